@@ -0,0 +1,369 @@
+#!/usr/bin/env python
+##########################################################################
+# This file is part of d00ks.
+# 
+# d00ks is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# d00ks is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with d00ks.  If not, see <http://www.gnu.org/licenses/>.
+##########################################################################
+
+
+"""
+This file is a benchmark suite for the simulator.
+
+Every program in examples/ is run through a Program, together
+with some synthetic kernels: a tight ALU loop, a fixed-point
+multiply-accumulate loop, a memory copy and a recursive fib. For each one it reports how long assembling
+took, how many instructions ran per second and the peak memory
+of the process. Each benchmark runs in a forked child where
+possible, so they don't inflate each other's peak memory. An
+example which fails (fib.s branches to a label it never defines)
+is skipped with a message rather than reported.
+
+Results can be saved as JSON and compared against a previous
+run, failing if anything got slower by more than a threshold:
+	python bench.py -o before.json
+	...
+	python bench.py -c before.json -t 0.05
+"""
+
+import os
+import sys
+import gc
+import glob
+import json
+import time
+import resource
+import traceback
+import simulator
+import fastlexer
+import preprocess
+from parser import parser
+
+VERSION = 1
+
+# stop runaway programs after this many instructions
+LIMIT = 10000000
+
+ALU = """
+AREA Alu, CODE, READONLY
+start
+	LDR R0, =20000
+	MOV R1, #0
+	MOV R2, #1
+loop
+	ADD R1, R1, R2
+	EOR R2, R2, R1, LSL #3
+	ORR R3, R1, R2, ROR #7
+	AND R4, R3, #0xFF
+	SUBS R0, R0, #1
+	BNE loop
+stop
+	B stop
+"""
+
+MULTIPLY = """
+AREA Mac, CODE, READONLY
+start
+	LDR R0, =20000
+	LDR R1, =0x12345
+	LDR R2, =0xFFFF8001
+	MOV R4, #0
+	MOV R5, #0
+	MOV R6, #0
+	MOV R7, #0
+loop
+	SMULL R8, R9, R1, R2
+	SMLAL R4, R5, R1, R2
+	UMULL R10, R11, R2, R1
+	UMLALS R6, R7, R2, R1
+	ADD R1, R1, R9
+	EOR R2, R2, R8
+	SUBS R0, R0, #1
+	BNE loop
+stop
+	B stop
+"""
+
+MEMCOPY = """
+AREA Copy, CODE, READONLY
+start
+	LDR R4, =100
+pass
+	LDR R0, =SRC
+	LDR R1, =DST
+	MOV R2, #256
+word
+	LDR R3, [R0], #4
+	STR R3, [R1], #4
+	SUBS R2, R2, #1
+	BNE word
+	SUBS R4, R4, #1
+	BNE pass
+stop
+	B stop
+
+AREA Buffers, DATA, READWRITE
+SRC SPACE 1024
+DST SPACE 1024
+"""
+
+RECURSION = """
+AREA Fib, CODE, READONLY
+start
+	LDR SP, =STK_TOP
+	MOV R0, #20
+	BL fib
+	B stop
+fib
+	CMP R0, #2
+	MOVLT PC, LR
+	STMFD SP!, {R4, R5, LR}
+	MOV R4, R0
+	SUB R0, R4, #1
+	BL fib
+	MOV R5, R0
+	SUB R0, R4, #2
+	BL fib
+	ADD R0, R5, R0
+	LDMFD SP!, {R4, R5, PC}
+stop
+	B stop
+
+AREA Stack, DATA, READWRITE
+STK_MEM SPACE 2048
+STK_TOP
+"""
+
+KERNELS = [
+	("alu", ALU),
+	("multiply", MULTIPLY),
+	("memcopy", MEMCOPY),
+	("recursion", RECURSION),
+]
+
+# metric: True if bigger is better
+METRICS = {
+	"ips": True,
+	"assemble": False,
+	"peak_kb": False,
+}
+
+class Benchmark(object):
+	"""
+	A program to assemble and run to completion. An optional
+	one is left out of the results if it fails.
+	"""
+	def __init__(self, name, source, filename="", optional=False):
+		self.name = name
+		self.source = source
+		self.filename = filename
+		self.optional = optional
+
+	def assemble(self):
+		'Returns a compiled simulator.Program'
+		data = preprocess.preprocess(self.source, self.filename)
+		program = simulator.Program()
+		program.compile(parser.parse(data, lexer=fastlexer.lexer))
+		return program
+
+	def run(self, repeat=3):
+		"""
+		Assembles and runs the program repeat times, returning a
+		dict of the best times.
+		"""
+		assemble = seconds = None
+		for i in xrange(repeat):
+			gc.collect()
+			start = time.time()
+			program = self.assemble()
+			elapsed = time.time() - start
+			if assemble is None or elapsed < assemble:
+				assemble = elapsed
+			start = time.time()
+			count = execute(program, LIMIT)
+			elapsed = time.time() - start
+			if seconds is None or elapsed < seconds:
+				seconds = elapsed
+		return {
+			"instructions": count,
+			"seconds": seconds,
+			"ips": count / seconds if seconds else 0.0,
+			"assemble": assemble,
+			"peak_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+		}
+
+def execute(program, limit):
+	'Steps program until a breakpoint, returning the instruction count'
+	step = program.step
+	count = 0
+	try:
+		while count < limit:
+			step()
+			count += 1
+	except simulator.Breakpoint:
+		pass
+	return count
+
+def benchmarks(files=None):
+	"""
+	Returns the examples (or the given files) and the kernels.
+	The examples are optional, as not all of them run.
+	"""
+	optional = files is None
+	if optional:
+		here = os.path.dirname(os.path.abspath(__file__))
+		files = sorted(glob.glob(os.path.join(here, "examples", "*.s")))
+	ans = []
+	for path in files:
+		f = open(path)
+		try:
+			ans.append(Benchmark(os.path.basename(path), f.read(), path, optional))
+		finally:
+			f.close()
+	for (name, source) in KERNELS:
+		ans.append(Benchmark(name, source))
+	return ans
+
+def measure(benchmark, repeat=3):
+	"""
+	Runs benchmark in a child process if os.fork is available,
+	returning its results, or a dict with an "error" if it failed.
+	"""
+	if not hasattr(os, "fork"):
+		return _measure(benchmark, repeat)
+	(r, w) = os.pipe()
+	pid = os.fork()
+	if pid == 0:
+		os.close(r)
+		try:
+			os.write(w, json.dumps(_measure(benchmark, repeat)))
+		finally:
+			os._exit(0)
+	os.close(w)
+	data = []
+	while True:
+		chunk = os.read(r, 4096)
+		if not chunk:
+			break
+		data.append(chunk)
+	os.close(r)
+	os.waitpid(pid, 0)
+	try:
+		return json.loads("".join(data))
+	except ValueError:
+		return {"error": "benchmark process died"}
+
+def _measure(benchmark, repeat):
+	try:
+		return benchmark.run(repeat)
+	except Exception, e:
+		return {"error": "".join(traceback.format_exception_only(type(e), e)).strip()}
+
+def run(suite, repeat=3, out=sys.stdout, err=sys.stderr):
+	"""
+	Measures each benchmark in suite, returning the results document.
+	Optional benchmarks which fail are reported to err and skipped.
+	"""
+	results = {}
+	out.write("%-16s %10s %10s %12s %10s %10s\n"%("benchmark", "instrs", "run s",
+		"instr/s", "asm s", "peak KB"))
+	for benchmark in suite:
+		result = measure(benchmark, repeat)
+		if "error" in result and benchmark.optional:
+			err.write("skipping %s: %s\n"%(benchmark.name, result["error"]))
+			err.flush()
+			continue
+		results[benchmark.name] = result
+		if "error" in result:
+			out.write("%-16s %s\n"%(benchmark.name, result["error"]))
+		else:
+			out.write("%-16s %10i %10.3f %12.0f %10.4f %10i\n"%(benchmark.name,
+				result["instructions"], result["seconds"], result["ips"],
+				result["assemble"], result["peak_kb"]))
+		out.flush()
+	return {
+		"version": VERSION,
+		"python": sys.version.split()[0],
+		"time": time.time(),
+		"repeat": repeat,
+		"results": results,
+	}
+
+def compare(old, new, threshold=0.05):
+	"""
+	Compares two results documents, returning a list of
+	(benchmark, metric, old value, new value, change) for every
+	metric that got worse by more than threshold (a fraction).
+	change is positive when new is worse.
+	"""
+	regressions = []
+	for name in sorted(new["results"]):
+		before = old["results"].get(name)
+		after = new["results"][name]
+		if before is None or "error" in before or "error" in after:
+			continue
+		for (metric, bigger) in sorted(METRICS.items()):
+			if not before[metric]:
+				continue
+			change = (after[metric] - before[metric]) / float(before[metric])
+			if bigger:
+				change = -change
+			if change > threshold:
+				regressions.append((name, metric, before[metric], after[metric], change))
+	return regressions
+
+def load(path):
+	f = open(path)
+	try:
+		return json.load(f)
+	finally:
+		f.close()
+
+def save(document, path):
+	f = open(path, "w")
+	try:
+		json.dump(document, f, indent=1, sort_keys=True)
+	finally:
+		f.close()
+
+def main(argv):
+	repeat = 3
+	output = baseline = None
+	threshold = 0.05
+	files = []
+	args = iter(argv)
+	for arg in args:
+		if arg == "-n":
+			repeat = int(args.next())
+		elif arg == "-o":
+			output = args.next()
+		elif arg == "-c":
+			baseline = args.next()
+		elif arg == "-t":
+			threshold = float(args.next())
+		else:
+			files.append(arg)
+	document = run(benchmarks(files or None), repeat)
+	if output:
+		save(document, output)
+	if baseline:
+		regressions = compare(load(baseline), document, threshold)
+		for (name, metric, before, after, change) in regressions:
+			print "REGRESSION %s %s: %g -> %g (%+.1f%%)"%(name, metric, before, after, 100*change)
+		if regressions:
+			return 1
+		print "No regressions over %.1f%%"%(100*threshold)
+	return 0
+
+if __name__ == "__main__":
+	sys.exit(main(sys.argv[1:]))
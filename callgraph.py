@@ -0,0 +1,249 @@
+##########################################################################
+# This file is part of d00ks.
+# 
+# d00ks is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# d00ks is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with d00ks.  If not, see <http://www.gnu.org/licenses/>.
+##########################################################################
+
+
+"""
+This file profiles a Program by guest function, following calls
+and returns to keep a shadow of the guest's call stack.
+
+A BL which is taken is a call to its target, returning to the
+instruction after it. Any other instruction that writes the PC
+(MOV PC, LR, LDM ... {..., PC}, BX LR, ...) is a return if the
+new PC is the return address of a call on the shadow stack, and
+it returns from every frame above that call too, so functions
+that are left by a longjmp-style jump don't stay on the stack.
+
+Time is counted in instructions, by adding the length of each
+basic block as it is entered, and is charged to the function on
+top of the shadow stack. finish() takes off the instructions of
+the block the program stopped in which haven't run. Like hotspot.Profile, the instructions
+are wrapped when they are decoded, and only block leaders and
+instructions that write the PC are wrapped at all.
+
+The results can be printed, saved in the format of the profile
+module so pstats and its viewers can read them (with instruction
+counts in place of seconds), or saved as collapsed stacks for
+flame graph tools:
+
+	graph = callgraph.CallGraph(program)
+	program.run()
+	graph.report()
+	graph.dump_stats("guest.prof")
+	graph.dump_collapsed("guest.folded")
+"""
+
+import sys
+import marshal
+import instruction
+import hotspot
+
+class CallGraph(object):
+	"""
+	For each function (named by the PC it was called at, with
+	the entry point as the root), calls[f] is the number of
+	calls, primitive[f] the number of them not made from inside
+	f itself, exclusive[f] the instructions run in f and
+	inclusive[f] the instructions run in f and everything it
+	called. edges[(caller, callee)] holds the same four numbers
+	for calls from one function to another, and stacks[path]
+	the instructions run with the shadow stack equal to path.
+	"""
+	def __init__(self, program, filename="<guest>"):
+		self.program = program
+		self.filename = filename
+		self.reset()
+		program.instrument(self.instrument)
+
+	def reset(self):
+		'Forgets everything, starting again from the current PC'
+		code = self.program.code
+		self.lengths = {}
+		for (start, end) in hotspot.blocks(code):
+			self.lengths[start] = end - start
+		self.clock = 0
+		self.charged = 0
+		self.root = self.program.registers[self.program.registers.PC]
+		# (function, return address, clock when called)
+		self.frames = []
+		self.path = [self.root]
+		# how many frames will return to each address
+		self.returns = {}
+		self.calls = {self.root: 1}
+		self.primitive = {self.root: 1}
+		self.exclusive = {self.root: 0}
+		self.inclusive = {self.root: 0}
+		self.edges = {}
+		self.stacks = {}
+
+	def detach(self):
+		'Stops profiling'
+		self.program.uninstrument(self.instrument)
+
+	def instrument(self, pc, instr, execute):
+		if hotspot.writes_pc(instr):
+			inner = execute
+			if isinstance(instr, instruction.B) and instr.link:
+				test = instr.cond
+				def execute(registers):
+					taken = test(registers)
+					inner(registers)
+					if taken:
+						self.call(registers[registers.PC], pc + 1)
+			else:
+				def execute(registers):
+					inner(registers)
+					if registers[registers.PC] in self.returns:
+						self.ret(registers[registers.PC])
+		length = self.lengths.get(pc)
+		if length is not None:
+			body = execute
+			def execute(registers):
+				self.clock += length
+				body(registers)
+		return execute
+
+	def charge(self):
+		'Charges the instructions since the last call or return to the current function'
+		elapsed = self.clock - self.charged
+		if elapsed:
+			self.charged = self.clock
+			function = self.path[-1]
+			self.exclusive[function] += elapsed
+			if len(self.path) > 1:
+				self.edges[(self.path[-2], function)][2] += elapsed
+			path = tuple(self.path)
+			self.stacks[path] = self.stacks.get(path, 0) + elapsed
+
+	def call(self, function, ret):
+		self.charge()
+		caller = self.path[-1]
+		recursive = function in self.path
+		self.frames.append((function, ret, self.clock))
+		self.path.append(function)
+		self.returns[ret] = self.returns.get(ret, 0) + 1
+		if function not in self.calls:
+			self.calls[function] = self.primitive[function] = 0
+			self.exclusive[function] = self.inclusive[function] = 0
+		self.calls[function] += 1
+		edge = self.edges.setdefault((caller, function), [0, 0, 0, 0])
+		edge[0] += 1
+		if not recursive:
+			self.primitive[function] += 1
+			edge[1] += 1
+
+	def ret(self, pc):
+		'Returns to pc, from the innermost call which will return there'
+		for depth in xrange(len(self.frames) - 1, -1, -1):
+			if self.frames[depth][1] == pc:
+				break
+		else:
+			return
+		self.charge()
+		while len(self.frames) > depth:
+			(function, ret, called) = self.frames.pop()
+			self.path.pop()
+			self.returns[ret] -= 1
+			if not self.returns[ret]:
+				del self.returns[ret]
+			elapsed = self.clock - called
+			# time in recursive calls is already counted by the outermost one
+			if function not in self.path:
+				self.inclusive[function] += elapsed
+			caller = self.path[-1]
+			if (caller, function) not in zip(self.path, self.path[1:]):
+				self.edges[(caller, function)][3] += elapsed
+
+	def finish(self):
+		"""
+		Charges the time of the calls still on the shadow stack, as
+		if they had all returned. Call it once the program stops.
+		"""
+		# the rest of a block the program stopped in hasn't run
+		stopped = hotspot.unfinished(self.program, hotspot.blocks(self.program.code))
+		if stopped is not None:
+			rest = stopped[2] - stopped[1]
+			if self.clock - self.charged >= rest:
+				self.clock -= rest
+		self.charge()
+		while self.frames:
+			self.ret(self.frames[-1][1])
+		self.inclusive[self.root] = self.clock
+
+	def name(self, function):
+		'Returns the label of a function, or <label + offset> if it has none'
+		found = self.program.symbols.lookup(function)
+		if found is None:
+			return "0x%X"%function
+		if found[1] == function:
+			return found[0]
+		return "%s+0x%X"%(found[0], function - found[1])
+
+	def key(self, function):
+		'The (file, line, name) that the profile module uses for a function'
+		return (self.filename, function, self.name(function))
+
+	def stats(self):
+		"""
+		Returns the results as the dict that profile.Profile keeps in
+		its stats attribute, for pstats.
+		"""
+		ans = {}
+		for function in self.calls:
+			callers = {}
+			for ((caller, callee), (nc, cc, tt, ct)) in self.edges.iteritems():
+				if callee == function:
+					callers[self.key(caller)] = (nc, cc, tt, ct)
+			ans[self.key(function)] = (self.primitive[function], self.calls[function],
+				self.exclusive[function], self.inclusive[function], callers)
+		return ans
+
+	def dump_stats(self, path):
+		'Saves the results in a file pstats.Stats can load'
+		f = open(path, "wb")
+		try:
+			marshal.dump(self.stats(), f)
+		finally:
+			f.close()
+
+	def collapsed(self):
+		'Returns the results as collapsed stacks, one "a;b;c count" per line'
+		lines = []
+		for (path, count) in self.stacks.iteritems():
+			lines.append("%s %i\n"%(";".join(self.name(f) for f in path), count))
+		lines.sort()
+		return "".join(lines)
+
+	def dump_collapsed(self, path):
+		f = open(path, "w")
+		try:
+			f.write(self.collapsed())
+		finally:
+			f.close()
+
+	def report(self, n=20, out=sys.stdout):
+		'Prints the n functions with the most instructions, including their callees'
+		total = self.inclusive[self.root] or self.clock or 1
+		out.write("%10s %10s %10s %7s %7s  %s\n"%("calls", "inclusive", "exclusive",
+			"incl %", "excl %", "function"))
+		functions = sorted(self.calls, key=lambda f: (-self.inclusive[f], -self.exclusive[f]))
+		for function in functions[:n]:
+			calls = "%i"%self.calls[function]
+			if self.primitive[function] != self.calls[function]:
+				calls = "%i/%i"%(self.calls[function], self.primitive[function])
+			out.write("%10s %10i %10i %7.2f %7.2f  %s\n"%(calls, self.inclusive[function],
+				self.exclusive[function], 100.0*self.inclusive[function]/total,
+				100.0*self.exclusive[function]/total, self.name(function)))
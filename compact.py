@@ -0,0 +1,386 @@
+##########################################################################
+# This file is part of d00ks.
+# 
+# d00ks is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# d00ks is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with d00ks.  If not, see <http://www.gnu.org/licenses/>.
+##########################################################################
+
+
+"""
+This file keeps the instructions of a program as parallel arrays
+instead of a list of objects, for very large programs.
+
+Each instruction is a row across seven columns: its opcode (an
+index into OPCODES, which says which class it is and how to
+rebuild it), its condition, a flag (S, the link bit of a branch
+or the ! of LDM/STM), Rd, Rn, the kind of its last operand and a
+32-bit immediate. A register or an immediate operand, and an
+immediate offset from a register, fit in the columns; any other
+operand goes in a pool of shared operands and the immediate is
+its index there. Equal operands share one pool entry.
+
+A CompactCode can stand in for Program.code: indexing it builds
+the instruction at that PC, which Program.decode() only does the
+first time the PC is reached. The columns and the pool are
+plain data, so dumps() and loads() only have to marshal them.
+
+	program.compact()
+	data = program.code.dumps()
+"""
+
+import sys
+import marshal
+from array import array
+import cond
+import instruction
+from instruction import reg, num, register_number
+
+VERSION = 1
+
+MASK = 0xFFFFFFFF
+
+# kinds of operand
+NONE = 0
+REGISTER = 1
+IMMEDIATE = 2
+OFFSET = 3
+POOLED = 4
+
+# the opcode of an instruction which is kept whole in the pool
+WHOLE = 0xFF
+
+# every condition, by name, so CS and HS stay apart
+CONDITIONS = sorted(cond.codes, key=lambda c: (cond.codes[c], c.__name__))
+_conditions = dict((c, i) for (i, c) in enumerate(CONDITIONS))
+
+class CompactError(Exception):
+	"""Raised for compact code that can't be loaded."""
+	pass
+
+class Unpackable(Exception):
+	"""Raised by a layout for an instruction it can't split into columns."""
+	pass
+
+def register(arg):
+	'Returns the number of a register Argument'
+	if not isinstance(arg, instruction.Argument) or not arg.isregister:
+		raise Unpackable(str(arg))
+	return arg.value
+
+# Layouts: pack(instr) returns (flag, rd, rn, operand), with rn
+# None if the instruction doesn't use that column, and
+# unpack(cls, cond, flag, rd, rn, operand) rebuilds it.
+
+def pack_dataproc(instr):
+	return (instr.s, instr.rd, register(instr.rn), instr.shifter_operand)
+
+def unpack_dataproc(cls, con, flag, rd, rn, operand):
+	return cls(con, bool(flag), rd, reg(rn), operand)
+
+def pack_move(instr):
+	return (instr.s, instr.rd, None, instr.shifter_operand)
+
+def unpack_move(cls, con, flag, rd, rn, operand):
+	return cls(con, bool(flag), rd, operand)
+
+def pack_compare(instr):
+	return (False, 0, register(instr.rn), instr.shifter_operand)
+
+def unpack_compare(cls, con, flag, rd, rn, operand):
+	return cls(con, reg(rn), operand)
+
+def pack_transfer(instr):
+	return (False, instr.rd, None, instr.addr_mode)
+
+def unpack_transfer(cls, con, flag, rd, rn, operand):
+	return cls(con, rd, operand)
+
+def pack_multiply(instr):
+	return (instr.s, instr.rd, None, (instr.rm, instr.rs))
+
+def unpack_multiply(cls, con, flag, rd, rn, operand):
+	return cls(con, bool(flag), rd, operand[0], operand[1])
+
+def pack_accumulate(instr):
+	return (instr.s, instr.rd, None, (instr.rm, instr.rs, instr.rn))
+
+def unpack_accumulate(cls, con, flag, rd, rn, operand):
+	return cls(con, bool(flag), rd, operand[0], operand[1], operand[2])
+
+def pack_long(instr):
+	return (instr.s, instr.rdlo, instr.rdhi, (instr.rm, instr.rs))
+
+def unpack_long(cls, con, flag, rd, rn, operand):
+	return cls(con, bool(flag), rd, rn, operand[0], operand[1])
+
+def pack_branch(instr):
+	return (instr.link, 0, None, instr.target)
+
+def unpack_branch(cls, con, flag, rd, rn, operand):
+	return cls(bool(flag), con, operand)
+
+def pack_multiple(instr):
+	return (instr.bang, 0, register_number(instr.rn), (instr.addrmode, tuple(instr.regs)))
+
+def unpack_multiple(cls, con, flag, rd, rn, operand):
+	return cls(con, operand[0], rn, bool(flag), list(operand[1]))
+
+def pack_nothing(instr):
+	return (False, 0, None, None)
+
+def unpack_nothing(cls, con, flag, rd, rn, operand):
+	return cls()
+
+_layouts = [
+	((instruction.ADC, instruction.ADD, instruction.AND, instruction.BIC, instruction.EOR,
+		instruction.ORR, instruction.RSB, instruction.RSC, instruction.SBC, instruction.SUB),
+		pack_dataproc, unpack_dataproc),
+	((instruction.MOV, instruction.MVN), pack_move, unpack_move),
+	((instruction.CMN, instruction.CMP, instruction.TEQ, instruction.TST),
+		pack_compare, unpack_compare),
+	((instruction.LDR, instruction.LDRB, instruction.LDRH, instruction.LDSB, instruction.LDSH,
+		instruction.STR, instruction.STRB, instruction.STRH), pack_transfer, unpack_transfer),
+	((instruction.MUL,), pack_multiply, unpack_multiply),
+	((instruction.MLA,), pack_accumulate, unpack_accumulate),
+	((instruction.SMLAL, instruction.SMULL, instruction.UMLAL, instruction.UMULL),
+		pack_long, unpack_long),
+	((instruction.B, instruction.BX), pack_branch, unpack_branch),
+	((instruction.LDM, instruction.STM), pack_multiple, unpack_multiple),
+	((instruction.BKPT,), pack_nothing, unpack_nothing),
+]
+
+# the dispatch table: OPCODES[opcode] is (class, pack, unpack)
+OPCODES = []
+for (_classes, _pack, _unpack) in _layouts:
+	for _cls in _classes:
+		OPCODES.append((_cls, _pack, _unpack))
+opcodes = dict((entry[0], i) for (i, entry) in enumerate(OPCODES))
+
+# the shifter operand of each register, shared as operands are never changed
+_registers = [instruction.Shifter(r) for r in instruction.REGISTERS]
+
+def fields(cls):
+	'Returns the names of the slots of cls, base classes first'
+	names = []
+	for klass in reversed(cls.__mro__):
+		names.extend(klass.__dict__.get("__slots__", ()))
+	return names
+
+def flatten(obj):
+	"""
+	Returns obj as nested tuples of plain values, which marshal
+	can store and which are equal for operands that are the same.
+	"""
+	if isinstance(obj, (list, tuple)):
+		return (type(obj).__name__, tuple(flatten(item) for item in obj))
+	if obj in _conditions:
+		return ("cond", _conditions[obj])
+	if isinstance(obj, (bool, int, long, str, type(None))):
+		return (type(obj).__name__, obj)
+	cls = type(obj)
+	if getattr(instruction, cls.__name__, None) is not cls:
+		raise CompactError("Cannot store %r"%obj)
+	values = []
+	for name in fields(cls):
+		try:
+			values.append((name, flatten(getattr(obj, name))))
+		except AttributeError:
+			pass
+	return (cls.__name__, tuple(values))
+
+def unflatten(flat):
+	'Rebuilds an object from flatten()'
+	(kind, value) = flat
+	if kind == "list":
+		return [unflatten(item) for item in value]
+	if kind == "tuple":
+		return tuple(unflatten(item) for item in value)
+	if kind == "cond":
+		return CONDITIONS[value]
+	if kind in ("bool", "int", "long", "str", "NoneType"):
+		return value
+	cls = getattr(instruction, kind, None)
+	if not isinstance(cls, type):
+		raise CompactError("Unknown type %s"%kind)
+	values = dict((name, unflatten(item)) for (name, item) in value)
+	if cls is instruction.Argument:
+		return (reg if values["isregister"] else num)(values["value"])
+	obj = cls.__new__(cls)
+	for (name, item) in values.iteritems():
+		setattr(obj, name, item)
+	return obj
+
+class CompactCode(object):
+	"""
+	The instructions of a program as columns. It behaves like a
+	list of instructions (len(), indexing and iterating) but makes
+	each instruction when it is asked for. labels maps PCs to
+	their labels, which are given to the instructions made.
+	"""
+	def __init__(self):
+		self.opcode = array('B')
+		self.cond = array('B')
+		self.flag = array('B')
+		self.rd = array('B')
+		self.rn = array('B')
+		self.kind = array('B')
+		self.imm = array('I')
+		self.pool = []
+		self.keys = {}
+		self.labels = {}
+
+	@classmethod
+	def from_code(cls, code):
+		'Packs a list of instructions'
+		compact = cls()
+		for instr in code:
+			compact.append(instr)
+		return compact
+
+	def columns(self):
+		return (self.opcode, self.cond, self.flag, self.rd, self.rn, self.kind, self.imm)
+
+	def __len__(self):
+		return len(self.opcode)
+
+	def intern(self, operand):
+		'Returns the index of operand in the pool, adding it if it is new'
+		try:
+			key = flatten(operand)
+		except CompactError:
+			# still shared in memory, but dumps() will refuse it
+			key = ("id", id(operand))
+		try:
+			return self.keys[key]
+		except KeyError:
+			index = self.keys[key] = len(self.pool)
+			self.pool.append(operand)
+			return index
+
+	def append(self, instr):
+		label = getattr(instr, "label", "")
+		if label:
+			self.labels[len(self)] = label
+		try:
+			(cls, pack, unpack) = OPCODES[opcodes[type(instr)]]
+			row = (opcodes[cls], _conditions[instr.cond]) + self.pack(instr, pack)
+		except (KeyError, AttributeError, TypeError, Unpackable):
+			# kept as it is, in the pool
+			row = (WHOLE, 0, 0, 0, 0, POOLED, self.intern(instr))
+		for (column, value) in zip(self.columns(), row):
+			column.append(value)
+
+	def pack(self, instr, pack):
+		'Returns the flag, rd, rn, kind and imm columns of instr'
+		(flag, rd, rn, operand) = pack(instr)
+		for field in (rd, rn):
+			if field is not None and not (isinstance(field, int) and 0 <= field < 0x100):
+				raise Unpackable(str(instr))
+		kind = type(operand)
+		if operand is None:
+			(kind, imm) = (NONE, 0)
+		elif kind is instruction.Shifter and operand.rm.isregister and 0 <= operand.rm.value < 16:
+			(kind, imm) = (REGISTER, operand.rm.value)
+		elif (kind is instruction.Shifter and isinstance(operand.rm.value, (int, long)) and
+				0 <= operand.rm.value <= MASK):
+			(kind, imm) = (IMMEDIATE, operand.rm.value)
+		elif (kind is instruction.AddrmodeImmoffset and rn is None and
+				type(operand.shifter_operand) is instruction.Shifter and
+				not operand.shifter_operand.rm.isregister and
+				isinstance(operand.shifter_operand.rm.value, (int, long)) and
+				-0x80000000 <= operand.shifter_operand.rm.value < 0x80000000):
+			(kind, imm) = (OFFSET, operand.shifter_operand.rm.value & MASK)
+			rn = operand.rn
+		else:
+			(kind, imm) = (POOLED, self.intern(operand))
+		return (1 if flag else 0, rd, rn or 0, kind, imm)
+
+	def operand(self, pc):
+		'Returns the last operand of the instruction at pc'
+		kind = self.kind[pc]
+		# array("I") gives back longs
+		imm = int(self.imm[pc])
+		if kind == REGISTER:
+			return _registers[imm]
+		elif kind == IMMEDIATE:
+			return instruction.Shifter(num(imm))
+		elif kind == OFFSET:
+			if imm & 0x80000000:
+				imm -= 1 << 32
+			return instruction.AddrmodeImmoffset(self.rn[pc], instruction.Shifter(num(imm)))
+		elif kind == POOLED:
+			return self.pool[imm]
+		return None
+
+	def __getitem__(self, pc):
+		if pc < 0:
+			pc += len(self)
+		opcode = self.opcode[pc]
+		if opcode == WHOLE:
+			return self.pool[self.imm[pc]]
+		(cls, pack, unpack) = OPCODES[opcode]
+		instr = unpack(cls, CONDITIONS[self.cond[pc]], self.flag[pc], self.rd[pc],
+			self.rn[pc], self.operand(pc))
+		label = self.labels.get(pc)
+		if label:
+			instr.label = label
+		return instr
+
+	def __iter__(self):
+		for pc in xrange(0, len(self)):
+			yield self[pc]
+
+	def size(self):
+		'Returns the number of bytes in the columns and the pool'
+		import footprint
+		columns = sum(column.itemsize * len(column) for column in self.columns())
+		return columns + footprint.Footprint(self.pool).total()
+
+	def dumps(self):
+		'Returns the columns, the pool and the labels as a string'
+		return marshal.dumps((VERSION, [entry[0].__name__ for entry in OPCODES],
+			[column.tostring() for column in self.columns()],
+			[flatten(operand) for operand in self.pool], self.labels))
+
+	@classmethod
+	def loads(cls, data):
+		try:
+			(version, names, columns, pool, labels) = marshal.loads(data)
+		except (EOFError, ValueError, TypeError):
+			raise CompactError("Not compact code")
+		if version != VERSION or names != [entry[0].__name__ for entry in OPCODES]:
+			raise CompactError("Compact code from an incompatible version")
+		compact = cls()
+		for (column, string) in zip(compact.columns(), columns):
+			column.fromstring(string)
+		if len(set(len(column) for column in compact.columns())) != 1:
+			raise CompactError("Compact code columns differ in length")
+		compact.pool = [unflatten(flat) for flat in pool]
+		compact.keys = dict((flat, i) for (i, flat) in enumerate(pool))
+		compact.labels = labels
+		return compact
+
+	def save(self, path):
+		f = open(path, "wb")
+		try:
+			f.write(self.dumps())
+		finally:
+			f.close()
+
+	@classmethod
+	def load(cls, path):
+		f = open(path, "rb")
+		try:
+			return cls.loads(f.read())
+		finally:
+			f.close()
@@ -125,3 +125,14 @@ def AL(R):
 	return True
 
 AL.__name__ = ""
+
+# condition field encodings used by the ARM instruction set,
+# keyed by condition function
+codes = {
+	EQ: 0x0, NE: 0x1, CS: 0x2, HS: 0x2, CC: 0x3, LO: 0x3, MI: 0x4, PL: 0x5,
+	VS: 0x6, VC: 0x7, HI: 0x8, LS: 0x9, GE: 0xA, LT: 0xB, GT: 0xC, LE: 0xD,
+	AL: 0xE,
+}
+
+# the reverse of codes, indexed by condition field
+by_code = [EQ, NE, CS, CC, MI, PL, VS, VC, HI, LS, GE, LT, GT, LE, AL, None]
@@ -0,0 +1,251 @@
+##########################################################################
+# This file is part of d00ks.
+# 
+# d00ks is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# d00ks is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with d00ks.  If not, see <http://www.gnu.org/licenses/>.
+##########################################################################
+
+
+"""
+This file estimates how many cycles a Program would take on an
+ARM7TDMI, from the number of sequential (S), non-sequential (N)
+and internal (I) cycles each instruction needs:
+
+	data processing		1S, +1I with a register shift, +1S+1N if it writes the PC
+	MUL, MLA		1S + mI, +1I to accumulate
+	UMULL, SMULL		1S + (m+1)I, +1I to accumulate
+	LDR			1S+1N+1I, +1S+1N if it loads the PC
+	STR			2N
+	LDM			nS+1N+1I, +1S+1N if it loads the PC
+	STM			(n-1)S+2N
+	B, BL, BX		2S+1N (refilling the pipeline)
+	SWP			1S+2N+1I
+	condition fails		1S
+
+where n is the number of registers transferred and m (1 to 4)
+depends on how many significant bytes the multiplier Rs has.
+Memory wait states can be modelled by making S and N cycles cost
+more than one clock with a Timing.
+
+The cost of every instruction is worked out once, when it is
+decoded. Like hotspot.Profile, only block leaders are wrapped,
+adding the cost of the whole block when it is entered (less the
+rest of a block the program has stopped in, when reporting); the only
+other instructions wrapped are conditional ones, which give back
+the difference if their condition fails, and multiplies, whose
+cost depends on their operands.
+
+	counter = cycles.Cycles(program)
+	program.run()
+	counter.report()
+"""
+
+import sys
+from array import array
+import cond
+import instruction
+import hotspot
+
+class Timing(object):
+	'The number of clocks taken by an S, N and I cycle'
+	def __init__(self, s=1, n=1, i=1):
+		self.s = s
+		self.n = n
+		self.i = i
+
+	def clocks(self, (s, n, i)):
+		return s*self.s + n*self.n + i*self.i
+
+MULTIPLY = (instruction.MUL, instruction.MLA, instruction.UMULL, instruction.SMULL,
+	instruction.UMLAL, instruction.SMLAL)
+LOAD = (instruction.LDR, instruction.LDRB, instruction.LDRH, instruction.LDSB,
+	instruction.LDSH)
+STORE = (instruction.STR, instruction.STRB, instruction.STRH)
+
+def multiplier_cycles(value, signed=True):
+	"""
+	Returns m for a multiplier, the number of cycles the early
+	terminating multiplier takes: 1 if bits 8-31 are all zero (or
+	all one, for signed multiplies), 2 for bits 16-31, 3 for bits
+	24-31 and 4 otherwise.
+	"""
+	value &= 0xFFFFFFFF
+	for (m, shift) in ((1, 8), (2, 16), (3, 24)):
+		top = value >> shift
+		if top == 0 or (signed and top == 0xFFFFFFFF >> shift):
+			return m
+	return 4
+
+def writes_pc(instr):
+	rd = getattr(instr, "rd", None)
+	return rd is not None and instruction.register_number(rd) == 15
+
+def cost(instr):
+	"""
+	Returns the (S, N, I) cycles instr takes when its condition
+	passes, not counting the m cycles of a multiply.
+	"""
+	if isinstance(instr, (instruction.B, instruction.BKPT)):
+		return (2, 1, 0)
+	if isinstance(instr, MULTIPLY):
+		internal = 0
+		if isinstance(instr, (instruction.UMULL, instruction.SMULL)):
+			internal = 1
+		elif isinstance(instr, (instruction.MLA, instruction.UMLAL, instruction.SMLAL)):
+			internal = 1 if isinstance(instr, instruction.MLA) else 2
+		return (1, 0, internal)
+	if isinstance(instr, LOAD):
+		return (2, 2, 1) if writes_pc(instr) else (1, 1, 1)
+	if isinstance(instr, STORE):
+		return (0, 2, 0)
+	if isinstance(instr, instruction.LDM):
+		n = len(instr.regs)
+		if 15 in [r.value for r in instr.regs]:
+			return (n + 1, 2, 1)
+		return (n, 1, 1)
+	if isinstance(instr, instruction.STM):
+		return (len(instr.regs) - 1, 2, 0)
+	if isinstance(instr, (instruction.SWP, instruction.SWPB)):
+		return (1, 2, 1)
+	(s, n, i) = (1, 0, 0)
+	arg = getattr(getattr(instr, "shifter_operand", None), "arg", None)
+	if isinstance(arg, instruction.Argument) and arg.isregister:
+		i += 1
+	if writes_pc(instr):
+		(s, n) = (s + 1, n + 1)
+	return (s, n, i)
+
+# cycles taken by an instruction whose condition fails
+FAILED = (1, 0, 0)
+
+class Cycles(object):
+	"""
+	Cycle counts for a program: cycles[pc] holds the clocks spent
+	in the block starting at pc (or, for instructions inside a
+	block, the corrections for failed conditions and multiplies),
+	and entries[pc] the number of times the block was entered.
+	"""
+	def __init__(self, program, timing=None):
+		self.program = program
+		self.timing = timing or Timing()
+		self.reset()
+		program.instrument(self.instrument)
+
+	def reset(self):
+		'Sets all the counts back to zero'
+		n = len(self.program.code)
+		self.cycles = array('l', [0]) * n
+		self.entries = array('L', [0]) * n
+		self.blocks = dict(hotspot.blocks(self.program.code))
+
+	def detach(self):
+		'Stops counting'
+		self.program.uninstrument(self.instrument)
+
+	def clocks(self, instr):
+		return self.timing.clocks(cost(instr))
+
+	def instrument(self, pc, instr, execute):
+		cycles = self.cycles
+		test = getattr(instr, "cond", cond.AL)
+		if isinstance(instr, MULTIPLY):
+			signed = not isinstance(instr, (instruction.UMULL, instruction.UMLAL))
+			rs = instr.rs
+			internal = self.timing.i
+			saved = self.clocks(instr) - self.timing.clocks(FAILED)
+			inner = execute
+			def execute(registers):
+				if test(registers):
+					cycles[pc] += internal*multiplier_cycles(rs.get(registers), signed)
+				else:
+					cycles[pc] -= saved
+				inner(registers)
+		elif test is not cond.AL:
+			saved = self.clocks(instr) - self.timing.clocks(FAILED)
+			inner = execute
+			def execute(registers):
+				if not test(registers):
+					cycles[pc] -= saved
+				inner(registers)
+		end = self.blocks.get(pc)
+		if end is not None:
+			code = self.program.code
+			clocks = sum(self.clocks(code[i]) for i in xrange(pc, end))
+			entries = self.entries
+			body = execute
+			def execute(registers):
+				cycles[pc] += clocks
+				entries[pc] += 1
+				body(registers)
+		return execute
+
+	def unfinished(self):
+		"""
+		Returns (start, clocks, instructions) for the instructions
+		charged to the block at start, which the program stopped
+		partway through, that haven't run yet, or None.
+		"""
+		stopped = hotspot.unfinished(self.program, sorted(self.blocks.iteritems()))
+		if stopped is None or not self.entries[stopped[0]]:
+			return None
+		(start, pc, end) = stopped
+		code = self.program.code
+		return (start, sum(self.clocks(code[i]) for i in xrange(pc, end)), end - pc)
+
+	def charged(self):
+		'Returns the clocks for each pc, for the instructions which have run'
+		cycles = self.cycles
+		stopped = self.unfinished()
+		if stopped is not None:
+			cycles = array('l', cycles)
+			cycles[stopped[0]] -= stopped[1]
+		return cycles
+
+	def total(self):
+		'Returns the total number of clocks'
+		return sum(self.charged())
+
+	def instructions(self):
+		'Returns the number of instructions run'
+		ans = sum(self.entries[start]*(end - start) for (start, end) in self.blocks.iteritems())
+		stopped = self.unfinished()
+		if stopped is not None:
+			ans -= stopped[2]
+		return ans
+
+	def functions(self):
+		"""
+		Returns (clocks, label) for each label, counting every
+		instruction up to the next label, most first.
+		"""
+		cycles = self.charged()
+		symbols = self.program.symbols.ranges(end=len(cycles))
+		ans = []
+		if not symbols or symbols[0][1] > 0:
+			first = symbols[0][1] if symbols else len(cycles)
+			ans.append((sum(cycles[:first]), "{program}"))
+		for (name, start, end) in symbols:
+			ans.append((sum(cycles[start:end]), name))
+		ans.sort(key=lambda (clocks, name): -clocks)
+		return ans
+
+	def report(self, n=10, out=sys.stdout):
+		'Prints the total and the n labels taking the most cycles'
+		total = self.total()
+		instructions = self.instructions()
+		out.write("%i cycles, %i instructions, %.2f cycles per instruction\n\n"%(total,
+			instructions, float(total)/(instructions or 1)))
+		out.write("%10s %6s  %s\n"%("cycles", "%", "label"))
+		for (clocks, name) in self.functions()[:n]:
+			if clocks:
+				out.write("%10i %6.2f  %s\n"%(clocks, 100.0*clocks/(total or 1), name))
@@ -20,18 +20,81 @@
 
 from parser import *
 from sys import argv
+import image
+import fastlexer
+import preprocess
+import hotspot
+import callgraph
+import cycles
+import tracefile
+import timetravel
+import guestcov
+import idle
 
-f = open(argv[-1])
-prog = f.read()
-output = parser.parse(prog)
+program = simulator.Program()
+
+if "-b" in argv:
+	program.load(image.Image.load(argv[-1]))
+	for line in program.listing():
+		print line
+else:
+	f = open(argv[-1])
+	prog = f.read()
+	path = [argv[i + 1] for (i, arg) in enumerate(argv[:-1]) if arg == "-I"]
+	prog = preprocess.preprocess(prog, argv[-1], path, cache=preprocess.default_cache())
+	output = parser.parse(prog, lexer=fastlexer.lexer)
+	
+	for (label, line) in output:
+		print "%s\t%s"%(label+"\n" if label else "", line if line else "")
+	
+	program.compile(output)
+	if "-K" in argv:
+		program.compact()
 
-for (label, line) in output:
-	print "%s\t%s"%(label+"\n" if label else "", line if line else "")
+if "-o" in argv:
+	program.image().save(argv[argv.index("-o") + 1])
 
-program = simulator.Program()
-program.compile(output)
+if "-H" in argv:
+	profile = hotspot.Profile(program)
+
+if "-P" in argv or "-F" in argv:
+	graph = callgraph.CallGraph(program, argv[-1])
+
+if "-C" in argv:
+	counter = cycles.Cycles(program)
+
+if "-T" in argv:
+	trace = tracefile.Trace(program, tracefile.Writer(argv[argv.index("-T") + 1]))
+
+if "-i" in argv and int(argv[argv.index("-i") + 1]):
+	idle.IdleDetector(program, int(argv[argv.index("-i") + 1]))
+
+if "-V" in argv:
+	coverage = guestcov.Coverage.record(program)
+
+if "-R" in argv:
+	history = timetravel.History(program)
 
 if "-e" in argv:
 	program.run()
 else:
 	program.debug()
+
+if "-H" in argv:
+	profile.report()
+
+if "-C" in argv:
+	counter.report()
+
+if "-T" in argv:
+	trace.close()
+
+if "-V" in argv:
+	coverage.save(argv[argv.index("-V") + 1])
+
+if "-P" in argv or "-F" in argv:
+	graph.finish()
+	if "-P" in argv:
+		graph.dump_stats(argv[argv.index("-P") + 1])
+	if "-F" in argv:
+		graph.dump_collapsed(argv[argv.index("-F") + 1])
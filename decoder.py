@@ -0,0 +1,332 @@
+##########################################################################
+# This file is part of d00ks.
+# 
+# d00ks is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# d00ks is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with d00ks.  If not, see <http://www.gnu.org/licenses/>.
+##########################################################################
+
+"""
+This file turns 32-bit ARM words back into the instruction
+objects of instruction.py, so that binary images run on the
+same engine as assembled source.
+
+A loaded image has its code mapped into memory at address 0,
+with the word for PC n at address 4*n, and its data areas at
+their usual addresses. Instructions are decoded the first time
+they run, and a write to a code page throws away the decoded
+instructions on that page.
+"""
+
+import struct
+import cond
+import instruction
+import memory
+from instruction import reg, num
+
+# code pages are 1<<PAGE_SHIFT words
+PAGE_SHIFT = 6
+PAGE_WORDS = 1 << PAGE_SHIFT
+
+class DecodeError(Exception):
+	pass
+
+_dataproc = {
+	0x0: instruction.AND, 0x1: instruction.EOR, 0x2: instruction.SUB, 0x3: instruction.RSB,
+	0x4: instruction.ADD, 0x5: instruction.ADC, 0x6: instruction.SBC, 0x7: instruction.RSC,
+	0xC: instruction.ORR, 0xE: instruction.BIC,
+}
+_compare = {0x8: instruction.TST, 0x9: instruction.TEQ, 0xA: instruction.CMP, 0xB: instruction.CMN}
+_move = {0xD: instruction.MOV, 0xF: instruction.MVN}
+_shifts = [instruction.LSL, instruction.LSR, instruction.ASR, instruction.ROR]
+_longmul = {4: instruction.UMULL, 5: instruction.UMLAL, 6: instruction.SMULL, 7: instruction.SMLAL}
+_halfword_loads = {1: instruction.LDRH, 2: instruction.LDSB, 3: instruction.LDSH}
+_multiple_modes = {(0, 1): 'IA', (1, 1): 'IB', (0, 0): 'DA', (1, 0): 'DB'}
+
+def decode_immediate(bits):
+	'Expands a 12 bit rotate/immed_8 field'
+	rot = (bits >> 7) & 0x1E
+	imm = bits & 0xFF
+	return ((imm >> rot) | (imm << (32 - rot))) & 0xFFFFFFFF
+
+def decode_shifter(bits):
+	'Decodes a register shifter_operand field'
+	rm = reg(bits & 0xF)
+	kind = (bits >> 5) & 0x3
+	if bits & 0x10:
+		if bits & 0x80:
+			raise DecodeError("Not a shifter operand")
+		return _shifts[kind](rm, reg((bits >> 8) & 0xF))
+	amount = (bits >> 7) & 0x1F
+	if amount == 0:
+		if kind == 0:
+			return instruction.Shifter(rm)
+		elif kind == 3:
+			return instruction.RRX(rm, num(1))
+		# LSR #32 and ASR #32
+		amount = 32
+	return _shifts[kind](rm, num(amount))
+
+def decode(word, pc, fetch, labels):
+	"""
+	Decodes the word at pc into an instruction object.
+
+	fetch(n) returns the code word at PC n, for PC-relative
+	literal loads. labels maps PCs to code symbols, so that
+	branches show their targets.
+	"""
+	con = cond.by_code[word >> 28]
+	if con is None:
+		raise DecodeError("Unconditional instruction space is not supported")
+	s = bool(word & (1 << 20))
+	rn = (word >> 16) & 0xF
+	rd = (word >> 12) & 0xF
+	group = (word >> 25) & 0x7
+
+	if group in (0, 1):
+		if (word & 0x0FC000F0) == 0x00000090:
+			rm = reg(word & 0xF)
+			rs = reg((word >> 8) & 0xF)
+			if word & (1 << 21):
+				return instruction.MLA(con, s, rn, rm, rs, reg(rd))
+			return instruction.MUL(con, s, rn, rm, rs)
+		if (word & 0x0F8000F0) == 0x00800090:
+			return _longmul[(word >> 21) & 0x7](con, s, rd, rn, reg(word & 0xF), reg((word >> 8) & 0xF))
+		if (word & 0x0FFFFFD0) == 0x012FFF10:
+			return instruction.BX(bool(word & 0x20), con, reg(word & 0xF))
+		if (word & 0xFFF000F0) == 0xE1200070:
+			return instruction.BKPT()
+		if group == 0 and (word & 0x90) == 0x90:
+			return decode_halfword(word, con, rn, rd)
+		opcode = (word >> 21) & 0xF
+		if group == 1:
+			operand = instruction.Shifter(num(decode_immediate(word & 0xFFF)))
+		else:
+			operand = decode_shifter(word & 0xFFF)
+		if opcode in _dataproc:
+			return _dataproc[opcode](con, s, rd, reg(rn), operand)
+		if opcode in _move:
+			return _move[opcode](con, s, rd, operand)
+		if not s:
+			raise DecodeError("PSR transfers are not supported")
+		return _compare[opcode](con, reg(rn), operand)
+
+	if group in (2, 3):
+		return decode_transfer(word, pc, fetch, con, rn, rd)
+
+	if group == 4:
+		if word & (1 << 22):
+			raise DecodeError("User bank LDM/STM is not supported")
+		mode = _multiple_modes[((word >> 24) & 1, (word >> 23) & 1)]
+		bang = bool(word & (1 << 21))
+		regs = [reg(i) for i in range(0, 16) if word & (1 << i)]
+		if word & (1 << 20):
+			return instruction.LDM(con, mode, rn, bang, regs)
+		return instruction.STM(con, mode, rn, bang, regs)
+
+	if group == 5:
+		offset = word & 0xFFFFFF
+		if offset & 0x800000:
+			offset -= 0x1000000
+		dest = pc + 2 + offset
+		if dest in labels:
+			target = instruction.BranchTarget(True, labels[dest])
+		else:
+			target = instruction.BranchTarget(False, dest)
+		return instruction.B(bool(word & (1 << 24)), con, target)
+
+	raise DecodeError("Coprocessor and SWI instructions are not supported")
+
+def decode_transfer(word, pc, fetch, con, rn, rd):
+	'Decodes a word or unsigned byte load/store'
+	p = (word >> 24) & 1
+	u = (word >> 23) & 1
+	byte = word & (1 << 22)
+	w = (word >> 21) & 1
+	load = word & (1 << 20)
+	if word & (1 << 25):
+		if word & 0x10:
+			raise DecodeError("Undefined instruction")
+		if not u:
+			raise DecodeError("Subtracted register offsets are not supported")
+		offset = decode_shifter(word & 0xFFF)
+	else:
+		offset = word & 0xFFF
+		if not u:
+			offset = -offset
+		if rn == 15 and p and not w:
+			# a literal pool load, as written by LDR Rd, =<target>
+			if not load or byte or offset & 0x3:
+				raise DecodeError("PC-relative transfers other than literal loads are not supported")
+			return instruction.LDR(con, rd, instruction.immediate(fetch(pc + 2 + (offset >> 2))))
+		offset = instruction.Shifter(num(offset))
+	if p and w:
+		addr_mode = instruction.AddrmodePreindexed(rn, offset)
+	elif p:
+		if word & 0x02000FFF:
+			addr_mode = instruction.AddrmodeImmoffset(rn, offset)
+		else:
+			addr_mode = instruction.Addrmode(rn)
+	elif w:
+		raise DecodeError("User mode transfers are not supported")
+	else:
+		addr_mode = instruction.AddrmodePostindexed(rn, offset)
+	if load:
+		cls = instruction.LDRB if byte else instruction.LDR
+	else:
+		cls = instruction.STRB if byte else instruction.STR
+	return cls(con, rd, addr_mode)
+
+def decode_halfword(word, con, rn, rd):
+	'Decodes a halfword or signed byte load/store'
+	p = (word >> 24) & 1
+	u = (word >> 23) & 1
+	w = (word >> 21) & 1
+	sh = (word >> 5) & 0x3
+	if word & (1 << 22):
+		offset = ((word >> 4) & 0xF0) | (word & 0xF)
+		if not u:
+			offset = -offset
+		offset = instruction.Shifter(num(offset))
+	elif not u:
+		raise DecodeError("Subtracted register offsets are not supported")
+	else:
+		offset = instruction.Shifter(reg(word & 0xF))
+	if p:
+		if w:
+			addr_mode = instruction.AddrmodePreindexed(rn, offset)
+		else:
+			addr_mode = instruction.AddrmodeImmoffset(rn, offset)
+	else:
+		addr_mode = instruction.AddrmodePostindexed(rn, offset)
+	if word & (1 << 20):
+		return _halfword_loads[sh](con, rd, addr_mode)
+	if sh != 1:
+		raise DecodeError("Doubleword transfers are not supported")
+	return instruction.STRH(con, rd, addr_mode)
+
+class DecodedCode(object):
+	"""
+	The code of a loaded image, as a sequence of instruction
+	objects indexed by PC. Words are decoded from memory when
+	first asked for, and decoded instructions are cached by
+	(PC, word), so code that is rewritten and later restored
+	is not decoded twice.
+
+	PC-relative literal loads are decoded to the value of their
+	literal, so every word decoded at their PC is thrown away
+	when the literal's page is written to.
+	"""
+	def __init__(self, program, mem, ntext, labels):
+		self.program = program
+		self.memory = mem
+		self.ntext = ntext
+		self.labels = labels
+		self.cache = {}
+		self.slots = [None] * ntext
+		self.dependents = {}
+
+	def __len__(self):
+		return self.ntext
+
+	def __getitem__(self, pc):
+		if pc < 0:
+			pc += self.ntext
+		instr = self.slots[pc]
+		if instr is None:
+			instr = self.decode(pc)
+		return instr
+
+	def __iter__(self):
+		for pc in xrange(0, self.ntext):
+			yield self[pc]
+
+	def fetch(self, pc):
+		'Returns the code word at pc'
+		return struct.unpack_from("<I", self.memory.buffer, 4*pc)[0]
+
+	def decode(self, pc):
+		word = self.fetch(pc)
+		words = self.cache.setdefault(pc, {})
+		try:
+			instr = words[word]
+		except KeyError:
+			literals = []
+			def fetch(n):
+				literals.append(n)
+				return self.fetch(n)
+			try:
+				instr = decode(word, pc, fetch, self.labels)
+			except DecodeError, e:
+				raise DecodeError("0x%X: %08X: %s"%(pc, word, e))
+			instr.label = self.labels.get(pc, "")
+			for n in literals:
+				self.dependents.setdefault(n >> PAGE_SHIFT, set()).add(pc)
+			words[word] = instr
+		self.slots[pc] = instr
+		return instr
+
+	def invalidate(self, index):
+		"""
+		Called when the guest writes to the code word at index.
+		Forgets the decoded instructions on its page.
+		"""
+		page = index >> PAGE_SHIFT
+		for pc in xrange(page << PAGE_SHIFT, min((page + 1) << PAGE_SHIFT, self.ntext)):
+			if self.slots[pc] is not None:
+				self.slots[pc] = None
+				self.program.forget(pc)
+		for pc in self.dependents.pop(page, ()):
+			# the literal may have changed under any word decoded at pc
+			self.cache.pop(pc, None)
+			self.slots[pc] = None
+			self.program.forget(pc)
+
+class ImageMemory(memory.Memory):
+	"""
+	Memory for a loaded image. The code words sit at the start
+	of the buffer, mapped at address 0, followed by the data
+	areas at their usual address. Stores into the code tell the
+	DecodedCode to forget what it has decoded.
+	"""
+	def __init__(self, img, size=4096):
+		self.code_size = 4*len(img.words)
+		size = max(size, len(img.data))
+		super(ImageMemory, self).__init__(self.code_size + size)
+		self.size = size
+		self.startaddr = img.database
+		self.code = None
+		struct.pack_into("<%iI"%len(img.words), self.buffer, 0, *img.words)
+		self.buffer[self.code_size:self.code_size + len(img.data)] = img.data
+
+	def realaddr(self, addr):
+		if 0 <= addr < self.code_size:
+			return addr
+		real = addr - self.startaddr
+		if real < 0 or real >= self.size:
+			raise memory.MemoryError("Out of bounds access at 0x%X"%addr)
+		return real + self.code_size
+
+	def strb(self, addr, byte):
+		super(ImageMemory, self).strb(addr, byte)
+		if 0 <= addr < self.code_size:
+			self.code.invalidate(addr >> 2)
+
+	def strh(self, addr, hw):
+		super(ImageMemory, self).strh(addr, hw)
+		if 0 <= addr < self.code_size:
+			self.code.invalidate(addr >> 2)
+
+	def strw(self, addr, word):
+		super(ImageMemory, self).strw(addr, word)
+		if 0 <= addr < self.code_size:
+			self.code.invalidate(addr >> 2)
@@ -0,0 +1,170 @@
+##########################################################################
+# This file is part of d00ks.
+# 
+# d00ks is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# d00ks is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with d00ks.  If not, see <http://www.gnu.org/licenses/>.
+##########################################################################
+
+"""
+A hand-written lexer for d00ks, producing the same tokens as
+lexer.py without going through ply.lex.
+
+All the token rules are joined into one master regex, in the
+order PLY tries them, and the ignored characters are skipped by
+the same match. Names are looked up in a single dict mapping
+every mnemonic permutation and reserved word to its token type
+and value.
+
+Use it by handing it to the parser:
+	parser.parse(data, lexer=fastlexer.lexer)
+"""
+
+import re
+from ply.lex import LexToken
+import instruction
+import lexer as _rules
+
+# (token type, rule) in the order ply.lex tries them: functions in
+# the order they are defined in lexer.py, then the literal strings.
+# The regexes are taken from lexer.py so the two cannot drift apart.
+_order = [
+	('STRING', _rules.t_STRING),
+	('CHAR', _rules.t_CHAR),
+	('HEXNUM', _rules.t_HEXNUM),
+	('CONSTNUM', _rules.t_CONSTNUM),
+	('MEMHEXNUM', _rules.t_MEMHEXNUM),
+	('MEMNUM', _rules.t_MEMNUM),
+	('REGISTER', _rules.t_REGISTER),
+	('IMMHEXTARGET', _rules.t_IMMHEXTARGET),
+	('IMMTARGET', _rules.t_IMMTARGET),
+	('COMMENT', _rules.t_COMMENT),
+	('newline', _rules.t_newline),
+	('LABEL', _rules.t_LABEL),
+	('LABELTARGET', _rules.t_LABELTARGET),
+	('OPENSQ', _rules.t_OPENSQ),
+	('CLOSESQ', _rules.t_CLOSESQ),
+	('BANG', _rules.t_BANG),
+	('TO', _rules.t_TO),
+	('OPENCB', _rules.t_OPENCB),
+	('CLOSECB', _rules.t_CLOSECB),
+]
+
+def _regex(rule):
+	if isinstance(rule, str):
+		return rule
+	return rule.__doc__
+
+master = re.compile("[%s]*(?:%s)"%(re.escape(_rules.t_ignore),
+	"|".join("(?P<%s>%s)"%(name, _regex(rule)) for (name, rule) in _order)), re.VERBOSE)
+
+# upper-cased name: (token type, value or None to keep the text)
+keywords = {}
+for _word in _rules.reserved:
+	keywords[_word] = (_word, None)
+for (_word, _perm) in _rules.perms.iteritems():
+	keywords[_word] = (_perm[0], _perm)
+
+class Lexer(object):
+	"""
+	Has the parts of the ply.lex.Lexer interface that ply.yacc
+	and the parser use: input(), token(), lineno and lexdata.
+	"""
+	def __init__(self):
+		self.input("")
+
+	def input(self, data):
+		self.lexdata = data
+		self.lexpos = 0
+		self.lineno = 1
+
+	def __iter__(self):
+		return self
+
+	def next(self):
+		tok = self.token()
+		if tok is None:
+			raise StopIteration
+		return tok
+
+	def token(self):
+		data = self.lexdata
+		pos = self.lexpos
+		end = len(data)
+		match = master.match
+		ignore = _rules.t_ignore
+		while pos < end:
+			m = match(data, pos)
+			if m is None:
+				if data[pos] not in ignore:
+					print "Illegal character '%s'" % data[pos]
+				pos += 1
+				continue
+			kind = m.lastgroup
+			text = m.group(kind)
+			start = m.start(kind)
+			pos = m.end()
+			if kind == 'newline':
+				self.lineno += len(text)
+				continue
+			elif kind == 'COMMENT':
+				line = _rules.line_marker(text)
+				if line is not None:
+					self.lineno = line - 1
+				continue
+			elif kind == 'LABEL':
+				keyword = keywords.get(text.upper())
+				if keyword is not None:
+					kind = keyword[0]
+					if keyword[1] is not None:
+						text = keyword[1]
+				value = text
+			elif kind == 'REGISTER':
+				value = instruction.reg(int(text[1:]))
+			elif kind == 'CONSTNUM':
+				value = instruction.num(int(text[1:]))
+			elif kind == 'HEXNUM':
+				value = instruction.num(int(text[1:], 16))
+			elif kind == 'MEMNUM':
+				value = int(text)
+			elif kind == 'MEMHEXNUM':
+				value = int(text, 16)
+			elif kind == 'IMMTARGET':
+				value = instruction.immediate(int(text[1:]))
+			elif kind == 'IMMHEXTARGET':
+				value = instruction.immediate(int(text[1:], 16))
+			elif kind == 'LABELTARGET':
+				value = instruction.label(text[1:])
+			elif kind == 'STRING':
+				value = text[1:-1]
+			elif kind == 'CHAR':
+				value = instruction.num(ord(text[2:-1]))
+			else:
+				value = text
+			tok = LexToken()
+			tok.type = kind
+			tok.value = value
+			tok.lineno = self.lineno
+			tok.lexpos = start
+			tok.lexer = self
+			self.lexpos = pos
+			return tok
+		self.lexpos = pos
+		return None
+
+lexer = Lexer()
+
+def tokenize(data):
+	'Returns the list of tokens in data'
+	lex = Lexer()
+	lex.input(data)
+	return list(lex)
@@ -0,0 +1,246 @@
+##########################################################################
+# This file is part of d00ks.
+# 
+# d00ks is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# d00ks is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with d00ks.  If not, see <http://www.gnu.org/licenses/>.
+##########################################################################
+
+
+"""
+This file simplifies instructions as they are decoded, so work
+that only depends on the instruction is done once rather than
+every time it runs.
+
+A shifter operand made only of immediates is evaluated there and
+then and becomes a Constant, carry out and all. A register shifted
+by an immediate amount gets an evaluator for that kind of shift
+with the amount built in, and a plain register is read directly.
+Address modes with an immediate offset add a Constant to the base
+register.
+
+The instructions in Program.code are never changed: simplify()
+returns a copy with the new operands, which is only used to run
+the instruction, so listings and images show what was written.
+"""
+
+import copy
+import promise
+import register
+import instruction
+
+MASK = 0xFFFFFFFF
+
+class Constant(instruction.Shifter):
+	"""
+	A shifter operand with a fixed value. carry is the C flag it
+	sets when asked to, or None if it leaves the C flag alone.
+	"""
+	__slots__ = ("original", "value", "carry")
+	def __init__(self, original, value, carry=None):
+		self.original = original
+		self.rm = instruction.num(value)
+		self.value = value
+		self.carry = carry
+
+	def __str__(self):
+		return str(self.original)
+
+	@promise.sensible()
+	def get(self, registers, flags=False):
+		if flags and self.carry is not None:
+			registers.flag_set(registers.C, self.carry)
+		return self.value
+
+	@promise.sensible()
+	def shift(self, registers):
+		return (self.value, self.carry)
+
+class Register(instruction.Shifter):
+	'A register operand, read without going through an Argument'
+	__slots__ = ("original", "reg")
+	def __init__(self, original):
+		self.original = original
+		self.rm = original.rm
+		self.reg = original.rm.value
+
+	def __str__(self):
+		return str(self.original)
+
+	@promise.sensible()
+	def get(self, registers, flags=False):
+		return registers[self.reg]
+
+	@promise.sensible()
+	def shift(self, registers):
+		return (registers[self.reg], None)
+
+class ShiftedRegister(Register):
+	"""
+	A register shifted by an immediate amount from 1 to 31, for
+	subclasses to apply. Every one of them sets the C flag.
+	"""
+	__slots__ = ("arg", "amount")
+	def __init__(self, original):
+		super(ShiftedRegister, self).__init__(original)
+		self.arg = original.arg
+		self.amount = original.arg.value
+
+	@promise.sensible()
+	def get(self, registers, flags=False):
+		(value, carry) = self.shift(registers)
+		if flags:
+			registers.flag_set(registers.C, carry)
+		return value
+
+class ShiftedLSL(ShiftedRegister):
+	__slots__ = ("right",)
+	def __init__(self, original):
+		super(ShiftedLSL, self).__init__(original)
+		self.right = 32 - self.amount
+
+	@promise.sensible()
+	def shift(self, registers):
+		value = registers[self.reg]
+		return ((value << self.amount) & MASK, (value >> self.right) & 1)
+
+class ShiftedLSR(ShiftedRegister):
+	__slots__ = ()
+	@promise.sensible()
+	def shift(self, registers):
+		value = registers[self.reg]
+		return (value >> self.amount, (value >> (self.amount - 1)) & 1)
+
+class ShiftedASR(ShiftedRegister):
+	__slots__ = ("fill",)
+	def __init__(self, original):
+		super(ShiftedASR, self).__init__(original)
+		self.fill = (MASK << (32 - self.amount)) & MASK
+
+	@promise.sensible()
+	def shift(self, registers):
+		value = registers[self.reg]
+		carry = (value >> (self.amount - 1)) & 1
+		if value & (1 << 31):
+			return ((value >> self.amount) | self.fill, carry)
+		return (value >> self.amount, carry)
+
+class ShiftedROR(ShiftedRegister):
+	__slots__ = ("left",)
+	def __init__(self, original):
+		super(ShiftedROR, self).__init__(original)
+		self.left = 32 - self.amount
+
+	@promise.sensible()
+	def shift(self, registers):
+		value = registers[self.reg]
+		value = ((value >> self.amount) | (value << self.left)) & MASK
+		return (value, value >> 31)
+
+# the evaluators for a register shifted by 1 to 31; other amounts
+# are rare enough to be left to the general case
+shifted = {
+	instruction.LSL: ShiftedLSL,
+	instruction.LSR: ShiftedLSR,
+	instruction.ASR: ShiftedASR,
+	instruction.ROR: ShiftedROR,
+}
+
+class ConstantOffset(instruction.AddrmodeImmoffset):
+	'[Rn, #offset]'
+	__slots__ = ("original", "offset")
+	def __init__(self, original, offset):
+		self.original = original
+		self.rn = original.rn
+		self.shifter_operand = offset
+		self.offset = offset.value
+
+	def __str__(self):
+		return str(self.original)
+
+	@promise.sensible()
+	def get(self, registers):
+		return registers[self.rn] + self.offset
+
+def evaluate(shifter, carry):
+	"""
+	Returns (value, C flag after) for a shifter operand of
+	immediates, with the C flag set to carry before.
+	"""
+	registers = register.Registers()
+	registers.flag_set(registers.C, carry)
+	(value, after) = shifter.shift(registers)
+	if after is None:
+		after = carry
+	return (value, after)
+
+def operand(shifter):
+	'Returns a faster equivalent of a shifter operand, or shifter'
+	arg = getattr(shifter, "arg", None)
+	if not shifter.rm.isregister and (arg is None or not arg.isregister):
+		# nothing here but the C flag can change what it does
+		try:
+			(value, clear) = evaluate(shifter, 0)
+			(other, kept) = evaluate(shifter, 1)
+		except (TypeError, ValueError):
+			return shifter
+		if value != other:
+			return shifter
+		if (clear, kept) == (0, 1):
+			return Constant(shifter, value)
+		if clear == kept:
+			return Constant(shifter, value, clear)
+		return shifter
+	if not shifter.rm.isregister:
+		return shifter
+	if type(shifter) is instruction.Shifter:
+		return Register(shifter)
+	if type(shifter) in shifted and not arg.isregister and 0 < arg.value < 32:
+		return shifted[type(shifter)](shifter)
+	return shifter
+
+def address(mode):
+	'Returns a faster equivalent of an address mode, or mode'
+	shifter = getattr(mode, "shifter_operand", None)
+	if not isinstance(shifter, instruction.Shifter):
+		return mode
+	folded = operand(shifter)
+	if folded is shifter:
+		return mode
+	if type(mode) is instruction.AddrmodeImmoffset and isinstance(folded, Constant):
+		return ConstantOffset(mode, folded)
+	mode = copy.copy(mode)
+	mode.shifter_operand = folded
+	return mode
+
+def simplify(instr):
+	"""
+	Returns instr, or a copy of it with operands which execute
+	faster but do just the same.
+	"""
+	changes = {}
+	shifter = getattr(instr, "shifter_operand", None)
+	if isinstance(shifter, instruction.Shifter):
+		folded = operand(shifter)
+		if folded is not shifter:
+			changes["shifter_operand"] = folded
+	mode = getattr(instr, "addr_mode", None)
+	if isinstance(mode, instruction.Addrmode):
+		folded = address(mode)
+		if folded is not mode:
+			changes["addr_mode"] = folded
+	if not changes:
+		return instr
+	instr = copy.copy(instr)
+	for (name, value) in changes.items():
+		setattr(instr, name, value)
+	return instr
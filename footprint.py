@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+##########################################################################
+# This file is part of d00ks.
+# 
+# d00ks is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# d00ks is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with d00ks.  If not, see <http://www.gnu.org/licenses/>.
+##########################################################################
+
+
+"""
+This file measures how much memory the instructions of a Program
+take, so the cost of very large (usually generated) programs can
+be seen as bytes per instruction.
+
+The object graph under Program.code is walked and every object
+in it is counted once however many instructions share it, so
+interned operands like instruction.R0 are only paid for once.
+Numbers, strings, functions and classes are not counted, as
+they are shared with the rest of the interpreter or the symbol
+table; what is left is the instructions, their operands and any
+lists or per-instance dicts they hold.
+
+	footprint.Footprint(program.code).report()
+"""
+
+import sys
+import instruction
+
+# the kinds of object that belong to an instruction
+OWNED = (instruction.Instruction, instruction.Argument, instruction.Target,
+	instruction.Addrmode, instruction.Shifter, list, tuple, dict)
+
+def slots(obj):
+	'Returns the values of the slots of obj which are set'
+	values = []
+	for cls in type(obj).__mro__:
+		for name in cls.__dict__.get("__slots__", ()):
+			try:
+				values.append(getattr(obj, name))
+			except AttributeError:
+				pass
+	return values
+
+class Footprint(object):
+	"""
+	sizes[kind] is the number of bytes taken by the objects of
+	type kind, and counts[kind] the number of them, over all of
+	the instructions.
+	"""
+	def __init__(self, code):
+		self.instructions = len(code)
+		self.sizes = {}
+		self.counts = {}
+		seen = set()
+		stack = list(code)
+		while stack:
+			obj = stack.pop()
+			if id(obj) in seen or not isinstance(obj, OWNED):
+				continue
+			seen.add(id(obj))
+			kind = type(obj)
+			size = sys.getsizeof(obj)
+			if isinstance(obj, dict):
+				stack.extend(obj.itervalues())
+			elif isinstance(obj, (list, tuple)):
+				stack.extend(obj)
+			else:
+				stack.extend(slots(obj))
+				attrs = getattr(obj, "__dict__", None)
+				if attrs is not None:
+					# the instance dict is only ever reached from here
+					seen.add(id(attrs))
+					size += sys.getsizeof(attrs)
+					stack.extend(attrs.itervalues())
+			self.sizes[kind] = self.sizes.get(kind, 0) + size
+			self.counts[kind] = self.counts.get(kind, 0) + 1
+
+	def total(self):
+		return sum(self.sizes.itervalues())
+
+	def per_instruction(self):
+		'Returns the average bytes per instruction'
+		if not self.instructions:
+			return 0.0
+		return self.total() / float(self.instructions)
+
+	def report(self, out=sys.stdout):
+		out.write("%10s %10s  %s\n"%("objects", "bytes", "type"))
+		for (size, kind) in sorted(((size, kind) for (kind, size) in self.sizes.iteritems()), reverse=True):
+			out.write("%10i %10i  %s\n"%(self.counts[kind], size, kind.__name__))
+		out.write("%i instructions, %i bytes, %.1f bytes per instruction\n"%
+			(self.instructions, self.total(), self.per_instruction()))
+
+def _assemble(path, binary):
+	import simulator
+	import image
+	import fastlexer
+	import preprocess
+	from parser import parser
+	program = simulator.Program()
+	if binary:
+		program.load(image.Image.load(path))
+	else:
+		f = open(path)
+		try:
+			data = f.read()
+		finally:
+			f.close()
+		data = preprocess.preprocess(data, path, cache=preprocess.default_cache())
+		program.compile(parser.parse(data, lexer=fastlexer.lexer))
+	return program
+
+def main(argv):
+	binary = "-b" in argv
+	paths = [arg for arg in argv if arg != "-b"]
+	if len(paths) != 1:
+		print "usage: footprint.py [-b] file"
+		return 2
+	Footprint(_assemble(paths[0], binary).code).report()
+	return 0
+
+if __name__ == "__main__":
+	sys.exit(main(sys.argv[1:]))
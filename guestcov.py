@@ -0,0 +1,303 @@
+#!/usr/bin/env python
+##########################################################################
+# This file is part of d00ks.
+# 
+# d00ks is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# d00ks is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with d00ks.  If not, see <http://www.gnu.org/licenses/>.
+##########################################################################
+
+
+"""
+This file records which instructions of a Program have run, for
+seeing how much of a program a test suite exercises.
+
+A Coverage holds three maps over Program.code, kept as bytearrays
+with a 1 at index n for PC n, so setting one costs the same however
+big the program is: whether each instruction was reached, and for
+conditional instructions whether their condition passed and
+whether it failed. Recording is folded into the decoded
+instructions: each one is wrapped in a function that sets its
+bits and then has the instruction decoded again without the
+wrapper once there is nothing left to learn from it. So every
+instruction pays once (twice for conditionals), and a coverage
+run soon goes as fast as a plain one.
+
+Coverage files are a small header followed by the bitmaps, packed
+and zlib compressed. Files from runs of the same program can be
+merged, which is just an OR of the maps:
+
+	coverage = guestcov.Coverage.record(program)
+	program.run()
+	coverage.save("run.cov")
+
+	$ ./guestcov.py -o all.cov -s prog.s run*.cov
+"""
+
+import sys
+import zlib
+import string
+import struct
+import hashlib
+import cond
+
+MAGIC = "D00V"
+VERSION = 1
+# magic, version, number of instructions, sha1 of the program
+HEADER = struct.Struct("<4sHI20s")
+
+class CoverageError(Exception):
+	pass
+
+def fingerprint(code):
+	'Returns a digest of the text of the instructions in code'
+	return hashlib.sha1("\n".join(str(instr) for instr in code)).digest()
+
+_DIGITS = string.maketrans("\0\1", "01")
+_FLAGS = string.maketrans("01", "\0\1")
+
+def _bits(flags):
+	'Returns a bytearray of 0s and 1s as a long, with bit n set for a 1 at n'
+	return int(str(flags).translate(_DIGITS)[::-1] or "0", 2)
+
+def _flags(bits, n):
+	'Returns the first n bits of a long as a bytearray of 0s and 1s'
+	return bytearray(bin(bits)[2:][::-1].ljust(n, "0")[:n].translate(_FLAGS))
+
+def _pack(flags):
+	'Returns a bytearray of 0s and 1s as a little-endian bitmap'
+	size = (len(flags) + 7) // 8
+	if not size:
+		return ""
+	return ("%0*x"%(2*size, _bits(flags))).decode("hex")[::-1]
+
+def _unpack(data, n):
+	return _flags(int(data[::-1].encode("hex") or "0", 16), n)
+
+class Coverage(object):
+	"""
+	The coverage of a program of n instructions: hit[pc] is 1 if
+	the instruction at pc was reached, and for conditional
+	instructions passed[pc] or failed[pc] is 1 if it was reached
+	with its condition passing or failing.
+	"""
+	def __init__(self, n, digest=""):
+		self.n = n
+		self.digest = digest
+		self.hit = bytearray(n)
+		self.passed = bytearray(n)
+		self.failed = bytearray(n)
+		self.program = None
+
+	@classmethod
+	def record(cls, program):
+		'Returns a new Coverage recording as program runs'
+		coverage = cls(len(program.code), fingerprint(program.code))
+		coverage.program = program
+		program.instrument(coverage.instrument)
+		return coverage
+
+	def detach(self):
+		'Stops recording'
+		self.program.uninstrument(self.instrument)
+
+	def instrument(self, pc, instr, execute):
+		undecode = self.program.undecode
+		(hit, passed, failed) = (self.hit, self.passed, self.failed)
+		test = getattr(instr, "cond", cond.AL)
+		if test is cond.AL:
+			if hit[pc]:
+				return execute
+			def covered(registers):
+				hit[pc] = 1
+				undecode(pc)
+				execute(registers)
+			return covered
+		if passed[pc] and failed[pc]:
+			return execute
+		def covered(registers):
+			hit[pc] = 1
+			if test(registers):
+				passed[pc] = 1
+			else:
+				failed[pc] = 1
+			if passed[pc] and failed[pc]:
+				undecode(pc)
+			execute(registers)
+		return covered
+
+	def merge(self, other):
+		'Adds the coverage of other, from another run of the same program'
+		if other.n != self.n or other.digest != self.digest:
+			raise CoverageError("Coverage is of a different program")
+		for name in ("hit", "passed", "failed"):
+			# kept in place, as the instrumented instructions refer to them
+			getattr(self, name)[:] = _flags(_bits(getattr(self, name)) |
+				_bits(getattr(other, name)), self.n)
+
+	def dumps(self):
+		'Returns the coverage as a string'
+		body = "".join(_pack(flags) for flags in (self.hit, self.passed, self.failed))
+		return HEADER.pack(MAGIC, VERSION, self.n, self.digest) + zlib.compress(body)
+
+	@classmethod
+	def loads(cls, data):
+		'Returns the Coverage in a string from dumps()'
+		try:
+			(magic, version, n, digest) = HEADER.unpack_from(data)
+			body = zlib.decompress(data[HEADER.size:])
+		except (struct.error, zlib.error):
+			raise CoverageError("Not a coverage file")
+		if magic != MAGIC or version != VERSION:
+			raise CoverageError("Not a coverage file, or of another version")
+		size = (n + 7) // 8
+		if len(body) != 3*size:
+			raise CoverageError("Coverage file is truncated")
+		coverage = cls(n, digest)
+		coverage.hit = _unpack(body[:size], n)
+		coverage.passed = _unpack(body[size:2*size], n)
+		coverage.failed = _unpack(body[2*size:], n)
+		return coverage
+
+	def save(self, path):
+		f = open(path, "wb")
+		try:
+			f.write(self.dumps())
+		finally:
+			f.close()
+
+	@classmethod
+	def load(cls, path):
+		f = open(path, "rb")
+		try:
+			return cls.loads(f.read())
+		finally:
+			f.close()
+
+	def covered(self, pc):
+		return bool(self.hit[pc])
+
+	def branches(self, code):
+		"""
+		Returns the number of conditional instructions in code that
+		went both ways, one way, and that were never reached.
+		"""
+		both = one = never = 0
+		for (pc, instr) in enumerate(code):
+			if getattr(instr, "cond", cond.AL) is cond.AL:
+				continue
+			if not self.covered(pc):
+				never += 1
+			elif self.passed[pc] and self.failed[pc]:
+				both += 1
+			else:
+				one += 1
+		return (both, one, never)
+
+	def labels(self, program):
+		"""
+		Returns (covered, instructions, label) for each label,
+		counting every instruction up to the next label.
+		"""
+		symbols = program.symbols.ranges(end=self.n)
+		if not symbols or symbols[0][1] > 0:
+			first = symbols[0][1] if symbols else self.n
+			symbols = [("{program}", 0, first)] + symbols
+		ans = []
+		for (name, start, end) in symbols:
+			hit = sum(1 for pc in xrange(start, end) if self.covered(pc))
+			ans.append((hit, end - start, name))
+		return ans
+
+	def lines(self, program):
+		"""
+		Returns a dict mapping each source line with instructions
+		on it to (covered, instructions).
+		"""
+		ans = {}
+		for (pc, line) in enumerate(program.lines.code):
+			if not line:
+				continue
+			(hit, total) = ans.get(line, (0, 0))
+			ans[line] = (hit + self.covered(pc), total + 1)
+		return ans
+
+	def report(self, program=None, out=sys.stdout):
+		'Prints the coverage, by label and line if program is given'
+		hit = self.hit.count("\1")
+		out.write("%i of %i instructions covered (%.2f%%)\n"%(hit, self.n,
+			100.0*hit/(self.n or 1)))
+		if program is None:
+			return
+		if self.digest != fingerprint(program.code):
+			raise CoverageError("Coverage is of a different program")
+		out.write("Conditional instructions: %i both ways, %i one way, %i never reached\n"%
+			self.branches(program.code))
+		out.write("\nBy label:\n")
+		out.write("%10s %10s %7s  %s\n"%("covered", "of", "%", "label"))
+		for (covered, total, name) in self.labels(program):
+			out.write("%10i %10i %7.2f  %s\n"%(covered, total,
+				100.0*covered/(total or 1), name))
+		missed = [(line, covered, total) for (line, (covered, total))
+			in sorted(self.lines(program).iteritems()) if covered < total]
+		if missed:
+			out.write("\nLines not fully covered:\n")
+			for (line, covered, total) in missed:
+				out.write("%10i  %i of %i instructions\n"%(line, covered, total))
+
+def _assemble(path, binary):
+	import simulator
+	import image
+	import fastlexer
+	import preprocess
+	from parser import parser
+	program = simulator.Program()
+	if binary:
+		program.load(image.Image.load(path))
+	else:
+		f = open(path)
+		try:
+			data = f.read()
+		finally:
+			f.close()
+		data = preprocess.preprocess(data, path, cache=preprocess.default_cache())
+		program.compile(parser.parse(data, lexer=fastlexer.lexer))
+	return program
+
+def main(argv):
+	output = program = None
+	paths = []
+	args = iter(argv)
+	for arg in args:
+		if arg == "-o":
+			output = next(args)
+		elif arg in ("-s", "-b"):
+			program = _assemble(next(args), arg == "-b")
+		else:
+			paths.append(arg)
+	if not paths:
+		print "usage: guestcov.py [-o merged.cov] [-s file.s | -b file.img] file.cov ..."
+		return 2
+	try:
+		coverage = Coverage.load(paths[0])
+		for path in paths[1:]:
+			coverage.merge(Coverage.load(path))
+		if output is not None:
+			coverage.save(output)
+		coverage.report(program)
+	except (IOError, CoverageError), e:
+		print e
+		return 1
+	return 0
+
+if __name__ == "__main__":
+	sys.exit(main(sys.argv[1:]))
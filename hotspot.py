@@ -0,0 +1,228 @@
+##########################################################################
+# This file is part of d00ks.
+# 
+# d00ks is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# d00ks is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with d00ks.  If not, see <http://www.gnu.org/licenses/>.
+##########################################################################
+
+
+"""
+This file counts how often each instruction of a Program runs,
+and reports where the time went.
+
+A Profile is added to a program as an instrumenter, so the count
+is kept by the decoded instructions themselves rather than by the
+step loop. Only the first instruction of each basic block is
+wrapped, in a function that bumps the block's entry in an array
+indexed by PC; every other instruction in the block ran as often
+as the block was entered, less the rest of the block the program
+has stopped in, if any. Conditional instructions are wrapped
+too, to count how often their condition passed. So leaving it on
+costs one array increment per block, plus one per conditional.
+
+Blocks start at labels, branch targets and after any instruction
+which can write the PC, so they are only entered at the top,
+unless a program jumps through a register to somewhere that is
+neither a label nor a return address.
+
+	profile = hotspot.Profile(program)
+	program.run()
+	profile.report()
+"""
+
+import sys
+import bisect
+from array import array
+import cond
+import instruction
+
+def writes_pc(instr):
+	'Returns whether instr can change the flow of control'
+	if isinstance(instr, instruction.B):
+		return True
+	if isinstance(instr, instruction.LDM):
+		return 15 in [r.value for r in instr.regs]
+	rd = getattr(instr, "rd", None)
+	if rd is None:
+		return False
+	return instruction.register_number(rd) == 15
+
+def branch_target(instr):
+	'Returns the PC a B to a constant address goes to, or None'
+	if not isinstance(instr, instruction.B) or isinstance(instr, instruction.BX):
+		return None
+	target = instr.target
+	if isinstance(target, instruction.Target) and not target.islabel:
+		return target.value
+	return None
+
+def blocks(code):
+	"""
+	Returns the basic blocks of code, as a list of (first pc,
+	end pc).
+	"""
+	starts = set([0])
+	for (pc, instr) in enumerate(code):
+		if getattr(instr, "label", ""):
+			starts.add(pc)
+		if writes_pc(instr):
+			starts.add(pc + 1)
+		target = branch_target(instr)
+		if target is not None:
+			starts.add(target)
+	starts = sorted(pc for pc in starts if 0 <= pc < len(code))
+	return zip(starts, starts[1:] + [len(code)])
+
+def unfinished(program, blocks):
+	"""
+	Returns (start, pc, end) if the program stopped at pc, partway
+	through the block from start to end, so the instructions from
+	pc to end were counted when the block was entered but haven't
+	run yet. Otherwise returns None. blocks is the sorted list of
+	(first pc, end pc) from blocks().
+	"""
+	registers = program.registers
+	pc = registers[registers.PC]
+	i = bisect.bisect_right(blocks, (pc, sys.maxint)) - 1
+	if i < 0:
+		return None
+	(start, end) = blocks[i]
+	if not start < pc < end:
+		return None
+	return (start, pc, end)
+
+class Profile(object):
+	"""
+	Execution counts for a program: entries[pc] is how many times
+	the block starting at pc was entered, and for conditional
+	instructions taken[pc] is how many times their condition
+	passed. counts() gives the count for every instruction.
+	"""
+	def __init__(self, program):
+		self.program = program
+		self.reset()
+		program.instrument(self.instrument)
+
+	def reset(self):
+		'Sets all the counts back to zero'
+		code = self.program.code
+		n = len(code)
+		self.entries = array('L', [0]) * n
+		self.taken = array('L', [0]) * n
+		self.leaders = array('B', [0]) * n
+		for (start, end) in self.blocks():
+			self.leaders[start] = 1
+
+	def detach(self):
+		'Stops counting'
+		self.program.uninstrument(self.instrument)
+
+	def instrument(self, pc, instr, execute):
+		test = getattr(instr, "cond", cond.AL)
+		if test is not cond.AL:
+			taken = self.taken
+			inner = execute
+			def execute(registers):
+				if test(registers):
+					taken[pc] += 1
+				inner(registers)
+		if pc < len(self.leaders) and self.leaders[pc]:
+			entries = self.entries
+			body = execute
+			def execute(registers):
+				entries[pc] += 1
+				body(registers)
+		return execute
+
+	def counts(self):
+		'Returns an array of the number of times each instruction ran'
+		ans = array('L', self.entries)
+		count = 0
+		for pc in xrange(len(ans)):
+			if self.leaders[pc]:
+				count = ans[pc]
+			else:
+				ans[pc] = count
+		# the rest of a block the program stopped in hasn't run
+		stopped = unfinished(self.program, self.blocks())
+		if stopped is not None and ans[stopped[0]]:
+			for pc in xrange(stopped[1], stopped[2]):
+				ans[pc] -= 1
+		return ans
+
+	def blocks(self):
+		return blocks(self.program.code)
+
+	def total(self):
+		return sum(self.counts())
+
+	def conditional(self, pc):
+		return getattr(self.program.code[pc], "cond", cond.AL) is not cond.AL
+
+	def hottest(self, n=10, counts=None):
+		'Returns the n (count, pc) pairs with the highest counts'
+		if counts is None:
+			counts = self.counts()
+		ans = [(counts[pc], pc) for pc in xrange(len(counts)) if counts[pc]]
+		ans.sort(key=lambda (count, pc): (-count, pc))
+		return ans[:n]
+
+	def functions(self, counts=None):
+		"""
+		Returns (instructions, label) for each label, counting every
+		instruction up to the next label, hottest first.
+		"""
+		if counts is None:
+			counts = self.counts()
+		symbols = self.program.symbols.ranges(end=len(counts))
+		ans = []
+		if not symbols or symbols[0][1] > 0:
+			first = symbols[0][1] if symbols else len(counts)
+			ans.append((sum(counts[:first]), "{program}"))
+		for (name, start, end) in symbols:
+			ans.append((sum(counts[start:end]), name))
+		ans.sort(key=lambda (count, name): -count)
+		return ans
+
+	def report(self, n=10, out=sys.stdout):
+		'Prints the n hottest instructions, blocks and labels'
+		counts = self.counts()
+		total = sum(counts)
+		where = self.program.symbols.describe
+		out.write("%i instructions executed\n\n"%total)
+		total = total or 1
+		out.write("Hottest instructions:\n")
+		out.write("%10s %6s %10s %10s  %s\n"%("count", "%", "taken", "not taken", "instruction"))
+		for (count, pc) in self.hottest(n, counts):
+			if self.conditional(pc):
+				branch = "%10i %10i"%(self.taken[pc], count - self.taken[pc])
+			else:
+				branch = "%10s %10s"%("", "")
+			out.write("%10i %6.2f %s  %s %s\n"%(count, 100.0*count/total,
+				branch, where(pc), self.program.disassemble(pc)))
+		blocks = []
+		for (start, end) in self.blocks():
+			executed = sum(counts[start:end])
+			if executed:
+				blocks.append((executed, start, end))
+		blocks.sort(key=lambda (executed, start, end): (-executed, start))
+		out.write("\nHottest blocks:\n")
+		out.write("%10s %6s %10s  %s\n"%("count", "%", "entries", "block"))
+		for (executed, start, end) in blocks[:n]:
+			out.write("%10i %6.2f %10i  %s (%i instructions)\n"%(executed,
+				100.0*executed/total, counts[start], where(start), end - start))
+		out.write("\nHottest labels:\n")
+		out.write("%10s %6s  %s\n"%("count", "%", "label"))
+		for (count, name) in self.functions(counts)[:n]:
+			if count:
+				out.write("%10i %6.2f  %s\n"%(count, 100.0*count/total, name))
@@ -0,0 +1,118 @@
+##########################################################################
+# This file is part of d00ks.
+# 
+# d00ks is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# d00ks is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with d00ks.  If not, see <http://www.gnu.org/licenses/>.
+##########################################################################
+
+
+"""
+This file stops a program when it is spinning in a loop it can
+never leave, such as the "stop B stop" most programs end with.
+
+A loop is a backward branch together with the instructions from
+its target up to it. If none of them can write memory or the PC,
+one pass round the loop only depends on the registers, so if the
+registers are the same each time the branch is taken, the program
+will go round forever. The IdleDetector wraps the branches of such
+loops when they are decoded, and raises Idle once the registers
+have repeated threshold times. Loops which write memory, call
+anything or branch out are never wrapped, and cost nothing.
+
+	idle.IdleDetector(program)
+	program.run()
+"""
+
+import simulator
+import instruction
+import symindex
+import hotspot
+
+# instructions which write memory
+STORES = (instruction.STR, instruction.STRB, instruction.STRH,
+	instruction.STM, instruction.SWP, instruction.SWPB)
+
+class Idle(simulator.Breakpoint):
+	"""
+	Raised with the PC of the branch which closes an idle loop,
+	and the number of times it went round with nothing changing.
+	"""
+	def __init__(self, pc, iterations):
+		super(Idle, self).__init__("Idle: the loop at 0x%X can never finish"%pc)
+		self.reason = "idle"
+		self.pc = pc
+		self.iterations = iterations
+
+def target(program, instr):
+	'Returns the PC a B (not BL or BX) goes to, if it is fixed, or None'
+	if not isinstance(instr, instruction.B) or isinstance(instr, instruction.BX):
+		return None
+	if instr.link or not isinstance(instr.target, instruction.Target):
+		return None
+	if not instr.target.islabel:
+		return instr.target.value
+	name = instr.target.value
+	if name in program.symbols and program.symbols.kind(name) == symindex.CODE_SYMBOL:
+		return program.symbols.address(name)
+	return None
+
+def idle_loop(program, pc, instr):
+	"""
+	Returns the first PC of the loop closed by the instruction at
+	pc if it is a backward branch over instructions which can't
+	write memory or the PC, or None.
+	"""
+	start = target(program, instr)
+	if start is None or not 0 <= start <= pc:
+		return None
+	for body in xrange(start, pc):
+		instr = program.code[body]
+		if isinstance(instr, STORES) or hotspot.writes_pc(instr):
+			return None
+	return start
+
+class IdleDetector(object):
+	"""
+	Raises Idle from a program once the registers are the same
+	threshold times in a row as an idle loop goes round.
+	"""
+	def __init__(self, program, threshold=1):
+		self.program = program
+		self.threshold = threshold
+		program.instrument(self.instrument)
+
+	def detach(self):
+		self.program.uninstrument(self.instrument)
+
+	def instrument(self, pc, instr, execute):
+		if idle_loop(self.program, pc, instr) is None:
+			return execute
+		threshold = self.threshold
+		state = [None, 0]
+		def watched(registers):
+			execute(registers)
+			if registers[registers.PC] == pc + 1:
+				# left the loop
+				state[0] = None
+				return
+			regs = tuple(registers.regs)
+			if regs != state[0]:
+				state[0] = regs
+				state[1] = 0
+				return
+			state[1] += 1
+			if state[1] >= threshold:
+				state[0] = None
+				registers[registers.PC] = pc
+				raise Idle(pc, state[1])
+		return watched
@@ -0,0 +1,169 @@
+##########################################################################
+# This file is part of d00ks.
+# 
+# d00ks is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# d00ks is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with d00ks.  If not, see <http://www.gnu.org/licenses/>.
+##########################################################################
+
+"""
+This file contains the flat binary image format for assembled
+programs.
+
+An image is laid out as:
+	header
+	code: ARM words, little-endian, followed by the literal pool
+	data: the initial contents of the DATA areas
+	symbols: (value, kind, name) for each entry of the symbol table
+
+Code addresses (branch targets, code symbols, the entry point)
+are word offsets from the start of the code, just like the PC of
+the simulator.
+"""
+
+import struct
+import instruction
+
+MAGIC = "D00K"
+VERSION = 1
+
+# magic, version, flags, entry, text words, pool words, data address,
+# data size, symbol count
+HEADER = struct.Struct("<4sHHIIIIII")
+
+# value, kind, name length
+SYMBOL = struct.Struct("<IBB")
+
+CODE_SYMBOL = 0
+DATA_SYMBOL = 1
+
+class ImageError(Exception):
+	pass
+
+class Encoder(object):
+	"""
+	Passed to Instruction.encode(). It knows the address of the
+	instruction currently being encoded, resolves symbols, and
+	collects the literal pool for LDR Rd, =<target>, which is
+	placed straight after the last instruction.
+	"""
+	def __init__(self, symbols, ntext):
+		self.symbols = symbols
+		self.ntext = ntext
+		self.pc = 0
+		self.pool = []
+		self.pool_index = {}
+
+	def symbol(self, name):
+		try:
+			return self.symbols[name]
+		except KeyError:
+			raise instruction.EncodingError("Undefined symbol %s"%name)
+
+	def literal(self, value):
+		'Returns the address of a pool entry holding value'
+		value = value & 0xFFFFFFFF
+		if value not in self.pool_index:
+			self.pool_index[value] = self.ntext + len(self.pool)
+			self.pool.append(value)
+		return self.pool_index[value]
+
+class Image(object):
+	"""
+	An assembled program: a list of code words (ntext instructions
+	then the literal pool), the contents of the data areas loaded
+	at database, and the symbol table as a dict of
+	name: (value, kind).
+	"""
+	def __init__(self, words, ntext, database, data, symbols, entry=0):
+		self.words = words
+		self.ntext = ntext
+		self.database = database
+		self.data = data
+		self.symbols = symbols
+		self.entry = entry
+
+	def tostring(self):
+		'Returns the image as a string of bytes'
+		parts = [HEADER.pack(MAGIC, VERSION, 0, self.entry, self.ntext,
+			len(self.words) - self.ntext, self.database, len(self.data), len(self.symbols))]
+		parts.append(struct.pack("<%iI"%len(self.words), *self.words))
+		parts.append(self.data)
+		for name in sorted(self.symbols):
+			(value, kind) = self.symbols[name]
+			parts.append(SYMBOL.pack(value, kind, len(name)))
+			parts.append(name)
+		return "".join(parts)
+
+	@classmethod
+	def fromstring(cls, s):
+		'Reads an image from a string of bytes'
+		if len(s) < HEADER.size:
+			raise ImageError("Image is truncated")
+		(magic, version, flags, entry, ntext, npool, database, datasize, nsyms) = \
+			HEADER.unpack_from(s, 0)
+		if magic != MAGIC:
+			raise ImageError("Not a d00ks image")
+		if version != VERSION:
+			raise ImageError("Unsupported image version %i"%version)
+		offset = HEADER.size
+		nwords = ntext + npool
+		words = list(struct.unpack_from("<%iI"%nwords, s, offset))
+		offset += 4*nwords
+		data = s[offset:offset + datasize]
+		offset += datasize
+		symbols = {}
+		for i in xrange(nsyms):
+			(value, kind, length) = SYMBOL.unpack_from(s, offset)
+			offset += SYMBOL.size
+			symbols[s[offset:offset + length]] = (value, kind)
+			offset += length
+		return cls(words, ntext, database, data, symbols, entry)
+
+	def save(self, path):
+		f = open(path, "wb")
+		try:
+			f.write(self.tostring())
+		finally:
+			f.close()
+
+	@classmethod
+	def load(cls, path):
+		f = open(path, "rb")
+		try:
+			return cls.fromstring(f.read())
+		finally:
+			f.close()
+
+def assemble(program):
+	"""
+	Encodes a compiled simulator.Program, returning an Image.
+	"""
+	symbols = program.registers.symbol_table
+	encoder = Encoder(symbols, len(program.code))
+	words = []
+	for (pc, instr) in enumerate(program.code):
+		encoder.pc = pc
+		try:
+			words.append(instr.encode(encoder) & 0xFFFFFFFF)
+		except instruction.EncodingError, e:
+			raise instruction.EncodingError("0x%X %s: %s"%(pc, str(instr), e))
+	words.extend(encoder.pool)
+
+	mem = program.memory
+	start = mem.realaddr(mem.startaddr)
+	data = mem.buffer.raw[start:start + program.data_end - mem.startaddr]
+	table = {}
+	for (name, value) in symbols.iteritems():
+		kind = DATA_SYMBOL if value >= mem.startaddr else CODE_SYMBOL
+		table[name] = (value, kind)
+	return Image(words, len(program.code), mem.startaddr, data, table)
@@ -24,6 +24,31 @@ an instruction needs to execute.
 from ctypes import c_uint
 import simulator
 import promise
+import cond
+
+class EncodingError(Exception):
+	"""Raised when an instruction has no ARM machine code form."""
+	pass
+
+def encode_immediate(value):
+	"""
+	Finds the 12 bit rotate/immed_8 field representing a 32 bit
+	constant, i.e. an 8 bit value rotated right by an even amount.
+	"""
+	value = value & 0xFFFFFFFF
+	for rot in range(0, 16):
+		imm = ((value << (2*rot)) | (value >> (32 - 2*rot))) & 0xFFFFFFFF
+		if imm < 0x100:
+			return (rot << 8) | imm
+	raise EncodingError("Constant 0x%X cannot be encoded as an immediate"%value)
+
+def register_number(arg):
+	'Returns the register number of an argument (or a plain register number)'
+	if isinstance(arg, Argument):
+		if not arg.isregister:
+			raise EncodingError("Expected a register, not %s"%str(arg))
+		return arg.value
+	return arg
 
 class Argument(object):
 	"""
@@ -40,6 +65,7 @@ class Argument(object):
 	as the instruction doesn't care which type it is,
 	only the value.
 	"""
+	__slots__ = ("isregister", "value")
 	def __init__(self, isregister, value):
 		self.isregister = isregister
 		self.value = value
@@ -49,11 +75,6 @@ class Argument(object):
 	def get(self, registers):
 		return registers[self.value] if self.isregister else self.value
 	
-	@promise.sensible()
-	@promise.pure()
-	def value(self):
-		return self.value
-	
 	@promise.sensible()
 	@promise.pure()	
 	def __str__(self):
@@ -87,16 +108,25 @@ R13 = Argument(True, 13)
 R14 = Argument(True, 14)
 R15 = Argument(True, 15)
 
+# Arguments are never changed once made, so every mention of a
+# register, or of a small number, shares one object
+REGISTERS = (R0, R1, R2, R3, R4, R5, R6, R7, R8, R9, R10, R11, R12, R13, R14, R15)
+NUMBERS = tuple(Argument(False, i) for i in xrange(256))
+
 @promise.sensible()
 @promise.pure()
 def reg(i):
 	'Helper function for creating arguments'
+	if 0 <= i < len(REGISTERS):
+		return REGISTERS[i]
 	return Argument(True, i)
 
 @promise.sensible()
 @promise.pure()
 def num(i):
 	'Helper function for creating arguments'
+	if type(i) in (int, long) and 0 <= i < len(NUMBERS):
+		return NUMBERS[i]
 	return Argument(False, i)
 	
 class Target(object):
@@ -108,6 +138,7 @@ class Target(object):
 	The registers provide access to the symbol table, for
 	convinience.
 	"""
+	__slots__ = ("islabel", "value")
 	def __init__(self, islabel, value):
 		self.islabel = islabel
 		self.value = value
@@ -121,12 +152,27 @@ class Target(object):
 	@promise.pure()
 	def __str__(self):
 		return "=%s"%(self.value if self.islabel else "0x%X"%self.value)
+	
+	def encode(self, ctx):
+		"""
+		LDR Rd, =<target> is a pseudo-instruction: the value is placed
+		in the literal pool and loaded relative to the PC. This encodes
+		the P, U, W, Rn and offset fields for that load.
+		"""
+		value = ctx.symbol(self.value) if self.islabel else self.value
+		# the PC reads two instructions ahead
+		offset = (ctx.literal(value) - (ctx.pc + 2)) * 4
+		if abs(offset) > 0xFFF:
+			raise EncodingError("Literal pool is out of range of %s"%str(self))
+		u = 0 if offset < 0 else 1
+		return (1 << 24) | (u << 23) | (15 << 16) | abs(offset)
 
 class BranchTarget(Target):
 	"""
 	The branch (B) instruction uses targets but the syntax doesn't
 	use the = sign. This is just for pretty printing.
 	"""
+	__slots__ = ()
 	def __str__(self):
 		return "%s"%(self.value if self.islabel else "0x%X"%self.value)
 
@@ -144,6 +190,7 @@ def immediate(i):
 
 class Addrmode(object):
 	'''Just a register'''
+	__slots__ = ("rn",)
 	def __init__(self, rn):
 		self.rn = rn
 	def __repr__(self):
@@ -155,9 +202,44 @@ class Addrmode(object):
 		return registers[self.rn]
 	def __str__(self):
 		return "[R%i]"%self.rn
+	
+	def encode(self, halfword=False):
+		"""
+		Encodes the P, U, W, Rn and offset fields of a load/store.
+		Halfword and signed transfers use a different offset format.
+		"""
+		return self.encode_indexed(halfword, 1, 0, Shifter(num(0)))
+	
+	def encode_indexed(self, halfword, p, w, shifter_operand):
+		'Encodes the fields for an offset of shifter_operand'
+		if not shifter_operand.rm.isregister:
+			offset = shifter_operand.get(None)
+			u = 0 if offset < 0 else 1
+			offset = abs(offset)
+			if halfword:
+				if offset > 0xFF:
+					raise EncodingError("Offset %i out of range for halfword transfer"%offset)
+				bits = (1 << 22) | ((offset & 0xF0) << 4) | (offset & 0xF)
+			else:
+				if offset > 0xFFF:
+					raise EncodingError("Offset %i out of range for load/store"%offset)
+				bits = offset
+		elif halfword:
+			if type(shifter_operand) != Shifter:
+				raise EncodingError("Halfword transfers cannot use a shifted register offset")
+			u = 1
+			bits = shifter_operand.rm.value
+		else:
+			(i, bits) = shifter_operand.encode()
+			if bits & 0x10:
+				raise EncodingError("Load/store offsets cannot be shifted by a register")
+			u = 1
+			bits = (1 << 25) | bits
+		return (p << 24) | (u << 23) | (w << 21) | (self.rn << 16) | bits
 
 class AddrmodeImmoffset(Addrmode):
 	'''Immediate offset'''
+	__slots__ = ("shifter_operand",)
 	def __init__(self, rn, shifter_operand):
 		self.rn = rn
 		self.shifter_operand = shifter_operand
@@ -168,9 +250,13 @@ class AddrmodeImmoffset(Addrmode):
 		return registers[self.rn] + self.shifter_operand.get(registers)
 	def __str__(self):
 		return "[R%i, %s]"%(self.rn, self.shifter_operand)
+	
+	def encode(self, halfword=False):
+		return self.encode_indexed(halfword, 1, 0, self.shifter_operand)
 
 class AddrmodePreindexed(Addrmode):
 	'''Pre-indexed register'''
+	__slots__ = ("shifter_operand",)
 	def __init__(self, rn, shifter_operand):
 		self.rn = rn
 		self.shifter_operand = shifter_operand
@@ -183,8 +269,12 @@ class AddrmodePreindexed(Addrmode):
 	def __str__(self):
 		return "[R%i, %s]!"%(self.rn, self.shifter_operand)
 	
+	def encode(self, halfword=False):
+		return self.encode_indexed(halfword, 1, 1, self.shifter_operand)
+	
 class AddrmodePostindexed(Addrmode):
 	'''Post-indexed register'''
+	__slots__ = ("shifter_operand",)
 	def __init__(self, rn, shifter_operand):
 		self.rn = rn
 		self.shifter_operand = shifter_operand
@@ -197,6 +287,9 @@ class AddrmodePostindexed(Addrmode):
 		return val
 	def __str__(self):
 		return "[R%i], %s"%(self.rn, str(self.shifter_operand))
+	
+	def encode(self, halfword=False):
+		return self.encode_indexed(halfword, 0, 0, self.shifter_operand)
 		
 
 class Shifter(object):
@@ -213,6 +306,7 @@ class Shifter(object):
 	values easy. This basic class just has a value or a
 	register, kept in an argument object.
 	"""
+	__slots__ = ("rm",)
 	def __init__(self, rm):
 		super(Shifter, self).__init__()
 		self.rm = rm
@@ -222,10 +316,74 @@ class Shifter(object):
 	def get(self, registers, flags=False):
 		return self.rm.get(registers)
 	
+	@promise.sensible()
+	def shift(self, registers):
+		"""
+		Returns (value, carry), where carry is the shifter carry
+		out, or None if the C flag is left as it is.
+		"""
+		return (self.rm.get(registers), None)
+	
 	def __str__(self):
 		return str(self.rm)
+	
+	def encode(self):
+		"""
+		Returns (I, bits) where I is the immediate bit of a data
+		processing instruction and bits is its 12 bit shifter_operand
+		field.
+		"""
+		if self.rm.isregister:
+			return (0, self.rm.value)
+		return (1, encode_immediate(self.rm.value))
+	
+	def encode_shift(self, kind):
+		'Encodes rm shifted by arg, where kind is the 2 bit shift type'
+		if not self.rm.isregister:
+			# shifting a constant by a constant is just a constant
+			if self.arg.isregister:
+				raise EncodingError("Cannot shift a constant by a register")
+			return (1, encode_immediate(self.get(None)))
+		if self.arg.isregister:
+			return (0, (self.arg.value << 8) | (kind << 5) | 0x10 | self.rm.value)
+		amount = self.arg.value
+		if amount == 32 and kind in (1, 2):
+			# LSR #32 and ASR #32 are encoded as a shift of 0
+			amount = 0
+		elif amount not in range(0, 32) or (amount == 0 and kind == 3):
+			raise EncodingError("Cannot encode shift amount %i"%amount)
+		return (0, (amount << 7) | (kind << 5) | self.rm.value)
+
+class ShiftedOperand(Shifter):
+	"""
+	A value or register shifted by an amount, which is either an
+	immediate or the bottom byte of a register. Subclasses give
+	shift_by(value, amount, registers), which works out the value
+	and carry out in constant time, from the rules in the ARM ARM.
+	"""
+	__slots__ = ("arg",)
+	def __init__(self, rm, arg):
+		self.rm = rm
+		self.arg = arg
+	
+	def __str__(self):
+		return "%s, %s %s"%(str(self.rm), self.__class__.__name__, str(self.arg))
+	
+	@promise.sensible()
+	def get(self, registers, flags=False):
+		(value, carry) = self.shift(registers)
+		if flags and carry is not None:
+			registers.flag_set(registers.C, carry)
+		return value
+	
+	@promise.sensible()
+	def shift(self, registers):
+		amount = self.arg.get(registers)
+		if self.arg.isregister:
+			amount &= 0xFF
+		return self.shift_by(self.rm.get(registers), amount, registers)
 
-class ASR(Shifter):
+class ASR(ShiftedOperand):
 	"""
 	rm, ASR <val>
 	
@@ -234,142 +392,103 @@ class ASR(Shifter):
 	
 	This allows for signed division by 2.
 	"""
-	def __init__(self, rm, arg):
-		self.rm = rm
-		self.arg = arg
-
-	def __str__(self):
-		return "%s, ASR %s"%(str(self.rm), str(self.arg))
+	__slots__ = ()
+	def encode(self):
+		return self.encode_shift(2)
 
 	@promise.sensible()
-	def get(self, registers, flags=False):
-		"""Applies an LSR of amount value to the register"""
-		val = min(self.arg.get(registers), 32)
-		# is the MSB 1?
-		if self.rm.get(registers) & (1 << 31):
-			# make a mask of 1s to extend the bits with
-			fill = 0xFFFFFFFF << (32 - val)
-			# shorten to 32 bits
-			fill = fill & 0xFFFFFFFF
-		else:
-			fill = 0x0
-		tmp = self.rm.get(registers) >> val
-		# extend MSBs
-		tmp = tmp | fill
-		retval = tmp & 0xFFFFFFFF
-		if flags:
-			registers.flag_set(registers.C, (self.rm.get(registers) >> (val-1)) & 1)
-		return retval
-
-class LSL(Shifter):
+	def shift_by(self, value, amount, registers):
+		if amount == 0:
+			return (value, None)
+		if amount >= 32:
+			if value & (1 << 31):
+				return (0xFFFFFFFF, 1)
+			return (0, 0)
+		carry = (value >> (amount - 1)) & 1
+		if value & (1 << 31):
+			# fill the top with copies of the sign bit
+			return ((value >> amount) | ((0xFFFFFFFF << (32 - amount)) & 0xFFFFFFFF), carry)
+		return (value >> amount, carry)
+
+class LSL(ShiftedOperand):
 	"""
 	rm, LSL <val>
 	
 	Logical shift left. Shifts contents left by <val>.
 	"""
-	def __init__(self, rm, arg):
-		self.rm = rm
-		self.arg = arg
-	
-	def __str__(self):
-		return "%s, LSL %s"%(str(self.rm), str(self.arg))
+	__slots__ = ()
+	def encode(self):
+		return self.encode_shift(0)
 	
 	@promise.sensible()
-	def get(self, registers, flags=False):
-		"""Applies an LSL of amount value to the register"""
-		val = min(self.arg.get(registers), 32)
-		tmp = self.rm.get(registers) << val
-		retval = tmp & 0xFFFFFFFF
-		if flags:
-			registers.flag_set(registers.C, tmp & (1 << 32))
-		return retval
+	def shift_by(self, value, amount, registers):
+		if amount == 0:
+			return (value, None)
+		if amount > 32:
+			return (0, 0)
+		return ((value << amount) & 0xFFFFFFFF, (value >> (32 - amount)) & 1)
 
-class LSR(Shifter):
+class LSR(ShiftedOperand):
 	"""
 	rm, LSR <val>
 	
 	Logical shift right.
 	"""
-	def __init__(self, rm, arg):
-		self.rm = rm
-		self.arg = arg
-
-	def __str__(self):
-		return "%s, LSR %s"%(str(self.rm), str(self.arg))
+	__slots__ = ()
+	def encode(self):
+		return self.encode_shift(1)
 
 	@promise.sensible()
-	def get(self, registers, flags=False):
-		"""Applies an LSR of amount value to the register"""
-		val = min(self.arg.get(registers), 32)
-		tmp = self.rm.get(registers) >> val
-		retval = tmp & 0xFFFFFFFF
-		if flags:
-			registers.flag_set(registers.C, (self.rm.get(registers) >> (val-1)) & 1)
-		return retval
+	def shift_by(self, value, amount, registers):
+		if amount == 0:
+			return (value, None)
+		if amount > 32:
+			return (0, 0)
+		return (value >> amount, (value >> (amount - 1)) & 1)
 
-class ROR(Shifter):
+class ROR(ShiftedOperand):
 	"""
 	rm, ROR <val>
 	
 	Rotate bits right. Anything that comes off the right,
 	goes back in on the left.
 	"""
-	def __init__(self, rm, arg):
-		self.rm = rm
-		self.arg = arg
-
-	def __str__(self):
-		return "%s, ROR %s"%(str(self.rm), str(self.arg))
+	__slots__ = ()
+	def encode(self):
+		return self.encode_shift(3)
 
 	@promise.sensible()
-	def get(self, registers, flags=False):
-		"""Applies an ROR of amount value to the register"""
-		val = min(self.arg.get(registers), 32)
-		# select the bits that will be shifted out
-		fill = 0xFFFFFFFF >> (32 - val)
-		fill = fill & self.rm.get(registers)
-		# shift them to the new position
-		fill = fill << (32 - val)
-		# do the rotate
-		tmp = self.rm.get(registers) >> val
-		retval = tmp & 0xFFFFFFFF
-		# merge in the bits that were wrapped
-		retval = retval | fill
-		if flags:
-			registers.flag_set(registers.C, (self.rm.get(registers) >> (val-1)) & 1)
-		return retval
-
-class RRX(Shifter):
+	def shift_by(self, value, amount, registers):
+		if amount == 0:
+			return (value, None)
+		amount &= 31
+		if amount:
+			value = ((value >> amount) | (value << (32 - amount))) & 0xFFFFFFFF
+		# the carry is the last bit rotated round, now at the top
+		return (value, value >> 31)
+
+class RRX(ShiftedOperand):
 	"""
-	rm, ROR <val>
+	rm, RRX <val>
 	
 	33-bit rotate right, using the C flag as the 33rd bit.
 	"""
-	def __init__(self, rm, arg):
-		self.rm = rm
-		self.arg = arg
-
-	def __str__(self):
-		return "%s, RRX %s"%(str(self.rm), str(self.arg))
+	__slots__ = ()
+	def encode(self):
+		# RRX is encoded as ROR #0, and only rotates by one bit
+		if not self.rm.isregister or self.arg.isregister or self.arg.value != 1:
+			raise EncodingError("RRX can only rotate a register by 1")
+		return (0, (3 << 5) | self.rm.value)
 
 	@promise.sensible()
-	def get(self, registers, flags=False):
-		"""Applies an RRX of amount value to the register"""
-		# i cant think of any better way to do this than 1 shift at a time
-		val = min(self.arg.get(registers))
-		tmp = self.rm.get(registers)
-		for i in range(0, val):
-			# get carry bit in right position
-			c = (1 << 31) if registers.flag_get(registers.C) else 0
-			# get the next value of the carry bit
-			new_c = tmp & 1
-			# perform shift
-			tmp = tmp >> 1
-			# merge carry bit
-			tmp = tmp | c
-			# save new carry bit
-			registers.flag_set(registers.C, new_c)
-		return tmp
+	def shift_by(self, value, amount, registers):
+		amount %= 33
+		if amount == 0:
+			return (value, None)
+		# rotate the 33 bit value C:rm in one go
+		wide = (registers.flag_get(registers.C) << 32) | value
+		wide = ((wide >> amount) | (wide << (33 - amount))) & 0x1FFFFFFFF
+		return (wide & 0xFFFFFFFF, wide >> 32)
 		
 
 class Instruction(object):
@@ -382,9 +501,12 @@ class Instruction(object):
 	
 	The class also contains some helper functions for determining
 	carry and overflow and signedness.
+	
+	Instructions use __slots__ to keep large programs small, and
+	so does every subclass. label and line are only there when
+	the instruction has a label or a source line.
 	"""
-	label = ""
-	line = 0
+	__slots__ = ("cond", "s", "rd", "rn", "shifter_operand", "label", "line")
 	
 	def __init__(self, cond, s, rd, rn,  shifter_operand):
 		super(Instruction, self).__init__()
@@ -452,8 +574,63 @@ class Instruction(object):
 	def execute(self, registers):
 		pass
 	
+	def encode(self, ctx):
+		"""
+		Encodes the instruction as a 32 bit ARM word. ctx is an
+		image.Encoder, which knows the address of the instruction
+		and gives access to the symbol table and literal pool.
+		"""
+		raise EncodingError("%s has no machine code form"%self.__class__.__name__)
+	
+	def encode_cond(self):
+		'Encodes the condition field'
+		return cond.codes[self.cond] << 28
+	
+	def encode_dataproc(self, opcode, s, rd, rn):
+		'Encodes a data processing instruction'
+		(i, operand) = self.shifter_operand.encode()
+		return self.encode_cond() | (i << 25) | (opcode << 21) | ((1 if s else 0) << 20) |\
+			(register_number(rn) << 16) | (rd << 12) | operand
+	
+	def encode_multiply(self, opcode, rd, rn, rm, rs):
+		'Encodes a multiply, where rd/rn are RdHi/RdLo for long multiplies'
+		return self.encode_cond() | (opcode << 21) | ((1 if self.s else 0) << 20) |\
+			(rd << 16) | (rn << 12) | (register_number(rs) << 8) | 0x90 | register_number(rm)
+	
+	def encode_transfer(self, ctx, load, byte):
+		'Encodes a word or unsigned byte load/store'
+		if type(self.addr_mode) == Target:
+			bits = self.addr_mode.encode(ctx)
+		else:
+			bits = self.addr_mode.encode()
+		return self.encode_cond() | 0x04000000 | (byte << 22) | (load << 20) | (self.rd << 12) | bits
+	
+	def encode_halfword(self, load, sh):
+		'Encodes a halfword or signed load/store, where sh is the S and H bits'
+		return self.encode_cond() | (load << 20) | (self.rd << 12) | (sh << 5) | 0x90 |\
+			self.addr_mode.encode(True)
+	
+	def encode_multiple(self, load):
+		'Encodes a load/store multiple'
+		if load:
+			(p, u) = ldm_modes[self.addrmode]
+		else:
+			(p, u) = stm_modes[self.addrmode]
+		mask = 0
+		for regis in self.regs:
+			mask |= 1 << regis.value
+		return self.encode_cond() | 0x08000000 | (p << 24) | (u << 23) |\
+			((1 if self.bang else 0) << 21) | (load << 20) | (self.rn << 16) | mask
+	
 	def __repr__(self):
 		return str(self)
+
+# P and U bits for each LDM/STM addressing mode. The stack
+# modes mean different things for loads and stores.
+ldm_modes = {False: (0, 1), 'IA': (0, 1), 'IB': (1, 1), 'DA': (0, 0), 'DB': (1, 0),
+	'FD': (0, 1), 'FA': (0, 0), 'ED': (1, 1), 'EA': (1, 0)}
+stm_modes = {False: (0, 1), 'IA': (0, 1), 'IB': (1, 1), 'DA': (0, 0), 'DB': (1, 0),
+	'FD': (1, 0), 'FA': (1, 1), 'ED': (0, 0), 'EA': (0, 1)}
 		
 class ADC(Instruction):
 	"""
@@ -462,6 +639,7 @@ class ADC(Instruction):
 	Add with carry. Adds two values and accumulates it with
 	the current value of the carry bit.
 	"""
+	__slots__ = ()
 	@promise.sensible()
 	def execute(self, registers):
 		if self.cond(registers):
@@ -477,13 +655,17 @@ class ADC(Instruction):
 	def __str__(self):
 		return "ADC%s%s R%i, %s, %s"%\
 			(self.cond.__name__, "S" if self.s else "", self.rd, str(self.rn), str(self.shifter_operand))
-				
+
+	def encode(self, ctx):
+		return self.encode_dataproc(0x5, self.s, self.rd, self.rn)
+
 class ADD(Instruction):
 	"""
 	ADD{cond}{S} <Rd>, <Rn>, <shifter_operand>
 	
 	Adds two values.
 	"""
+	__slots__ = ()
 	@promise.sensible()
 	def execute(self, registers):
 		if self.cond(registers):
@@ -498,7 +680,9 @@ class ADD(Instruction):
 	def __str__(self):
 		return "ADD%s%s R%i, %s, %s"%\
 			(self.cond.__name__, "S" if self.s else "", self.rd, str(self.rn), str(self.shifter_operand))
-		
+
+	def encode(self, ctx):
+		return self.encode_dataproc(0x4, self.s, self.rd, self.rn)
 
 class AND(Instruction):
 	"""
@@ -506,6 +690,7 @@ class AND(Instruction):
 	
 	Calculates binary AND of two values.
 	"""
+	__slots__ = ()
 	@promise.sensible()
 	def execute(self, registers):
 		if self.cond(registers):
@@ -521,12 +706,16 @@ class AND(Instruction):
 		return "AND%s%s R%i, %s, %s"%\
 			(self.cond.__name__, "S" if self.s else "", self.rd, str(self.rn), str(self.shifter_operand))
 
+	def encode(self, ctx):
+		return self.encode_dataproc(0x0, self.s, self.rd, self.rn)
+
 class B(Instruction):
 	"""
 	B{L}{cond} <target_address>
 	
 	Branch to target.
 	"""
+	__slots__ = ("link", "target")
 	def __init__(self, link, cond, target):
 		self.link = link
 		self.cond = cond
@@ -543,12 +732,26 @@ class B(Instruction):
 		return "B%s%s %s"%\
 			("L" if self.link else "", self.cond.__name__, str(self.target))
 	
+	def encode(self, ctx):
+		if isinstance(self.target, Target):
+			dest = ctx.symbol(self.target.value) if self.target.islabel else self.target.value
+		elif not self.target.isregister:
+			dest = self.target.value
+		else:
+			raise EncodingError("Branches to a register must use BX")
+		# offsets are in words, from two instructions ahead
+		offset = dest - (ctx.pc + 2)
+		if offset < -(1 << 23) or offset >= (1 << 23):
+			raise EncodingError("Branch target out of range")
+		return self.encode_cond() | 0x0A000000 | ((1 if self.link else 0) << 24) | (offset & 0xFFFFFF)
+	
 class BIC(Instruction):
 	"""
 	BIC{cond}{S} <Rd>, <Rn>, <shifter_operand>
 	
 	Clear the bits specified by shifter_operand in Rn.
 	"""
+	__slots__ = ()
 	@promise.sensible()
 	def execute(self, registers):
 		if self.cond(registers):
@@ -565,15 +768,28 @@ class BIC(Instruction):
 		return "BIC%s%s R%i, %s, %s"%\
 			(self.cond.__name__, "S" if self.s else "", self.rd, str(self.rn), str(self.shifter_operand))
 
+	def encode(self, ctx):
+		return self.encode_dataproc(0xE, self.s, self.rd, self.rn)
+
 class BKPT(Instruction):
+	__slots__ = ()
 	def __init__(self):
 		pass
 	@promise.sensible()
 	def execute(self, registers):
 		raise simulator.Breakpoint()
+	
+	def __str__(self):
+		return "BKPT"
+	
+	def encode(self, ctx):
+		return 0xE1200070
 
 class BX(B):
-	pass
+	__slots__ = ()
+	def encode(self, ctx):
+		return self.encode_cond() | 0x012FFF10 | ((1 if self.link else 0) << 5) |\
+			register_number(self.target)
 
 class CMN(Instruction):
 	"""
@@ -581,6 +797,7 @@ class CMN(Instruction):
 	
 	Compare negative.
 	"""
+	__slots__ = ()
 	def __init__(self, cond, rn, shifter_operand):
 		super(Instruction, self).__init__()
 		self.cond = cond
@@ -601,12 +818,16 @@ class CMN(Instruction):
 		return "CMN%s %s, %s"%\
 			(self.cond.__name__, str(self.rn), str(self.shifter_operand))
 
+	def encode(self, ctx):
+		return self.encode_dataproc(0xB, True, 0, self.rn)
+
 class CMP(Instruction):
 	"""
 	CMP{cond} <Rn>, <shifter_operand>
 	
 	Compare.
 	"""
+	__slots__ = ()
 	def __init__(self, cond, rn, shifter_operand):
 		super(Instruction, self).__init__()
 		self.cond = cond
@@ -626,13 +847,17 @@ class CMP(Instruction):
 	def __str__(self):
 		return "CMP%s %s, %s"%\
 			(self.cond.__name__, str(self.rn), str(self.shifter_operand))
-	
+
+	def encode(self, ctx):
+		return self.encode_dataproc(0xA, True, 0, self.rn)
+
 class EOR(Instruction):
 	"""
 	EOR{cond}{S} <Rd>, <Rn>, <shifter_operand>
 	
 	Exclusive-OR
 	"""
+	__slots__ = ()
 	@promise.sensible()
 	def execute(self, registers):
 		if self.cond(registers):
@@ -648,8 +873,11 @@ class EOR(Instruction):
 		return "EOR%s%s R%i, %s, %s"%\
 			(self.cond.__name__, "S" if self.s else "", self.rd, str(self.rn), str(self.shifter_operand))
 
+	def encode(self, ctx):
+		return self.encode_dataproc(0x1, self.s, self.rd, self.rn)
+
 class LDM(Instruction):
-	pass
+	__slots__ = ()
 
 class LDR(Instruction):
 	"""
@@ -657,6 +885,7 @@ class LDR(Instruction):
 	
 	Load-register
 	"""
+	__slots__ = ("addr_mode",)
 	def __init__(self, cond, rd, addr_mode):
 		self.cond = cond
 		self.rd = rd
@@ -682,6 +911,7 @@ class LDRB(Instruction):
 	
 	Load-register
 	"""
+	__slots__ = ("addr_mode",)
 	def __init__(self, cond, rd, addr_mode):
 		self.cond = cond
 		self.rd = rd
@@ -706,6 +936,7 @@ class LDRH(Instruction):
 	
 	Load-register
 	"""
+	__slots__ = ("addr_mode",)
 	def __init__(self, cond, rd, addr_mode):
 		self.cond = cond
 		self.rd = rd
@@ -730,6 +961,7 @@ class LDSB(Instruction):
 	
 	Load-register
 	"""
+	__slots__ = ("addr_mode",)
 	def __init__(self, cond, rd, addr_mode):
 		self.cond = cond
 		self.rd = rd
@@ -750,12 +982,16 @@ class LDSB(Instruction):
 		return "LDR%sSB R%i, %s"%\
 			(self.cond.__name__, self.rd, str(self.addr_mode))
 
+	def encode(self, ctx):
+		return self.encode_halfword(1, 2)
+
 class LDSH(Instruction):
 	"""
 	LDR{<cond>}SB <Rd>, <addressing_mode>
 	
 	Load-register
 	"""
+	__slots__ = ("addr_mode",)
 	def __init__(self, cond, rd, addr_mode):
 		self.cond = cond
 		self.rd = rd
@@ -776,12 +1012,16 @@ class LDSH(Instruction):
 		return "LDR%sSH R%i, %s"%\
 			(self.cond.__name__, self.rd, str(self.addr_mode))
 
+	def encode(self, ctx):
+		return self.encode_halfword(1, 3)
+
 class MLA(Instruction):
 	"""
 	MLA{cond}{S} <Rd>, <Rm>, <Rs>, <Rn>
 	
 	Multiply and accumulate.
 	"""
+	__slots__ = ("rm", "rs")
 	def __init__(self, cond, s, rd, rm, rs, rn):
 		self.cond = cond
 		self.s = s
@@ -803,12 +1043,16 @@ class MLA(Instruction):
 		return "MLA%s%s R%i, %s, %s, %s"%\
 			(self.cond.__name__, "S" if self.s else "", self.rd, str(self.rm), str(self.rs), str(self.rn))
 
+	def encode(self, ctx):
+		return self.encode_multiply(1, self.rd, register_number(self.rn), self.rm, self.rs)
+
 class MOV(Instruction):
 	"""
 	MOV{cond}{S} <Rd>, <shifter_operand>
 	
 	Move.
 	"""
+	__slots__ = ()
 	def __init__(self, cond, s, rd, shifter_operand):
 		self.cond = cond
 		self.s = s
@@ -828,11 +1072,14 @@ class MOV(Instruction):
 		return "MOV%s%s R%i, %s"%\
 			(self.cond.__name__, "S" if self.s else "", self.rd, str(self.shifter_operand))
 
+	def encode(self, ctx):
+		return self.encode_dataproc(0xD, self.s, self.rd, 0)
+
 class MRS(Instruction):
-	pass
+	__slots__ = ()
 
 class MSR(Instruction):
-	pass
+	__slots__ = ()
 
 class MUL(Instruction):
 	"""
@@ -840,6 +1087,7 @@ class MUL(Instruction):
 	
 	Multiply.
 	"""
+	__slots__ = ("rm", "rs")
 	def __init__(self, cond, s, rd, rm, rs):
 		self.cond = cond
 		self.s = s
@@ -853,18 +1101,22 @@ class MUL(Instruction):
 			registers[self.rd] = self.rm.get(registers) * self.rs.get(registers)
 			if self.s:
 				registers.flag_set(registers.N, registers[self.rd] & (1 << 31))
-				registers.flag_set(registers.N, registers[self.rd] == 0)
+				registers.flag_set(registers.Z, registers[self.rd] == 0)
 
 	def __str__(self):
-		return "EOR%s%s R%i, %s, %s"%\
+		return "MUL%s%s R%i, %s, %s"%\
 			(self.cond.__name__, "S" if self.s else "", self.rd, str(self.rm), str(self.rs))
 
+	def encode(self, ctx):
+		return self.encode_multiply(0, self.rd, 0, self.rm, self.rs)
+
 class MVN(Instruction):
 	"""
 	MVN{cond}{S} <Rd>, <shifter_operand>
 	
 	Move negative.
 	"""
+	__slots__ = ()
 	def __init__(self, cond, s, rd, shifter_operand):
 		self.cond = cond
 		self.s = s
@@ -884,12 +1136,16 @@ class MVN(Instruction):
 		return "MVN%s%s R%i, %s"%\
 			(self.cond.__name__, "S" if self.s else "", self.rd, str(self.shifter_operand))
 
+	def encode(self, ctx):
+		return self.encode_dataproc(0xF, self.s, self.rd, 0)
+
 class ORR(Instruction):
 	"""
 	ORR{cond}{S} <Rd>, <Rn>, <shifter_operand>
 	
 	Binary-OR.
 	"""
+	__slots__ = ()
 	@promise.sensible()
 	def execute(self, registers):
 		if self.cond(registers):
@@ -905,12 +1161,16 @@ class ORR(Instruction):
 		return "ORR%s%s R%i, %s, %s"%\
 			(self.cond.__name__, "S" if self.s else "", self.rd, str(self.rn), str(self.shifter_operand))
 
+	def encode(self, ctx):
+		return self.encode_dataproc(0xC, self.s, self.rd, self.rn)
+
 class RSB(Instruction):
 	"""
 	RSB{cond}{S} <Rd>, <Rn>, <shifter_operand>
 	
 	Reverse subtract.
 	"""
+	__slots__ = ()
 	@promise.sensible()
 	def execute(self, registers):
 		if self.cond(registers):
@@ -927,12 +1187,16 @@ class RSB(Instruction):
 		return "RSB%s%s R%i, %s, %s"%\
 			(self.cond.__name__, "S" if self.s else "", self.rd, str(self.rn), str(self.shifter_operand))
 
+	def encode(self, ctx):
+		return self.encode_dataproc(0x3, self.s, self.rd, self.rn)
+
 class RSC(Instruction):
 	"""
 	RSC{cond}{S} <Rd>, <Rn>, <shifter_operand>
 	
 	Reverse subtract with carry.
 	"""
+	__slots__ = ()
 	@promise.sensible()
 	def execute(self, registers):
 		if self.cond(registers):
@@ -949,12 +1213,16 @@ class RSC(Instruction):
 		return "RSC%s%s R%i, %s, %s"%\
 			(self.cond.__name__, "S" if self.s else "", self.rd, str(self.rn), str(self.shifter_operand))
 
+	def encode(self, ctx):
+		return self.encode_dataproc(0x7, self.s, self.rd, self.rn)
+
 class SBC(Instruction):
 	"""
 	SBC{cond}{S} <Rd>, <Rn>, <shifter_operand>
 	
 	Subtract with carry.
 	"""
+	__slots__ = ()
 	@promise.sensible()
 	def execute(self, registers):
 		if self.cond(registers):
@@ -971,12 +1239,23 @@ class SBC(Instruction):
 		return "SBC%s%s R%i, %s, %s"%\
 			(self.cond.__name__, "S" if self.s else "", self.rd, str(self.rn), str(self.shifter_operand))
 
-class SMLAL(Instruction):
+	def encode(self, ctx):
+		return self.encode_dataproc(0x6, self.s, self.rd, self.rn)
+
+class LongMultiply(Instruction):
 	"""
-	SMLAL{cond}{S} <RdLo>, <RdHi>, <Rm>, <Rs>
+	<op>{cond}{S} <RdLo>, <RdHi>, <Rm>, <Rs>
 	
-	Signed multiply long with accumulate.
+	The long multiplies. Each one works out the 64-bit product
+	once and writes it back as a pair of registers; subclasses
+	say whether the operands are signed and whether RdHi:RdLo is
+	added to the product.
 	"""
+	__slots__ = ("rdlo", "rdhi", "rm", "rs")
+	signed = False
+	accumulate = False
+	opcode = 0
+	
 	def __init__(self, cond, s, rdlo, rdhi, rm, rs):
 		self.cond = cond
 		self.s = s
@@ -988,44 +1267,50 @@ class SMLAL(Instruction):
 	@promise.sensible()
 	def execute(self, registers):
 		if self.cond(registers):
-			registers[self.rdlo] = ((self.rm.get(registers) * self.rs.get(registers)) & 0xFFFFFFFF)\
-				+ registers[self.rdlo]
-			registers[self.rdhi] = (((self.rm.get(registers) * self.rs.get(registers)) >> 31) & 0xFFFFFFFF)\
-				+ registers[self.rdhi] + self.carry_from(self.rm.get(registers) * self.rs.get(registers))
+			rm = self.rm.get(registers)
+			rs = self.rs.get(registers)
+			if self.signed:
+				# two's complement, by taking the sign bit away twice
+				rm -= (rm & 0x80000000) << 1
+				rs -= (rs & 0x80000000) << 1
+			product = rm * rs
+			if self.accumulate:
+				product += (registers[self.rdhi] << 32) | registers[self.rdlo]
+			# the registers keep the bottom 32 bits of each half
+			registers[self.rdlo] = product
+			registers[self.rdhi] = product >> 32
 			if self.s:
 				registers.flag_set(registers.N, registers[self.rdhi] & (1 << 31))
 				registers.flag_set(registers.Z, registers[self.rdlo] == 0 and registers[self.rdhi] == 0)
 
 	def __str__(self):
-		return "SMLAL%s%s R%i, R%i, %s, %s"%\
-			(self.cond.__name__, "S" if self.s else "", self.rdlo, self.rdhi, str(self.rm), str(self.rs))
+		return "%s%s%s R%i, R%i, %s, %s"%\
+			(self.__class__.__name__, self.cond.__name__, "S" if self.s else "",
+			self.rdlo, self.rdhi, str(self.rm), str(self.rs))
+
+	def encode(self, ctx):
+		return self.encode_multiply(self.opcode, self.rdhi, self.rdlo, self.rm, self.rs)
 
-class SMULL(Instruction):
+class SMLAL(LongMultiply):
+	"""
+	SMLAL{cond}{S} <RdLo>, <RdHi>, <Rm>, <Rs>
+	
+	Signed multiply long with accumulate.
+	"""
+	__slots__ = ()
+	signed = True
+	accumulate = True
+	opcode = 7
+
+class SMULL(LongMultiply):
 	"""
 	SMULL{cond}{S} <RdLo>, <RdHi>, <Rm>, <Rs>
 	
 	Signed multiply long.
 	"""
-	def __init__(self, cond, s, rdlo, rdhi, rm, rs):
-		self.cond = cond
-		self.s = s
-		self.rdlo = rdlo
-		self.rdhi = rdhi
-		self.rm = rm
-		self.rs = rs
-
-	@promise.sensible()
-	def execute(self, registers):
-		if self.cond(registers):
-			registers[self.rdlo] = ((self.rm.get(registers) * self.rs.get(registers)) & 0xFFFFFFFF)
-			registers[self.rdhi] = (((self.rm.get(registers) * self.rs.get(registers)) >> 31) & 0xFFFFFFFF)
-			if self.s:
-				registers.flag_set(registers.N, registers[self.rdhi] & (1 << 31))
-				registers.flag_set(registers.Z, registers[self.rdlo] == 0 and registers[self.rdhi] == 0)
-
-	def __str__(self):
-		return "SMULL%s%s R%i, %s, %s"%\
-			(self.cond.__name__, "S" if self.s else "", self.rdlo, self.rdhi, str(self.rm), str(self.rs))
+	__slots__ = ()
+	signed = True
+	opcode = 6
 
 class LDM(Instruction):
 	"""
@@ -1033,6 +1318,7 @@ class LDM(Instruction):
 	
 	Load multiple registers
 	"""
+	__slots__ = ("addrmode", "bang", "regs")
 	def __init__(self, cond, addrmode, rn, bang, regs):
 		self.cond = cond
 		self.addrmode = addrmode
@@ -1077,6 +1363,8 @@ class LDM(Instruction):
 		regs = map(lambda x: str(x), self.regs)
 		return "LDM%s%s R%i%s, {%s}"%(self.cond.__name__, self.addrmode, self.rn, "!" if self.bang else "", ", ".join(regs))
 
+	def encode(self, ctx):
+		return self.encode_multiple(1)
 
 class LDR(Instruction):
 	"""
@@ -1084,6 +1372,7 @@ class LDR(Instruction):
 	
 	Load-register
 	"""
+	__slots__ = ("addr_mode",)
 	def __init__(self, cond, rd, addr_mode):
 		self.cond = cond
 		self.rd = rd
@@ -1103,13 +1392,16 @@ class LDR(Instruction):
 		return "LDR%s R%i, %s"%\
 			(self.cond.__name__, self.rd, str(self.addr_mode))
 
-	
+	def encode(self, ctx):
+		return self.encode_transfer(ctx, 1, 0)
+
 class LDRB(Instruction):
 	"""
 	LDR{<cond>}B <Rd>, <addressing_mode>
 	
 	Load-register
 	"""
+	__slots__ = ("addr_mode",)
 	def __init__(self, cond, rd, addr_mode):
 		self.cond = cond
 		self.rd = rd
@@ -1128,12 +1420,16 @@ class LDRB(Instruction):
 		return "LDR%sB R%i, %s"%\
 			(self.cond.__name__, self.rd, str(self.addr_mode))
 
+	def encode(self, ctx):
+		return self.encode_transfer(ctx, 1, 1)
+
 class LDRH(Instruction):
 	"""
 	LDR{<cond>}H <Rd>, <addressing_mode>
 	
 	Load-register
 	"""
+	__slots__ = ("addr_mode",)
 	def __init__(self, cond, rd, addr_mode):
 		self.cond = cond
 		self.rd = rd
@@ -1152,12 +1448,16 @@ class LDRH(Instruction):
 		return "LDR%sH R%i, %s"%\
 			(self.cond.__name__, self.rd, str(self.addr_mode))
 
+	def encode(self, ctx):
+		return self.encode_halfword(1, 1)
+
 class STM(Instruction):
 	"""
 	STM{<cond>}<addressing_mode> <Rn>{!}, <registers>
 	
 	Store multiple registers
 	"""
+	__slots__ = ("addrmode", "bang", "regs")
 	def __init__(self, cond, addrmode, rn, bang, regs):
 		self.cond = cond
 		self.addrmode = addrmode
@@ -1201,7 +1501,9 @@ class STM(Instruction):
 	def __str__(self):
 		regs = map(lambda x: str(x), self.regs)
 		return "STM%s%s R%i%s, {%s}"%(self.cond.__name__, self.addrmode, self.rn, "!" if self.bang else "", ", ".join(regs))
-			
+
+	def encode(self, ctx):
+		return self.encode_multiple(0)
 
 class STR(Instruction):
 	"""
@@ -1209,6 +1511,7 @@ class STR(Instruction):
 	
 	Store-register
 	"""
+	__slots__ = ("addr_mode",)
 	def __init__(self, cond, rd, addr_mode):
 		self.cond = cond
 		self.rd = rd
@@ -1224,12 +1527,16 @@ class STR(Instruction):
 		return "STR%s R%i, %s"%\
 			(self.cond.__name__, self.rd, str(self.addr_mode))
 
+	def encode(self, ctx):
+		return self.encode_transfer(ctx, 0, 0)
+
 class STRB(Instruction):
 	"""
 	STR{<cond>}B <Rd>, <addressing_mode>
 	
 	Store-register
 	"""
+	__slots__ = ("addr_mode",)
 	def __init__(self, cond, rd, addr_mode):
 		self.cond = cond
 		self.rd = rd
@@ -1245,12 +1552,16 @@ class STRB(Instruction):
 		return "STR%s R%i, %s"%\
 			(self.cond.__name__, self.rd, str(self.addr_mode))
 
+	def encode(self, ctx):
+		return self.encode_transfer(ctx, 0, 1)
+
 class STRH(Instruction):
 	"""
 	STR{<cond>}H <Rd>, <addressing_mode>
 	
 	Store-register
 	"""
+	__slots__ = ("addr_mode",)
 	def __init__(self, cond, rd, addr_mode):
 		self.cond = cond
 		self.rd = rd
@@ -1266,12 +1577,16 @@ class STRH(Instruction):
 		return "STR%s R%i, %s"%\
 			(self.cond.__name__, self.rd, str(self.addr_mode))
 
+	def encode(self, ctx):
+		return self.encode_halfword(0, 1)
+
 class SUB(Instruction):
 	"""
 	SUB{cond}{S} <Rd>, <Rn>, <shifter_operand>
 	
 	Subtract.
 	"""
+	__slots__ = ()
 	@promise.sensible()
 	def execute(self, registers):
 		if self.cond(registers):
@@ -1287,12 +1602,15 @@ class SUB(Instruction):
 	def __str__(self):
 		return "SUB%s%s R%i, %s, %s"%\
 			(self.cond.__name__, "S" if self.s else "", self.rd, str(self.rn), str(self.shifter_operand))
-				
+
+	def encode(self, ctx):
+		return self.encode_dataproc(0x2, self.s, self.rd, self.rn)
+
 class SWP(Instruction):
-	pass
+	__slots__ = ()
 
 class SWPB(Instruction):
-	pass
+	__slots__ = ()
 
 class TEQ(Instruction):
 	"""
@@ -1300,6 +1618,7 @@ class TEQ(Instruction):
 	
 	Compare using EOR.
 	"""
+	__slots__ = ()
 	def __init__(self, cond, rn, shifter_operand):
 		self.cond = cond
 		self.rn = rn
@@ -1317,12 +1636,16 @@ class TEQ(Instruction):
 		return "TEQ%s %s, %s"%\
 			(self.cond.__name__, str(self.rn), str(self.shifter_operand))
 
+	def encode(self, ctx):
+		return self.encode_dataproc(0x9, True, 0, self.rn)
+
 class TST(Instruction):
 	"""
 	TST{cond} <Rn>, <shifter_operand>
 	
 	Compare using AND.
 	"""
+	__slots__ = ()
 	def __init__(self, cond, rn, shifter_operand):
 		self.cond = cond
 		self.rn = rn
@@ -1340,60 +1663,24 @@ class TST(Instruction):
 		return "TST%s %s, %s"%\
 			(self.cond.__name__, str(self.rn), str(self.shifter_operand))
 
-class UMLAL(Instruction):
+	def encode(self, ctx):
+		return self.encode_dataproc(0x8, True, 0, self.rn)
+
+class UMLAL(LongMultiply):
 	"""
 	UMLAL{cond}{S} <RdLo>, <RdHi>, <Rm>, <Rs>
 	
 	Unsigned multiply long with accumulate.
 	"""
-	def __init__(self, cond, s, rdlo, rdhi, rm, rs):
-		self.cond = cond
-		self.s = s
-		self.rdlo = rdlo
-		self.rdhi = rdhi
-		self.rm = rm
-		self.rs = rs
-
-	@promise.sensible()
-	def execute(self, registers):
-		# FIXME: difference between this and UMLAL?
-		if self.cond(registers):
-			registers[self.rdlo] = ((self.rm.get(registers) * self.rs.get(registers)) & 0xFFFFFFFF)\
-				+ registers[self.rdlo]
-			registers[self.rdhi] = (((self.rm.get(registers) * self.rs.get(registers)) >> 31) & 0xFFFFFFFF)\
-				+ registers[self.rdhi] + self.carry_from(self.rm.get(registers) * self.rs.get(registers))
-			if self.s:
-				registers.flag_set(registers.N, registers[self.rdhi] & (1 << 31))
-				registers.flag_set(registers.Z, registers[self.rdlo] == 0 and registers[self.rdhi] == 0)
-				
-		def __str__(self):
-			return "UMLAL%s%s R%i, %s, %s"%\
-				(self.cond.__name__, "S" if self.s else "", self.rdlo, self.rdhi, str(self.rm), str(self.rs))
+	__slots__ = ()
+	accumulate = True
+	opcode = 5
 
-class UMULL(Instruction):
+class UMULL(LongMultiply):
 	"""
 	UMULL{cond}{S} <RdLo>, <RdHi>, <Rm>, <Rs>
 	
 	Unsigned multiply long.
 	"""
-	def __init__(self, cond, s, rdlo, rdhi, rm, rs):
-		self.cond = cond
-		self.s = s
-		self.rdlo = rdlo
-		self.rdhi = rdhi
-		self.rm = rm
-		self.rs = rs
-
-	@promise.sensible()
-	def execute(self, registers):
-		if self.cond(registers):
-			registers[self.rdlo] = ((self.rm.get(registers) * self.rs.get(registers)) & 0xFFFFFFFF)
-			registers[self.rdhi] = (((self.rm.get(registers) * self.rs.get(registers)) >> 31) & 0xFFFFFFFF)
-			if self.s:
-				registers.flag_set(registers.N, registers[self.rdhi] & (1 << 31))
-				registers.flag_set(registers.Z, registers[self.rdlo] == 0 and registers[self.rdhi] == 0)
-
-	def __str__(self):
-		return "UMULL%s%s R%i, %s, %s"%\
-			(self.cond.__name__, "S" if self.s else "", self.rdlo, self.rdhi, str(self.rm), str(self.rs))
-
+	__slots__ = ()
+	opcode = 4
@@ -17,6 +17,7 @@
 
 
 
+import re
 import ply.lex as lex
 import instruction
 import cond
@@ -240,7 +241,19 @@ def t_IMMTARGET(t):
 
 def t_COMMENT(t):
 	r'\;.*'
-	pass
+	line = line_marker(t.value)
+	if line is not None:
+		t.lexer.lineno = line - 1
+
+# a comment which preprocess.py puts before a line to give its number
+_marker = re.compile(r';#line (\d+)$')
+
+def line_marker(comment):
+	'Returns the line number the line after comment is on, if it says, or None'
+	m = _marker.match(comment)
+	if m is None:
+		return None
+	return int(m.group(1))
 	
 
 def t_newline(t):
@@ -0,0 +1,77 @@
+##########################################################################
+# This file is part of d00ks.
+# 
+# d00ks is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# d00ks is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with d00ks.  If not, see <http://www.gnu.org/licenses/>.
+##########################################################################
+
+
+"""
+This file contains the line table of a program, which maps each
+PC, and each data address, back to the line of source it came
+from.
+
+The parser records the line of every instruction and data
+directive, and Program.compile builds the table once from them,
+so tools don't have to parse the source again to find a line.
+Lines are kept in arrays: one entry per PC for the code, and the
+start, end and line of each data item, sorted by address, for the
+data. A line of 0 means the line isn't known, as for a loaded
+image.
+"""
+
+from array import array
+from bisect import bisect_right
+
+class LineTable(object):
+	"""
+	code[pc] is the line of the instruction at pc. starts[i],
+	ends[i] and lines[i] are the address range [start, end) of the
+	i'th data item and its line.
+	"""
+	def __init__(self, code=(), data=()):
+		self.code = array('L', code)
+		self.starts = array('L')
+		self.ends = array('L')
+		self.lines = array('L')
+		for (start, end, line) in sorted(data):
+			self.starts.append(start)
+			self.ends.append(end)
+			self.lines.append(line)
+
+	@classmethod
+	def unknown(cls, n):
+		'Returns a table for n instructions whose lines are not known'
+		return cls(array('L', [0]) * n)
+
+	def line(self, pc):
+		'Returns the line of the instruction at pc, or 0'
+		if 0 <= pc < len(self.code):
+			return self.code[pc]
+		return 0
+
+	def data_line(self, addr):
+		'Returns the line of the data item holding addr, or 0'
+		i = bisect_right(self.starts, addr) - 1
+		if i >= 0 and addr < self.ends[i]:
+			return self.lines[i]
+		return 0
+
+	def pcs(self, line):
+		'Returns the PCs of the instructions on line'
+		return [pc for (pc, at) in enumerate(self.code) if at == line]
+
+	def describe(self, pc):
+		'Returns "line n" for the instruction at pc, or ""'
+		line = self.line(pc)
+		return "line %i"%line if line else ""
@@ -18,16 +18,29 @@
 """
 This file contains classes for dealing with memory
 in the ARM simulator.
+
+Dumps, diffs and searches work on whole regions at once, as
+byte strings sliced straight out of the buffer, so they take
+milliseconds even for megabytes of memory. Diffs use NumPy
+if it is installed.
 """
 
 
 from ctypes import *
 import struct
+import binascii
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
 
 class MemoryError(Exception):
 	pass
 
 class Store(object):
+	line = 0
+	
 	def __repr__(self):
 		return str(self)
 
@@ -68,23 +81,301 @@ class SPACE(Store):
 	def store(self, mem, addr):
 		pass
 
+LOADS = (("ldrb", 1), ("ldrh", 2), ("ldrw", 4))
+STORES = (("strb", 1), ("strh", 2), ("strw", 4))
+
+# watchpoints are indexed by pages of 1 << WATCH_BITS bytes
+WATCH_BITS = 8
+
+# kinds of watchpoint, which can be or'ed together
+WATCH_READ = 1
+WATCH_WRITE = 2
+WATCH_CHANGE = 4
+
+_formats = {1: "<B", 2: "<H", 4: "<I"}
+
+# bytes on each line of a dump
+ROW = 32
+
+# each byte is two characters in a character dump: printable
+# ones followed by a space, anything else as a space and a dot
+_printable = [65 <= byte < 128 for byte in xrange(256)]
+_CHARS = "".join([chr(byte) if _printable[byte] else " " for byte in xrange(256)])
+_DOTS = "".join([" " if _printable[byte] else "." for byte in xrange(256)])
+
+def _interleave(*strings):
+	'Returns the characters of strings of the same length, taken from each in turn'
+	out = bytearray(len(strings[0])*len(strings))
+	for (i, string) in enumerate(strings):
+		out[i::len(strings)] = string
+	return str(out)
+
+def _pad(data):
+	'Returns data padded with zeros to a whole number of words'
+	return data + "\0"*(-len(data) % 4)
+
+def _layout(addr, text):
+	"""
+	Splits text, two characters for each byte from addr, into
+	lines of ROW bytes in groups of four, each line starting
+	with its address.
+	"""
+	spaced = _interleave(" "*(len(text)//8), *[text[i::8] for i in xrange(8)])
+	width = ROW//4*9
+	return ["0x%X:%s"%(addr + row*ROW, spaced[row*width:(row + 1)*width])
+		for row in xrange((len(spaced) + width - 1)//width)]
+
+def hexdump(data, addr=0):
+	"""
+	Returns lines showing the bytes of data, which start at addr,
+	as little-endian words in hex. A partial word at the end is
+	padded with zeros.
+	"""
+	data = _pad(data)
+	return _layout(addr, binascii.hexlify(
+		_interleave(data[3::4], data[2::4], data[1::4], data[0::4])).upper())
+
+def chardump(data, addr=0):
+	'Returns lines showing the bytes of data, which start at addr, as characters'
+	data = _pad(data)
+	return _layout(addr, _interleave(data.translate(_CHARS), data.translate(_DOTS)))
+
+def _changed(old, new):
+	'Returns the (start, end) offsets of each run of bytes which differ'
+	if numpy is not None:
+		changed = numpy.flatnonzero(numpy.frombuffer(old, numpy.uint8) !=
+			numpy.frombuffer(new, numpy.uint8))
+		if not len(changed):
+			return []
+		breaks = numpy.flatnonzero(numpy.diff(changed) != 1)
+		starts = numpy.concatenate((changed[:1], changed[breaks + 1]))
+		ends = numpy.concatenate((changed[breaks] + 1, changed[-1:] + 1))
+		return zip(starts.tolist(), ends.tolist())
+	runs = []
+	_compare(old, new, 0, len(old), 4096, runs)
+	return runs
+
+def _compare(old, new, start, end, block, runs):
+	"""
+	Adds the runs of bytes which differ between start and end to
+	runs, skipping equal blocks with one comparison each and only
+	looking inside the blocks that differ.
+	"""
+	for offset in xrange(start, end, block):
+		stop = min(offset + block, end)
+		if buffer(old, offset, stop - offset) == buffer(new, offset, stop - offset):
+			continue
+		if block > 64:
+			_compare(old, new, offset, stop, block//64, runs)
+			continue
+		for i in xrange(offset, stop):
+			if old[i] == new[i]:
+				continue
+			if runs and runs[-1][1] == i:
+				runs[-1] = (runs[-1][0], i + 1)
+			else:
+				runs.append((i, i + 1))
+
+def diff(old, new, addr=0):
+	"""
+	Compares two snapshots of the same memory, which start at
+	addr, returning (address, old bytes, new bytes) for each run
+	of bytes which changed.
+	"""
+	if len(old) != len(new):
+		raise ValueError("Can only compare snapshots of the same length")
+	return [(addr + start, old[start:end], new[start:end])
+		for (start, end) in _changed(old, new)]
+
+def find(data, pattern, addr=0):
+	'Yields the address of each match of pattern in data, which starts at addr'
+	offset = data.find(pattern)
+	while offset >= 0:
+		yield addr + offset
+		offset = data.find(pattern, offset + 1)
+
+class Watchpoint(object):
+	"""
+	Watches size bytes at addr for the kinds of access in kind.
+	When one happens, a hit (watchpoint, kind, addr, size, old
+	value, new value) is added to Memory.hits; the values are
+	those of the watched bytes, and the same for a read.
+	"""
+	def __init__(self, addr, size=4, kind=WATCH_WRITE):
+		if size not in _formats:
+			raise ValueError("Can only watch 1, 2 or 4 bytes")
+		self.addr = addr
+		self.size = size
+		self.kind = kind
+
+	def pages(self):
+		return xrange(self.addr >> WATCH_BITS, ((self.addr + self.size - 1) >> WATCH_BITS) + 1)
+
+	def overlaps(self, addr, size):
+		return addr < self.addr + self.size and self.addr < addr + size
+
+	def __str__(self):
+		kinds = [name for (bit, name) in ((WATCH_READ, "read"), (WATCH_WRITE, "write"),
+			(WATCH_CHANGE, "change")) if self.kind & bit]
+		return "%s of %i bytes at 0x%X"%("/".join(kinds), self.size, self.addr)
+
+def _hooked_load(method, size, hooks):
+	def load(addr):
+		value = method(addr)
+		for hook in hooks:
+			hook(addr, size, value)
+		return value
+	return load
+
+def _hooked_store(method, size, hooks):
+	mask = (1 << 8*size) - 1
+	def store(addr, value):
+		method(addr, value)
+		for hook in hooks:
+			hook(addr, size, value & mask)
+	return store
+
+def _watched_load(method, size, memory):
+	watched = memory.watched
+	def load(addr):
+		value = method(addr)
+		if addr >> WATCH_BITS in watched or (addr + size - 1) >> WATCH_BITS in watched:
+			memory.watch_access(WATCH_READ, addr, size, None)
+		return value
+	return load
+
+def _watched_store(method, size, memory):
+	watched = memory.watched
+	def store(addr, value):
+		if addr >> WATCH_BITS in watched or (addr + size - 1) >> WATCH_BITS in watched:
+			memory.watch_access(WATCH_WRITE | WATCH_CHANGE, addr, size, lambda: method(addr, value))
+		else:
+			method(addr, value)
+	return store
+
 class Memory(object):
 	"""
 	Represents the RAM of a program.
 	
 	Memory is stored using a byte buffer created
 	by the python ctypes module.
+	
+	Hooks in self.reads and self.writes are called as
+	hook(addr, size, value) after each load and store,
+	once rehook() has been called.
+	
+	Watchpoints are indexed by page in self.watched, and only
+	accesses to a page with a watchpoint on it are checked.
 	"""
 	def __init__(self, size=4096):
 		super(Memory, self).__init__()
 		self.size = size
 		self.buffer = create_string_buffer(size)
 		self.startaddr = 0xA1000000
+		self.reads = []
+		self.writes = []
+		self.watchpoints = []
+		self.watched = {}
+		self.hits = []
 		self.debugmode = False
 		self.debug_clean()
 	
+	def rehook(self):
+		"""
+		Picks the load and store methods to use: the plain ones if
+		there are no hooks, so unhooked accesses cost nothing extra,
+		or wrappers which call the hooks after the access. Loads
+		and stores are only checked against watchpoints while there
+		are watchpoints which care about them.
+		"""
+		for (name, size) in LOADS:
+			self.__dict__.pop(name, None)
+			if self.reads:
+				setattr(self, name, _hooked_load(getattr(self, name), size, self.reads))
+		for (name, size) in STORES:
+			self.__dict__.pop(name, None)
+			if self.writes:
+				setattr(self, name, _hooked_store(getattr(self, name), size, self.writes))
+		# watchpoints go outside the hooks, to see values before stores
+		if any(watchpoint.kind & WATCH_READ for watchpoint in self.watchpoints):
+			for (name, size) in LOADS:
+				setattr(self, name, _watched_load(getattr(self, name), size, self))
+		if any(watchpoint.kind & (WATCH_WRITE | WATCH_CHANGE) for watchpoint in self.watchpoints):
+			for (name, size) in STORES:
+				setattr(self, name, _watched_store(getattr(self, name), size, self))
+	
+	def watch(self, addr, size=4, kind=WATCH_WRITE):
+		'Adds and returns a Watchpoint'
+		for end in (addr, addr + size - 1):
+			if self.realaddr(end) < 0:
+				raise MemoryError("Out of bounds watchpoint at 0x%X"%addr)
+		watchpoint = Watchpoint(addr, size, kind)
+		self.watchpoints.append(watchpoint)
+		for page in watchpoint.pages():
+			self.watched.setdefault(page, []).append(watchpoint)
+		self.rehook()
+		return watchpoint
+	
+	def unwatch(self, watchpoint):
+		self.watchpoints.remove(watchpoint)
+		for page in watchpoint.pages():
+			self.watched[page].remove(watchpoint)
+			if not self.watched[page]:
+				del self.watched[page]
+		self.rehook()
+	
+	def peek(self, addr, size):
+		'Returns the value of size bytes at addr, without going through any hooks'
+		(value,) = struct.unpack_from(_formats[size], self.buffer, self.realaddr(addr))
+		return value
+	
+	def watch_access(self, kind, addr, size, store):
+		"""
+		Checks an access of size bytes at addr, on a watched page,
+		against the watchpoints there. A store is done by calling
+		store, in between finding the old and new values.
+		"""
+		pages = set([addr >> WATCH_BITS, (addr + size - 1) >> WATCH_BITS])
+		found = []
+		for page in pages:
+			for watchpoint in self.watched.get(page, ()):
+				if watchpoint.kind & kind and watchpoint.overlaps(addr, size) and watchpoint not in found:
+					found.append(watchpoint)
+		old = [self.peek(watchpoint.addr, watchpoint.size) for watchpoint in found]
+		if store is not None:
+			store()
+		for (watchpoint, before) in zip(found, old):
+			after = self.peek(watchpoint.addr, watchpoint.size)
+			if kind == WATCH_READ:
+				self.hits.append((watchpoint, WATCH_READ, addr, size, before, after))
+			elif watchpoint.kind & WATCH_WRITE:
+				self.hits.append((watchpoint, WATCH_WRITE, addr, size, before, after))
+			elif before != after:
+				self.hits.append((watchpoint, WATCH_CHANGE, addr, size, before, after))
+	
 	def set_debugmode(self, boolean):
+		"""
+		Records the buffer offset of every byte read or written in
+		readaccesses and writeaccesses.
+		"""
+		if boolean == self.debugmode:
+			return
+		if boolean:
+			self.reads.append(self.debug_read)
+			self.writes.append(self.debug_write)
+		else:
+			self.reads.remove(self.debug_read)
+			self.writes.remove(self.debug_write)
 		self.debugmode = boolean
+		self.rehook()
+	
+	def debug_read(self, addr, size, value):
+		addr = self.realaddr(addr)
+		self.readaccesses.extend(range(addr, addr + size))
+	
+	def debug_write(self, addr, size, value):
+		addr = self.realaddr(addr)
+		self.writeaccesses.extend(range(addr, addr + size))
 	
 	def debug_clean(self):
 		self.readaccesses = []
@@ -94,30 +385,59 @@ class Memory(object):
 		"""
 		Prints the contents of memory.
 		"""
-		buf = ""
-		for i in range(self.startaddr, self.startaddr + self.size):
-			if i % 32 == 0:
-				buf += "\n0x%X:"%i
-			if i % 4 == 0:
-				buf += " "
-			addr = (i - (i%4)) + (4 - (i % 4) - 1)
-			buf += "%02X"%self.ldrb(addr)
-		print buf
+		print "\n" + "\n".join(self.dump())
 	
 	def debug_char(self):
 		"""
 		Prints the contents of memory.
 		"""
-		buf = ""
-		for i in range(self.startaddr, self.startaddr + self.size):
-			if i % 32 == 0:
-				buf += "\n0x%X:"%i
-			if i % 4 == 0:
-				buf += " "
-			addr = i #(i - (i%4)) + (4 - (i % 4) - 1)
-			byte = self.ldrb(addr)
-			buf += "%s"%(chr(byte)+' ' if byte in range(65, 128) else ' .')
-		print buf
+		print "\n" + "\n".join(self.dump_chars())
+	
+	def read(self, addr, length):
+		"""
+		Returns length bytes from addr as a string, straight from
+		the buffer, without going through any hooks or watchpoints.
+		"""
+		if length <= 0:
+			return ""
+		real = self.realaddr(addr)
+		if real < 0 or self.realaddr(addr + length - 1) != real + length - 1:
+			raise MemoryError("Out of bounds access at 0x%X"%addr)
+		return memoryview(self.buffer)[real:real + length].tobytes()
+	
+	def snapshot(self):
+		'Returns the whole of memory as a string, to diff() against later'
+		return self.read(self.startaddr, self.size)
+	
+	def region(self, addr, length):
+		'Fills in the whole of memory for a missing addr and length'
+		if addr is None:
+			return (self.startaddr, self.size)
+		return (addr, self.startaddr + self.size - addr if length is None else length)
+	
+	def dump(self, addr=None, length=None):
+		'Returns lines showing memory as words in hex, from the word holding addr'
+		(addr, length) = self.region(addr, length)
+		start = addr & ~3
+		return hexdump(self.read(start, addr + length - start), start)
+	
+	def dump_chars(self, addr=None, length=None):
+		'Returns lines showing memory as characters, from the word holding addr'
+		(addr, length) = self.region(addr, length)
+		start = addr & ~3
+		return chardump(self.read(start, addr + length - start), start)
+	
+	def diff(self, snapshot):
+		"""
+		Compares memory with an earlier snapshot(), returning
+		(address, old bytes, new bytes) for each run of changes.
+		"""
+		return diff(snapshot, self.snapshot(), self.startaddr)
+	
+	def find(self, pattern, addr=None, length=None):
+		'Returns the address of each match of the string pattern'
+		(addr, length) = self.region(addr, length)
+		return list(find(self.read(addr, length), pattern, addr))
 	
 	def realaddr(self, addr):
 		"""
@@ -135,8 +455,6 @@ class Memory(object):
 		byte = byte.value & 0xFF
 		addr = self.realaddr(addr)
 		struct.pack_into("B", self.buffer, addr, byte)
-		if self.debugmode:
-			self.writeaccesses.append(addr)
 	
 	def strh(self, addr, hw):
 		"""Store halfword"""
@@ -146,9 +464,6 @@ class Memory(object):
 		hw = hw.value & 0xFFFF
 		addr = self.realaddr(addr)
 		struct.pack_into("H", self.buffer, addr, hw)
-		if self.debugmode:
-			self.writeaccesses.append(addr)
-			self.writeaccesses.append(addr+1)
 		
 	def strw(self, addr, word):
 		"""Store word"""
@@ -158,19 +473,12 @@ class Memory(object):
 		word = word.value & 0xFFFFFFFF
 		addr = self.realaddr(addr)
 		struct.pack_into("I", self.buffer, addr, word)
-		if self.debugmode:
-			self.writeaccesses.append(addr)
-			self.writeaccesses.append(addr+1)
-			self.writeaccesses.append(addr+2)
-			self.writeaccesses.append(addr+3)
 		
 	
 	def ldrb(self, addr):
 		"""Load byte"""
 		addr = self.realaddr(addr)
 		(val,) = struct.unpack_from("B", self.buffer, addr)
-		if self.debugmode:
-			self.readaccesses.append(addr)
 		return val
 	
 	def ldrh(self, addr):
@@ -179,9 +487,6 @@ class Memory(object):
 			raise MemoryError("Halfword reads must be halfword-aligned!")
 		addr = self.realaddr(addr)
 		(val,) = struct.unpack_from("H", self.buffer, addr)
-		if self.debugmode:
-			self.readaccesses.append(addr)
-			self.readaccesses.append(addr+1)
 		return val
 	
 	def ldrw(self, addr):
@@ -190,14 +495,9 @@ class Memory(object):
 			raise MemoryError("Word stores must be word-aligned!")
 		addr = self.realaddr(addr)
 		(val,) = struct.unpack_from("I", self.buffer, addr)
-		if self.debugmode:
-			self.readaccesses.append(addr)
-			self.readaccesses.append(addr+1)
-			self.readaccesses.append(addr+2)
-			self.readaccesses.append(addr+3)
 		return val
 	
 	def range_to_list(self, addr, length):
 		"""Return a range of memory as a list of bytes"""
-		return [self.ldrb(x) for x in range(addr, addr+length)]
+		return list(bytearray(self.read(addr, length)))
 
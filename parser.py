@@ -17,8 +17,11 @@
 
 
 
+import re
+import ply.lex as lex
 import ply.yacc as yacc
 from lexer import tokens
+import lexer
 import instruction
 import cond
 import register
@@ -38,15 +41,44 @@ def p_commands(p):
 
 def p_linel(p):
 	'line : LABEL command'
-	p[0] = (p[1], p[2])
+	# the command can be on a later line than its label
+	gap = _gap.match(p.lexer.lexdata, p.lexpos(1) + len(p[1])).group()
+	p[0] = (p[1], located(p[2], gap_lineno(gap, p.lineno(1))))
 
 def p_linejustlabel(p):
 	'line : LABEL'
 	p[0] = (p[1], None)
 
 def p_line(p):
-	'line : command'
-	p[0] = ('', p[1])
+	'line : lineno command'
+	p[0] = ('', located(p[2], p[1]))
+
+def p_lineno(p):
+	'lineno :'
+	# reduced with the first token of the command as the lookahead,
+	# so the lexer is still on its line
+	p[0] = p.lexer.lineno
+
+# what can come between a label and its command
+_gap = re.compile(r'(?:[ \t\n,]|;.*)*')
+_newline_or_comment = re.compile(r'\n|;.*')
+
+def gap_lineno(gap, lineno):
+	'Returns the line at the end of gap, which starts on lineno'
+	for m in _newline_or_comment.finditer(gap):
+		if m.group() == "\n":
+			lineno += 1
+		else:
+			marker = lexer.line_marker(m.group())
+			if marker is not None:
+				lineno = marker - 1
+	return lineno
+
+def located(command, lineno):
+	'Records the source line of an instruction or data directive'
+	if isinstance(command, (instruction.Instruction, memory.Store)):
+		command.line = lineno
+	return command
 
 def p_directivecmd(p):
 	'command : directive'
@@ -646,6 +678,20 @@ def p_error(p):
 
 parser = yacc.yacc()
 
+_parse = parser.parse
+
+def parse(input=None, lexer=None, **kwargs):
+	"""
+	Parses input, counting its lines from 1. ply.lex's lexers
+	carry on from where the last input left off.
+	"""
+	if lexer is None:
+		lexer = lex.lexer
+	lexer.lineno = 1
+	return _parse(input, lexer, **kwargs)
+
+parser.parse = parse
+
 
 
 
@@ -615,7 +615,7 @@ class Preprocessor(object):
                 # Preprocessor directive
 
                 for tok in x:
-                    if tok in self.t_WS and '\n' in tok.value:
+                    if tok.type in self.t_WS and '\n' in tok.value:
                         chunk.append(tok)
                 
                 dirtokens = self.tokenstrip(x[i+1:])
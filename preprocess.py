@@ -0,0 +1,263 @@
+##########################################################################
+# This file is part of d00ks.
+# 
+# d00ks is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# d00ks is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with d00ks.  If not, see <http://www.gnu.org/licenses/>.
+##########################################################################
+
+"""
+This file runs assembly source through the C preprocessor in
+ply/cpp.py before it is parsed, so programs can #include shared
+code and #define macros.
+
+Where the output's lines stop matching the lines of the source,
+because a file was included or a block was left out by #ifdef, a
+";#line n" comment is put before the next line, and the lexer
+carries on counting from n. The line table holds only numbers,
+so the lines of included code are lines of the file they came
+from.
+
+Expanded output is kept in a content-addressed Cache. An entry is
+found by hashing the source, the defines and the include path, and
+is only used if every file the expansion read (and every include
+candidate it found missing) is still the same, so an unchanged
+program is never re-expanded however many headers it pulls in.
+"""
+
+import os
+import re
+import copy
+import marshal
+import hashlib
+import ply.lex as lex
+import ply.cpp as cpp
+
+VERSION = 2
+
+# a line which starts with # is a directive
+_directive = re.compile(r'^[ \t]*#', re.M)
+
+def digest(data):
+	return hashlib.sha1(data).hexdigest()
+
+def _cpp_lexer():
+	# ply.lex.lex() replaces the module-level lexer that the parser
+	# falls back on, so put back whatever was there (nothing, if no
+	# lexer has been built yet) afterwards
+	names = ("lexer", "input", "token")
+	saved = [(name, getattr(lex, name)) for name in names if hasattr(lex, name)]
+	try:
+		return lex.lex(module=cpp, errorlog=lex.NullLogger())
+	finally:
+		for name in names:
+			if hasattr(lex, name):
+				delattr(lex, name)
+		for (name, value) in saved:
+			setattr(lex, name, value)
+
+_lexer = _cpp_lexer()
+
+class Preprocessor(cpp.Preprocessor):
+	"""
+	A cpp.Preprocessor which reports errors as SyntaxErrors and
+	records each include file it looks for in self.dependencies,
+	as (path, digest), with a digest of None if it was missing.
+	"""
+	def __init__(self, path=[]):
+		super(Preprocessor, self).__init__(_lexer.clone())
+		self.path = list(path)
+		self.dependencies = []
+
+	def error(self, file, line, msg):
+		raise SyntaxError("%s:%i %s"%(file, line, msg))
+
+	def read(self, name):
+		name = os.path.abspath(name)
+		try:
+			f = open(name, "r")
+		except IOError:
+			self.dependencies.append((name, None))
+			return None
+		try:
+			data = f.read()
+		finally:
+			f.close()
+		self.dependencies.append((name, digest(data)))
+		return data
+
+	def include(self, tokens):
+		if not tokens:
+			return
+		if tokens[0].value != '<' and tokens[0].type != self.t_STRING:
+			tokens = self.expand_macros(tokens)
+		if tokens[0].value == '<':
+			# include <...>
+			for i in xrange(1, len(tokens)):
+				if tokens[i].value == '>':
+					break
+			else:
+				self.error(self.source, tokens[0].lineno, "Malformed #include <...>")
+			filename = "".join([x.value for x in tokens[1:i]])
+			path = self.path + [""] + self.temp_path
+		elif tokens[0].type == self.t_STRING:
+			filename = tokens[0].value[1:-1]
+			path = self.temp_path + [""] + self.path
+		else:
+			self.error(self.source, tokens[0].lineno, "Malformed #include statement")
+		for p in path:
+			iname = os.path.join(p, filename)
+			data = self.read(iname)
+			if data is None:
+				continue
+			dname = os.path.dirname(iname)
+			if dname:
+				self.temp_path.insert(0, dname)
+			last = None
+			for tok in self.parsegen(data, filename):
+				yield tok
+				last = tok
+			# the newline at the end of the file is dropped
+			if last is not None and not last.value.endswith("\n"):
+				newline = copy.copy(last)
+				newline.type = self.t_NEWLINE
+				newline.value = "\n"
+				yield newline
+			if dname:
+				del self.temp_path[0]
+			break
+		else:
+			self.error(self.source, tokens[0].lineno, "Couldn't find '%s'"%filename)
+
+class Cache(object):
+	"""
+	Expanded sources on disk. For each key there is a manifest
+	holding the include dependencies and the digest of the output,
+	and the output itself is stored under its digest, so programs
+	that expand to the same text share one copy.
+	"""
+	def __init__(self, directory):
+		self.directory = directory
+
+	def filename(self, name):
+		return os.path.join(self.directory, name)
+
+	def lookup(self, key):
+		'Returns the cached output for key, or None'
+		try:
+			f = open(self.filename(key + ".manifest"), "rb")
+			try:
+				(version, dependencies, output) = marshal.load(f)
+			finally:
+				f.close()
+		except (IOError, EOFError, ValueError, TypeError):
+			return None
+		if version != VERSION:
+			return None
+		for (name, known) in dependencies:
+			try:
+				f = open(name, "r")
+			except IOError:
+				if known is None:
+					continue
+				return None
+			try:
+				if digest(f.read()) != known:
+					return None
+			finally:
+				f.close()
+		try:
+			f = open(self.filename(output + ".s"), "r")
+			try:
+				return f.read()
+			finally:
+				f.close()
+		except IOError:
+			return None
+
+	def store(self, key, dependencies, output):
+		if not os.path.isdir(self.directory):
+			os.makedirs(self.directory)
+		name = digest(output)
+		self.write(name + ".s", output)
+		self.write(key + ".manifest", marshal.dumps((VERSION, dependencies, name)))
+
+	def write(self, name, data):
+		# write then rename, so a reader never sees half a file
+		path = self.filename(name)
+		tmp = "%s.%i"%(path, os.getpid())
+		f = open(tmp, "wb")
+		try:
+			f.write(data)
+		finally:
+			f.close()
+		os.rename(tmp, path)
+
+def default_cache():
+	'The cache in $D00KS_CACHE, or ~/.d00ks/cpp'
+	directory = os.environ.get("D00KS_CACHE")
+	if not directory:
+		directory = os.path.join(os.path.expanduser("~"), ".d00ks")
+	return Cache(os.path.join(directory, "cpp"))
+
+def preprocess(data, source="", path=[], defines={}, cache=None):
+	"""
+	Returns data with its directives carried out and its macros
+	expanded. path is the list of directories searched by #include,
+	and defines maps macro names to their values. Source with no
+	directives and no defines is returned untouched.
+	"""
+	if not defines and not _directive.search(data):
+		return data
+	if cache is not None:
+		key = digest(repr((VERSION, data, sorted(defines.items()), list(path),
+			os.path.abspath(os.path.dirname(source)))))
+		output = cache.lookup(key)
+		if output is not None:
+			return output
+	pp = Preprocessor(path)
+	if os.path.dirname(source):
+		pp.temp_path.insert(0, os.path.dirname(source))
+	for (name, value) in defines.items():
+		pp.define("%s %s"%(name, value))
+	pp.parse(data, source)
+	output = []
+	# the line the lexer will be on, where in output it starts (the
+	# index of a piece, and the offset of the line in it), and
+	# whether anything but whitespace has been put on it yet
+	line = 1
+	start = (0, 0)
+	blank = True
+	while True:
+		tok = pp.token()
+		if not tok:
+			break
+		if tok.type in pp.t_WS:
+			newlines = tok.value.count("\n")
+			if newlines:
+				line += newlines
+				start = (len(output), tok.value.rindex("\n") + 1)
+				blank = True
+		else:
+			if blank and tok.lineno != line:
+				# at the very start of the line
+				(i, offset) = start
+				piece = output[i] if i < len(output) else ""
+				marker = ";#line %i\n"%tok.lineno
+				output[i:i + 1] = [piece[:offset] + marker + piece[offset:]]
+				line = tok.lineno
+			blank = False
+		output.append(tok.value)
+	output = "".join(output)
+	if cache is not None:
+		cache.store(key, pp.dependencies, output)
+	return output
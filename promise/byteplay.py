@@ -42,8 +42,8 @@ from cStringIO import StringIO
 # Define opcodes and information about them
 
 python_version = '.'.join(str(x) for x in sys.version_info[:2])
-if python_version not in ('2.4', '2.5', '2.6'):
-    warnings.warn('byteplay supports only Python versions 2.4 to 2.6')
+if python_version not in ('2.4', '2.5', '2.6', '2.7'):
+    warnings.warn('byteplay supports only Python versions 2.4 to 2.7')
 
 class Opcode(int):
     """An int which represents an opcode - has a nicer repr."""
@@ -140,6 +140,11 @@ class _se:
         YIELD_VALUE = 1,1
         IMPORT_NAME = 2,1
 
+    if python_version == '2.7':
+        # these take the position of the collection as their arg
+        LIST_APPEND = SET_ADD = 1,0
+        MAP_ADD = 2,0
+
 
 _se = dict((op, getattr(_se, opname[op]))
            for op in opcodes
@@ -150,6 +155,19 @@ hasflow = opcodes - set(_se) - \
                CALL_FUNCTION_VAR_KW, BUILD_TUPLE, BUILD_LIST,
                UNPACK_SEQUENCE, BUILD_SLICE, DUP_TOPX,
                RAISE_VARARGS, MAKE_FUNCTION, MAKE_CLOSURE])
+if python_version == '2.7':
+    hasflow -= set([BUILD_SET])
+
+# Conditional jumps: the first two leave TOS alone either way, the next
+# two pop it either way, and the last two pop it only if they don't jump.
+if python_version == '2.7':
+    condjumps = set()
+    popcondjumps = set([POP_JUMP_IF_FALSE, POP_JUMP_IF_TRUE])
+    orpopcondjumps = set([JUMP_IF_FALSE_OR_POP, JUMP_IF_TRUE_OR_POP])
+else:
+    condjumps = set([JUMP_IF_FALSE, JUMP_IF_TRUE])
+    popcondjumps = set()
+    orpopcondjumps = set()
 
 def getse(op, arg=None):
     """Get the stack effect of an opcode, as a (pop, push) tuple.
@@ -186,6 +204,8 @@ def getse(op, arg=None):
         return arg, 1
     elif op == BUILD_LIST:
         return arg, 1
+    elif python_version == '2.7' and op == BUILD_SET:
+        return arg, 1
     elif op == UNPACK_SEQUENCE:
         return 1, arg
     elif op == BUILD_SLICE:
@@ -446,9 +466,11 @@ class Code(object):
         # yield the stack state of the target as if 1 object was pushed, but
         # this will be corrected in the actual stack recording.
 
+        # In Python 2.7, SETUP_WITH targets behave the same way.
         sf_targets = set(label_pos[arg]
                          for op, arg in code
-                         if op == SETUP_FINALLY)
+                         if op == SETUP_FINALLY or
+                            (python_version == '2.7' and op == SETUP_WITH))
 
         # What we compute - for each opcode, its stack state, as an n-tuple.
         # n is the number of blocks pushed. For each block, we record the number
@@ -525,11 +547,21 @@ class Code(object):
                 # One possibility for a jump
                 yield label_pos[arg], curstack
 
-            elif op in (JUMP_IF_FALSE, JUMP_IF_TRUE):
+            elif op in condjumps:
                 # Two possibilities for a jump
                 yield label_pos[arg], curstack
                 yield pos+1, curstack
 
+            elif op in popcondjumps:
+                # Two possibilities for a jump, TOS is popped in both
+                yield label_pos[arg], newstack(-1)
+                yield pos+1, newstack(-1)
+
+            elif op in orpopcondjumps:
+                # TOS is kept if we jump and popped if we don't
+                yield label_pos[arg], curstack
+                yield pos+1, newstack(-1)
+
             elif op == FOR_ITER:
                 # FOR_ITER pushes next(TOS) on success, and pops TOS and jumps
                 # on failure
@@ -570,6 +602,13 @@ class Code(object):
                 yield pos+1, curstack + (0,)
                 yield label_pos[arg], newstack(1)
 
+            elif python_version == '2.7' and op == SETUP_WITH:
+                # The context manager is replaced by its __exit__, then
+                # a new block holds the result of __enter__. On exception,
+                # we jump to the label as for SETUP_FINALLY.
+                yield pos+1, curstack + (1,)
+                yield label_pos[arg], newstack(1)
+
             elif op == POP_BLOCK:
                 # Just pop the block
                 yield pos+1, curstack[:-1]
@@ -0,0 +1,396 @@
+"""
+
+  promise.cache:  persist the bytecode rewritten by promises.
+
+Applying a promise means disassembling a function's bytecode with byteplay,
+transforming it and assembling it again.  That is by far the most expensive
+thing promise does, and it is repeated by every process that imports a module
+full of decorated functions.  This module stores the rewritten code objects on
+disk so that the cost is paid once per install rather than once per process.
+
+Each transformation of a function's code is looked up by a key made from:
+
+    * the interpreter version and the source of promise itself
+    * the code object being transformed
+    * a description of the transformation (which promises are applied)
+    * what each name used by the code is bound to: missing, a callable,
+      a pure function (identified by its own code), or some other value
+      (identified by its type and contents; functions using values that
+      can't be described that way are not cached)
+
+There is one cache file per source module and interpreter version, holding
+a dict of entries, together with a hash of the module's source file.  The
+file is read when the first function in the module is decorated (i.e. at
+import time) and is thrown away if the source has changed.  New entries are
+written back when the interpreter exits.
+
+Code objects can only be marshalled if all of their constants can be, but
+promises store arbitrary objects such as functions and classes as constants.
+Those are saved as references to where the object can be found again (a
+global or builtin name, a module attribute, or the function itself), and are
+looked up when the entry is loaded.  Functions whose constants can't be
+referenced this way are simply not cached.
+
+Set the environment variable PROMISE_CACHE_DIR to choose where the cache files
+are kept; by default they go in a "cache" directory next to this module.  If
+it can't be written to, caching is quietly disabled.
+"""
+
+import os
+import sys
+import types
+import atexit
+import marshal
+import hashlib
+import __builtin__
+
+
+#  Bump this whenever the format of keys or entries changes.
+VERSION = 3
+
+#  Set to False to turn the cache off for this process.
+enabled = True
+
+directory = os.environ.get("PROMISE_CACHE_DIR")
+if not directory:
+    directory = os.path.join(os.path.dirname(os.path.abspath(__file__)),"cache")
+
+#  Value types that marshal can store.  Tuples and frozensets are checked
+#  element by element.
+_simple_types = (types.NoneType,bool,int,long,float,complex,str,unicode,
+                 types.EllipsisType)
+
+
+class Uncacheable(Exception):
+    """Raised when a code object can't be stored in or loaded from the cache."""
+    pass
+
+
+def _marshalable(obj):
+    """Check whether marshal can store the given constant."""
+    if isinstance(obj,_simple_types):
+        return True
+    if isinstance(obj,(tuple,frozenset)):
+        for item in obj:
+            if not _marshalable(item):
+                return False
+        return True
+    return False
+
+
+def _replace_consts(co,consts):
+    """Make a copy of the given code object with different constants."""
+    return types.CodeType(co.co_argcount,co.co_nlocals,co.co_stacksize,
+                          co.co_flags,co.co_code,tuple(consts),co.co_names,
+                          co.co_varnames,co.co_filename,co.co_name,
+                          co.co_firstlineno,co.co_lnotab,co.co_freevars,
+                          co.co_cellvars)
+
+
+def _reference(func,obj):
+    """Find a way to get back to the given object from func.
+
+    Returns a tuple describing where obj can be found, or raises Uncacheable.
+    """
+    if obj is func:
+        return ("self",)
+    for (name,value) in func.func_globals.iteritems():
+        if value is obj:
+            return ("global",name)
+    for (name,value) in __builtin__.__dict__.iteritems():
+        if value is obj:
+            return ("builtin",name)
+    modname = getattr(obj,"__module__",None)
+    name = getattr(obj,"__name__",None)
+    try:
+        if getattr(sys.modules[modname],name) is obj:
+            return ("module",modname,name)
+    except (KeyError,TypeError,AttributeError):
+        pass
+    raise Uncacheable(repr(obj))
+
+
+def _resolve(func,ref):
+    """Find the object described by a tuple from _reference()."""
+    try:
+        if ref[0] == "self":
+            return func
+        elif ref[0] == "global":
+            return func.func_globals[ref[1]]
+        elif ref[0] == "builtin":
+            return __builtin__.__dict__[ref[1]]
+        elif ref[0] == "module":
+            return getattr(sys.modules[ref[1]],ref[2])
+    except (KeyError,AttributeError):
+        pass
+    raise Uncacheable(repr(ref))
+
+
+def dump_code(co,func):
+    """Convert a code object of func into a marshallable form.
+
+    Returns a tuple (code,refs) where code is a copy of co with every
+    constant that can't be marshalled replaced by None, and refs is a list
+    of (index,reference) pairs recording what was replaced.  Nested code
+    objects are converted in the same way, with a reference ("code",refs).
+    """
+    consts = list(co.co_consts)
+    refs = []
+    for (i,const) in enumerate(consts):
+        if isinstance(const,types.CodeType):
+            (consts[i],inner) = dump_code(const,func)
+            if inner:
+                refs.append((i,("code",inner)))
+        elif not _marshalable(const):
+            refs.append((i,_reference(func,const)))
+            consts[i] = None
+    if refs:
+        co = _replace_consts(co,consts)
+    return (co,refs)
+
+
+def load_code(co,refs,func):
+    """Rebuild a code object of func from the output of dump_code()."""
+    if not refs:
+        return co
+    consts = list(co.co_consts)
+    for (i,ref) in refs:
+        if ref[0] == "code":
+            consts[i] = load_code(consts[i],ref[1],func)
+        else:
+            consts[i] = _resolve(func,ref)
+    return _replace_consts(co,consts)
+
+
+def names(co,found=None):
+    """Collect all names used by a code object and those nested in it."""
+    if found is None:
+        found = set()
+    found.update(co.co_names)
+    found.update(co.co_freevars)
+    for const in co.co_consts:
+        if isinstance(const,types.CodeType):
+            names(const,found)
+    return found
+
+
+def _describe(obj,deep):
+    """Describe what a name is bound to, as far as promises care."""
+    if hasattr(obj,"_promise_fold_constant"):
+        #  A pure function will be inlined, so its code matters too.
+        #  Its description doesn't look any further, to avoid cycles.
+        try:
+            original = obj._promise_original_code
+        except AttributeError:
+            original = obj.func_code
+        if deep:
+            return ("pure",_digest(obj,original,False))
+        return ("pure",marshal.dumps(dump_code(original,obj),0))
+    if callable(obj):
+        return 1
+    #  Other values may be folded into the code as constants, and can
+    #  come from another module whose source isn't hashed, so the value
+    #  itself is part of the key.
+    return ("value",_value(obj,[0]))
+
+
+#  The most objects a value is described by before giving up on it.
+MAX_VALUE_SIZE = 1000
+
+
+def _value(obj,count):
+    """Describe a value by its type and contents, so that the description
+    is the same in every process that has the same value.
+
+    Raises Uncacheable if that can't be done, or if more than
+    MAX_VALUE_SIZE objects (counted in count[0]) would be described.
+    """
+    count[0] += 1
+    if count[0] > MAX_VALUE_SIZE:
+        raise Uncacheable("value too large")
+    if _marshalable(obj):
+        return obj
+    if isinstance(obj,types.ModuleType):
+        return ("module",obj.__name__)
+    kind = "%s.%s" % (type(obj).__module__,type(obj).__name__)
+    if isinstance(obj,(tuple,list)):
+        return (kind,tuple([_value(item,count) for item in obj]))
+    if isinstance(obj,(set,frozenset)):
+        items = [_value(item,count) for item in obj]
+        return (kind,tuple(sorted(items,key=lambda item: marshal.dumps(item,0))))
+    if isinstance(obj,dict):
+        items = [(_value(k,count),_value(v,count)) for (k,v) in obj.iteritems()]
+        return (kind,tuple(sorted(items,key=lambda item: marshal.dumps(item,0))))
+    #  Other objects by their attributes, whether in slots or a __dict__
+    attrs = {}
+    for cls in type(obj).__mro__:
+        slots = cls.__dict__.get("__slots__",())
+        if isinstance(slots,basestring):
+            slots = (slots,)
+        for name in slots:
+            if name not in ("__dict__","__weakref__") and hasattr(obj,name):
+                attrs[name] = getattr(obj,name)
+    attrs.update(getattr(obj,"__dict__",{}))
+    if not attrs:
+        #  Nothing to tell one such object from another
+        raise Uncacheable(repr(obj))
+    return (kind,tuple([(name,_value(attrs[name],count)) for name in sorted(attrs)]))
+
+
+def _environment(func,co,deep=True):
+    """Describe the bindings of every name used by a code object."""
+    env = []
+    globals = func.func_globals
+    builtins = __builtin__.__dict__
+    for name in sorted(names(co)):
+        if name in globals:
+            env.append((name,_describe(globals[name],deep)))
+        elif name in builtins:
+            env.append((name,_describe(builtins[name],deep)))
+        else:
+            env.append((name,0))
+    #  Constants already bound into the code may be pure functions as well
+    for const in co.co_consts:
+        if hasattr(const,"_promise_fold_constant"):
+            env.append((None,_describe(const,deep)))
+    return tuple(env)
+
+
+def _promise_source():
+    """Hash the source of promise, so that changes to it invalidate entries."""
+    global _promise_digest
+    if _promise_digest is None:
+        h = hashlib.sha1()
+        here = os.path.dirname(os.path.abspath(__file__))
+        for name in ("bytecode.py","byteplay.py","cache.py"):
+            try:
+                f = open(os.path.join(here,name),"rb")
+                try:
+                    h.update(f.read())
+                finally:
+                    f.close()
+            except IOError:
+                pass
+        _promise_digest = h.hexdigest()
+    return _promise_digest
+
+_promise_digest = None
+
+
+def _digest(func,co,deep=True,operation=None):
+    """Hash a code object of func and everything its rewriting depends on."""
+    key = (VERSION,sys.version,_promise_source(),operation,dump_code(co,func),
+           _environment(func,co,deep))
+    return hashlib.sha1(marshal.dumps(key,0)).hexdigest()
+
+
+class ModuleCache(object):
+    """The cache entries for the functions of one source module."""
+
+    def __init__(self,filename):
+        self.path = None
+        self.entries = {}
+        self.dirty = False
+        try:
+            f = open(filename,"rb")
+            try:
+                self.source = hashlib.sha1(f.read()).hexdigest()
+            finally:
+                f.close()
+        except IOError:
+            #  No source, so nothing to check entries against.
+            return
+        name = hashlib.sha1(os.path.abspath(filename)).hexdigest()
+        self.path = os.path.join(directory,"%s-py%d%d.marshal" % (name,
+                                 sys.version_info[0],sys.version_info[1]))
+        try:
+            f = open(self.path,"rb")
+            try:
+                (version,source,entries) = marshal.load(f)
+            finally:
+                f.close()
+        except (IOError,EOFError,ValueError,TypeError):
+            return
+        if version == VERSION and source == self.source:
+            self.entries = entries
+
+    def get(self,key):
+        return self.entries.get(key)
+
+    def put(self,key,entry):
+        if self.path is not None:
+            self.entries[key] = entry
+            self.dirty = True
+
+    def save(self):
+        """Write the entries back to disk if any were added."""
+        if not self.dirty:
+            return
+        try:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            tmp = "%s.%d" % (self.path,os.getpid())
+            f = open(tmp,"wb")
+            try:
+                marshal.dump((VERSION,self.source,self.entries),f,2)
+            finally:
+                f.close()
+            os.rename(tmp,self.path)
+        except (IOError,OSError):
+            pass
+        self.dirty = False
+
+
+_modules = {}
+
+
+def module_cache(func):
+    """Get the ModuleCache for the module in which func was defined."""
+    filename = func.func_code.co_filename
+    try:
+        return _modules[filename]
+    except KeyError:
+        if filename.endswith((".pyc",".pyo")):
+            filename = filename[:-1]
+        cache = _modules[func.func_code.co_filename] = ModuleCache(filename)
+        return cache
+
+
+def save():
+    """Write out all modified cache files."""
+    for cache in _modules.itervalues():
+        cache.save()
+
+atexit.register(save)
+
+
+def transform(func,code,operation,compute):
+    """Rewrite the code of func, using the cache where possible.
+
+    The argument 'code' is the code object being rewritten, 'operation' is
+    a marshallable description of the rewriting, and 'compute' is a function
+    that actually does it by setting func.func_code.  If an entry for the same
+    code, operation and bindings is in the cache it is loaded instead of
+    calling compute().
+    """
+    if not enabled:
+        return compute()
+    cache = module_cache(func)
+    if cache.path is None:
+        return compute()
+    try:
+        key = _digest(func,code,True,operation)
+    except Uncacheable:
+        return compute()
+    entry = cache.get(key)
+    if entry is not None:
+        try:
+            func.func_code = load_code(entry[0],entry[1],func)
+            return
+        except Uncacheable:
+            pass
+    compute()
+    try:
+        cache.put(key,dump_code(func.func_code,func))
+    except Uncacheable:
+        pass
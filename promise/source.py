@@ -0,0 +1,624 @@
+"""
+
+  promise.source:  promises implemented by rewriting python 3 source.
+
+This is the implementation of promise used on python 3, where bytecode is
+different in every release.  A promise is applied by parsing the function's
+source with the ast module, transforming the syntax tree, and compiling it
+again.  The promises and their semantics are the same as in promise.bytecode,
+with the following differences in how they are carried out:
+
+    * constants are bound to hidden keyword-only arguments, whose default
+      values live in the function's __kwdefaults__; reading them is as
+      cheap as reading any other local variable.
+
+    * invariants are copied into hidden local variables by an assignment
+      inserted at the start of the function.
+
+    * a pure function can only be inlined if its body is a single expression
+      once if/elif/else chains of return statements are folded together; it
+      is then substituted into the calling expression, with any complicated
+      arguments evaluated once into temporaries.
+
+    * all promises are deferred until the function is first called, since
+      parsing source at import time is as expensive as rewriting bytecode.
+
+Functions whose source can't be found, and functions with closures, are left
+untouched.  This needs python 3.8 or later; on older versions of python 3 the
+promises are accepted but ignored.
+"""
+
+import sys
+import ast
+import copy
+import types
+import inspect
+import textwrap
+import builtins
+import itertools
+import __future__
+
+
+class BrokenPromiseError(Exception):
+    """Exception raised when you make a promise that is provably broken."""
+    pass
+
+
+_ids = itertools.count(1)
+
+
+def new_name(name=None):
+    """Generate a new unique variable name
+
+    If the given name is not None, it is included in the generated name for
+    ease of reference in e.g. tracebacks or source inspection.
+    """
+    if name is None:
+        return "_promise_var%s" % (next(_ids),)
+    else:
+        return "_promise_var%s_%s" % (next(_ids),name,)
+
+
+#  Code.replace() and assignment expressions both appeared in python 3.8
+supported = sys.version_info >= (3,8)
+
+#  Compiler flags of __future__ statements, which must be passed on when
+#  the rewritten source is compiled.
+_future_flags = 0
+for _feature in __future__.all_feature_names:
+    _future_flags |= getattr(__future__,_feature).compiler_flag
+
+#  Largest expression (in syntax tree nodes) that will be inlined
+MAX_INLINE_SIZE = 200
+
+#  Expressions that bind names or create scopes can't be inlined
+_uninlinable = (ast.Lambda,ast.ListComp,ast.SetComp,ast.DictComp,
+                ast.GeneratorExp,ast.Yield,ast.YieldFrom,ast.Await)
+if supported:
+    _uninlinable += (ast.NamedExpr,)
+
+
+def _bootstrap(*args,_promise_func=None,_promise_apply=None,**kwds):
+    _promise_apply(_promise_func)
+    return _promise_func(*args,**kwds)
+
+
+def apply_deferred_promises(func):
+    """Apply any deferred promises attached to a function."""
+    #  Popping the list ensures only one thread applies the promises.
+    deferred = func.__dict__.pop("_promise_deferred",None)
+    if deferred is None:
+        return
+    #  Remove the bootstrapping code inserted by Promise.defer()
+    (func.__code__,func.__kwdefaults__) = func._promise_original
+    del func._promise_original
+    source = _Source.parse(func)
+    if source is None:
+        return
+    for p in deferred:
+        p.apply(func,source)
+    source.install()
+
+
+def _global_names(tree):
+    """Find the names loaded by a function that aren't bound within it.
+
+    Returns a tuple (loaded,bound) of sets of names.  Names bound anywhere
+    in the function, including in nested scopes or by a global statement,
+    are excluded from the loaded names.
+    """
+    loaded = set()
+    bound = set()
+    for node in ast.walk(tree):
+        if isinstance(node,ast.Name):
+            if isinstance(node.ctx,ast.Load):
+                loaded.add(node.id)
+            else:
+                bound.add(node.id)
+        elif isinstance(node,ast.arg):
+            bound.add(node.arg)
+        elif isinstance(node,(ast.FunctionDef,ast.AsyncFunctionDef,
+                              ast.ClassDef)):
+            if node is not tree:
+                bound.add(node.name)
+        elif isinstance(node,(ast.Import,ast.ImportFrom)):
+            for alias in node.names:
+                bound.add((alias.asname or alias.name).split(".")[0])
+        elif isinstance(node,ast.ExceptHandler):
+            if node.name:
+                bound.add(node.name)
+        elif isinstance(node,(ast.Global,ast.Nonlocal)):
+            bound.update(node.names)
+    return (loaded - bound,bound)
+
+
+def _mangled(tree):
+    """Check whether the tree uses names that a class body would mangle."""
+    for node in ast.walk(tree):
+        for name in (getattr(node,"id",None),getattr(node,"attr",None),
+                     getattr(node,"arg",None)):
+            if isinstance(name,str) and name.startswith("__") \
+                                    and not name.endswith("__"):
+                return True
+    return False
+
+
+class _Rename(ast.NodeTransformer):
+    """Replace loads of some names with other expressions."""
+
+    def __init__(self,replacements):
+        self.replacements = replacements
+
+    def visit_Name(self,node):
+        if isinstance(node.ctx,ast.Load):
+            try:
+                new = self.replacements[node.id]
+            except KeyError:
+                pass
+            else:
+                return ast.copy_location(copy.deepcopy(new),node)
+        return node
+
+
+class _Source(object):
+    """The parsed source of a function, as promises transform it.
+
+    Promises modify the syntax tree in self.tree and the hidden constants in
+    self.constants, then install() compiles the result into the function.
+    """
+
+    def __init__(self,func,tree):
+        self.func = func
+        self.tree = tree
+        self.constants = {}
+        self.invariants = []
+        (self.globals,self.bound) = _global_names(tree)
+
+    @classmethod
+    def parse(cls,func):
+        """Parse the source of func, or return None if that's not possible."""
+        code = func.__code__
+        if code.co_freevars:
+            return None
+        try:
+            (lines,lineno) = inspect.getsourcelines(func)
+            module = ast.parse(textwrap.dedent("".join(lines)))
+        except (OSError,TypeError,SyntaxError,IndentationError):
+            return None
+        if len(module.body) != 1:
+            return None
+        tree = module.body[0]
+        if not isinstance(tree,(ast.FunctionDef,ast.AsyncFunctionDef)):
+            return None
+        if tree.name != code.co_name or _mangled(tree):
+            return None
+        ast.increment_lineno(module,lineno - 1)
+        #  Decorators, defaults and annotations are evaluated in the
+        #  enclosing scope, and have already been evaluated.
+        tree.decorator_list = []
+        tree.returns = None
+        args = tree.args
+        args.defaults = []
+        args.kw_defaults = [None] * len(args.kwonlyargs)
+        for arg in ast.walk(args):
+            if isinstance(arg,ast.arg):
+                arg.annotation = None
+        return cls(func,tree)
+
+    def lookup(self,name):
+        """Find the object a global name of the function is bound to.
+
+        If the name cannot be found, NameError is raised.
+        """
+        try:
+            return self.func.__globals__[name]
+        except KeyError:
+            try:
+                return builtins.__dict__[name]
+            except KeyError:
+                raise NameError(name)
+
+    def check_unbound(self,names,promised):
+        """Raise BrokenPromiseError if any of the names is bound locally."""
+        for name in names:
+            if name in self.bound:
+                msg = "name '%s' was promised %s, but assigned to"
+                raise BrokenPromiseError(msg % (name,promised))
+
+    def bind_constant(self,name):
+        """Make loads of the given global name use its current value.
+
+        Returns the value, or raises NameError if the name isn't bound.
+        """
+        value = self.lookup(name)
+        hidden = new_name(name)
+        self.constants[hidden] = value
+        self.tree = _Rename({name:ast.Name(id=hidden,ctx=ast.Load())}).visit(
+                        self.tree)
+        self.globals.discard(name)
+        return value
+
+    def bind_invariant(self,name):
+        """Make loads of the given global name use a local copy of it."""
+        hidden = new_name(name)
+        self.tree = _Rename({name:ast.Name(id=hidden,ctx=ast.Load())}).visit(
+                        self.tree)
+        self.invariants.append(ast.Assign(
+                        targets=[ast.Name(id=hidden,ctx=ast.Store())],
+                        value=ast.Name(id=name,ctx=ast.Load())))
+        self.globals.discard(name)
+
+    def fold(self):
+        """Give constant pure functions a chance to inline themselves."""
+        for value in list(self.constants.values()):
+            try:
+                fold = value._promise_fold_constant
+            except AttributeError:
+                pass
+            else:
+                fold(self.func,self)
+
+    def compile(self,tree):
+        """Compile a function definition into a code object for self.func."""
+        code = self.func.__code__
+        module = ast.Module(body=[tree],type_ignores=[])
+        ast.fix_missing_locations(module)
+        flags = code.co_flags & _future_flags
+        outer = compile(module,code.co_filename,"exec",flags,True)
+        for const in outer.co_consts:
+            if isinstance(const,types.CodeType) and const.co_name==tree.name:
+                break
+        if const.co_freevars:
+            raise SyntaxError("promised function needs a closure")
+        if hasattr(code,"co_qualname"):
+            const = const.replace(co_qualname=code.co_qualname)
+        return const
+
+    def install(self):
+        """Compile the transformed source and make it the function's code."""
+        tree = self.tree
+        body = tree.body
+        start = 0
+        if body and isinstance(body[0],ast.Expr) and \
+                    isinstance(body[0].value,ast.Constant) and \
+                    isinstance(body[0].value.value,str):
+            start = 1
+        for stmt in self.invariants:
+            ast.copy_location(stmt,body[start])
+        tree.body = body[:start] + self.invariants + body[start:]
+        for hidden in sorted(self.constants):
+            tree.args.kwonlyargs.append(ast.arg(arg=hidden,annotation=None))
+            tree.args.kw_defaults.append(None)
+        self.func.__code__ = self.compile(tree)
+        kwdefaults = dict(self.func.__kwdefaults__ or {})
+        kwdefaults.update(self.constants)
+        self.func.__kwdefaults__ = kwdefaults
+        if hasattr(self.func,"_promise_fold_constant"):
+            self.func._promise_inline = _inlinable(self)
+
+
+def _returns(body):
+    """Convert a function body into a single expression giving its result.
+
+    Returns None unless the body consists of return statements, possibly
+    chosen between by if statements.
+    """
+    stmts = [s for s in body if not isinstance(s,ast.Pass)]
+    if not stmts:
+        return None
+    stmt = stmts[0]
+    if isinstance(stmt,ast.Return):
+        if stmt.value is None:
+            return ast.Constant(value=None)
+        return copy.deepcopy(stmt.value)
+    if isinstance(stmt,ast.If):
+        body = _returns(stmt.body)
+        orelse = _returns(stmt.orelse + stmts[1:])
+        if body is None or orelse is None:
+            return None
+        return ast.IfExp(test=copy.deepcopy(stmt.test),body=body,orelse=orelse)
+    return None
+
+
+def _inlinable(source):
+    """Describe how to inline the function whose source has been installed.
+
+    Returns a tuple (params,expr,constants), or None if it can't be inlined.
+    """
+    args = source.tree.args
+    if args.vararg or args.kwarg or source.invariants:
+        return None
+    if len(args.kwonlyargs) != len(source.constants):
+        return None
+    body = source.tree.body
+    if body and isinstance(body[0],ast.Expr) and \
+                isinstance(body[0].value,ast.Constant):
+        body = body[1:]
+    expr = _returns(body)
+    if expr is None:
+        return None
+    size = 0
+    for node in ast.walk(expr):
+        if isinstance(node,_uninlinable):
+            return None
+        size += 1
+    if size > MAX_INLINE_SIZE:
+        return None
+    params = [a.arg for a in getattr(args,"posonlyargs",[]) + args.args]
+    return (params,expr,dict(source.constants))
+
+
+class _Inline(ast.NodeTransformer):
+    """Replace calls to some hidden constants with the callee's expression."""
+
+    def __init__(self,source,func,names,inline):
+        self.source = source
+        self.func = func
+        self.names = names
+        (self.params,self.expr,self.constants) = inline
+
+    def visit_Call(self,node):
+        self.generic_visit(node)
+        if not isinstance(node.func,ast.Name) or node.func.id not in self.names:
+            return node
+        if node.keywords or len(node.args) > len(self.params):
+            return node
+        for arg in node.args:
+            if isinstance(arg,ast.Starred):
+                return node
+        args = list(node.args)
+        defaults = self.func.__defaults__ or ()
+        missing = len(self.params) - len(args)
+        if missing > len(defaults):
+            return node
+        for value in defaults[len(defaults)-missing:]:
+            hidden = new_name()
+            self.source.constants[hidden] = value
+            args.append(ast.Name(id=hidden,ctx=ast.Load()))
+        #  Simple arguments are substituted directly, anything else is
+        #  evaluated once into a temporary first.
+        replacements = {}
+        temporaries = []
+        for (param,arg) in zip(self.params,args):
+            if isinstance(arg,(ast.Name,ast.Constant)):
+                replacements[param] = arg
+            else:
+                tmp = new_name(param)
+                temporaries.append(ast.NamedExpr(
+                                target=ast.Name(id=tmp,ctx=ast.Store()),
+                                value=arg))
+                replacements[param] = ast.Name(id=tmp,ctx=ast.Load())
+        self.source.constants.update(self.constants)
+        expr = _Rename(replacements).visit(copy.deepcopy(self.expr))
+        for child in ast.walk(expr):
+            if "lineno" in child._attributes:
+                ast.copy_location(child,node)
+        if temporaries:
+            index = ast.UnaryOp(op=ast.USub(),operand=ast.Constant(value=1))
+            if sys.version_info < (3,9):
+                index = ast.Index(value=index)
+            expr = ast.Subscript(value=ast.Tuple(elts=temporaries+[expr],
+                                                 ctx=ast.Load()),
+                                 slice=index,ctx=ast.Load())
+            for child in ast.walk(expr):
+                if "lineno" in child._attributes:
+                    ast.copy_location(child,node)
+        return expr
+
+
+class Promise(object):
+    """Base class for promises.
+
+    A "Promise" represents a transformation that can be applied to a function's
+    source, given that the user promises to only use the function in certain
+    restricted ways.  They are intended for use as function- or class-level
+    decorators.  The following methods should be provided by subclasses:
+
+        * decorate(func):  mark the given function as having this promise
+                           applied; this normally defers the modification
+                           until call time.
+
+        * apply(func,source):  actually transform the function's source
+                               to take advantages of the promised behaviour.
+
+    Subclasses may find the following method useful:
+
+        * defer(func):  defer the application of this promise until the
+                        given function is called for the first time.
+    """
+
+    def __init__(self):
+        pass
+
+    def __call__(self,*args):
+        """Apply this promise to a function, module, dict, etc.
+
+        Calling a promise arranges for it to be applied to any functions
+        found in the given arguments.  Each argument can be a raw function,
+        or a class, module or iterable of functions.
+        """
+        if not args:
+            return None
+        for arg in args:
+            if isinstance(arg,types.FunctionType):
+                self.decorate(arg)
+            else:
+                try:
+                    subargs = arg.values()
+                except (AttributeError,TypeError):
+                    subargs =  (getattr(arg,nm) for nm in dir(arg))
+                for subarg in subargs:
+                    if isinstance(subarg,types.FunctionType):
+                        self(subarg)
+        return args[0]
+
+    def decorate(self,func):
+        """Decorate the given function to apply this promise.
+
+        The return value is ignored; in practice this means that decorate()
+        must directly modify the given function rather than the standard
+        practice of creating a wrapper.
+        """
+        self.defer(func)
+
+    def apply(self,func,source):
+        """Apply this promise to the given function.
+
+        The argument 'func' is the function to which the promise is being
+        applied, and 'source' holds its parsed source, which should be
+        modified in-place.
+        """
+        pass
+
+    def defer(self,func):
+        """Defer the application of this promise func is first executed."""
+        if not supported or func.__code__.co_freevars:
+            return
+        # Try to be thread-safe by using setdefault(), which is implemented
+        # in C and is therefore non-interruptible.
+        default = []
+        deferred = func.__dict__.setdefault("_promise_deferred",default)
+        deferred.append(self)
+        if deferred is default:
+            #  Replace the code with a trampoline that applies the promises
+            #  and then calls the function again.  The original code is put
+            #  back by apply_deferred_promises().
+            code = func.__code__
+            func._promise_original = (code,func.__kwdefaults__)
+            changes = dict(co_name=code.co_name,co_filename=code.co_filename,
+                           co_firstlineno=code.co_firstlineno)
+            if hasattr(code,"co_qualname"):
+                changes["co_qualname"] = code.co_qualname
+            func.__code__ = _bootstrap.__code__.replace(**changes)
+            func.__kwdefaults__ = {"_promise_func":func,
+                                   "_promise_apply":apply_deferred_promises}
+
+    def apply_or_defer(self,func):
+        """Apply this promise after any others already deferred.
+
+        Source is only ever rewritten when the function is first called, so
+        this is the same as defer().
+        """
+        self.defer(func)
+
+
+class invariant(Promise):
+    """Promise that the given names are invariant during the function call.
+
+    This promise allows the names to be loaded once, at the beginning of the
+    function, and accessed through local variables from there on out.
+    """
+
+    def __init__(self,names):
+        self.names = names
+        super(invariant,self).__init__()
+
+    def apply(self,func,source):
+        names = [nm for nm in self.names if nm in source.globals]
+        source.check_unbound([nm for nm in self.names],"invariant")
+        for nm in sorted(names):
+            source.bind_invariant(nm)
+
+
+class constant(Promise):
+    """Promise that the given names are constant
+
+    This promise allows the objects referred to by the names to be stored
+    directly with the code, eliminating name lookups.  Any names that are
+    missing when the function is first called are left as ordinary lookups.
+    """
+
+    def __init__(self,names,exclude=[]):
+        self.names = names
+        self.exclude = exclude
+        super(constant,self).__init__()
+
+    def apply(self,func,source):
+        source.check_unbound([nm for nm in self.names],"constant")
+        names = [nm for nm in self.names if nm in source.globals
+                                         and nm not in self.exclude]
+        for nm in sorted(names):
+            try:
+                source.bind_constant(nm)
+            except NameError:
+                pass
+        #  If any constants define a '_promise_fold_constant' method,
+        #  let them have a crack at the source as well.
+        source.fold()
+
+
+class pure(Promise):
+    """Promise that a function is pure.
+
+    A pure function has no side-effects or internal state; it is simply
+    a mapping from input values to output values.  Its globals are all
+    constant, and if it is itself used as a constant by another function
+    its calls may be inlined there as if it were a macro.
+    """
+
+    def decorate(self,func):
+        if func.__code__.co_flags & inspect.CO_VARARGS:
+            raise TypeError("pure functions currently don't support varargs")
+        if func.__code__.co_flags & inspect.CO_VARKEYWORDS:
+            raise TypeError("pure functions currently don't support varkwds")
+        func._promise_fold_constant = self._make_fold_method(func)
+        self.defer(func)
+
+    def apply(self,func,source):
+        #  Since I'm pure, my globals must all be constant
+        for node in ast.walk(source.tree):
+            if isinstance(node,ast.Global):
+                msg = "pure functions must not modify their globals: '%s'"
+                raise BrokenPromiseError(msg % (node.names[0],))
+        constant(sorted(source.globals)).apply(func,source)
+
+    def _make_fold_method(self,source_func):
+        """Make _promise_fold_constant method for the given pure function."""
+        def fold(dest_func,dest_source):
+            """Inline the source of source_func into the given source."""
+            apply_deferred_promises(source_func)
+            inline = getattr(source_func,"_promise_inline",None)
+            if inline is None:
+                return
+            names = set(nm for (nm,value) in dest_source.constants.items()
+                        if value is source_func)
+            tree = copy.deepcopy(dest_source.tree)
+            constants = dict(dest_source.constants)
+            inliner = _Inline(dest_source,source_func,names,inline)
+            tree = inliner.visit(tree)
+            #  Make sure the result still compiles, since assignment
+            #  expressions aren't allowed everywhere.
+            try:
+                dest_source.compile(copy.deepcopy(tree))
+            except SyntaxError:
+                dest_source.constants = constants
+            else:
+                dest_source.tree = tree
+        return fold
+
+
+class sensible(Promise):
+    """Promise that a function is sensibly behaved.  Basically:
+
+        * all builtins are constant
+        * all global functions are constant
+        * all other globals are invariant
+
+    The semantics of this promise will probably change as more types of promise
+    are added to the module.
+    """
+
+    def apply(self,func,source):
+        callable_globals = set()
+        other_globals = set()
+        for nm in source.globals:
+            try:
+                obj = source.lookup(nm)
+            except NameError:
+                continue
+            if callable(obj) or nm not in func.__globals__:
+                callable_globals.add(nm)
+            else:
+                other_globals.add(nm)
+        constant(callable_globals).apply(func,source)
+        invariant(other_globals).apply(func,source)
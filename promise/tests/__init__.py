@@ -102,6 +102,57 @@ def test_inlining():
     
     
 
+def test_cache_is_stable():
+    """Test that running the same code again adds nothing to the cache."""
+    import marshal
+    import shutil
+    import subprocess
+    import tempfile
+    tmpdir = tempfile.mkdtemp()
+    try:
+        modfile = os.path.join(tmpdir,"cachetest.py")
+        f = open(modfile,"w")
+        f.write("""
+import promise
+class Point(object):
+    def __init__(self,x,y):
+        self.x = x
+        self.y = y
+class Pair(object):
+    __slots__ = ("a","b")
+    def __init__(self,a,b):
+        self.a = a
+        self.b = b
+ORIGIN = Point(1,2)
+PAIR = Pair(3,[4,5])
+TABLE = {"one": 1, "two": frozenset([2])}
+@promise.constant(["ORIGIN","PAIR","TABLE"])
+def calc():
+    return ORIGIN.x + PAIR.b[1] + TABLE["one"]
+assert calc() == 7
+""")
+        f.close()
+        env = dict(os.environ)
+        env["PROMISE_CACHE_DIR"] = os.path.join(tmpdir,"cache")
+        env["PYTHONPATH"] = os.pathsep.join([tmpdir] + sys.path)
+        def run():
+            cmd = [sys.executable,"-B","-c","import cachetest"]
+            assert subprocess.call(cmd,env=env,cwd=tmpdir) == 0
+            entries = {}
+            for name in os.listdir(env["PROMISE_CACHE_DIR"]):
+                f = open(os.path.join(env["PROMISE_CACHE_DIR"],name),"rb")
+                try:
+                    entries[name] = marshal.load(f)[2]
+                finally:
+                    f.close()
+            return entries
+        first = run()
+        assert first
+        assert run() == first
+    finally:
+        shutil.rmtree(tmpdir)
+
+
 def test_README():
     """Ensure that the README is in sync with the docstring.
 
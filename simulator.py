@@ -26,8 +26,13 @@ import cond
 import instruction
 import register
 import memory
+import image
+import symindex
+import linetable
 import promise
 import pprint
+import binascii
+import sys
 
 class Area(object):
 	"""Represents an assembler AREA directive"""
@@ -39,14 +44,55 @@ class Area(object):
 		
 class Breakpoint(Exception):
 	pass
+
+# hooks which are called from the decoded instructions
+STEP_HOOKS = ("instruction", "branch", "fault")
+
+def _before(execute, pc, hooks):
+	def hooked(registers):
+		for hook in hooks:
+			hook(pc, registers)
+		execute(registers)
+	return hooked
+
+def _branched(execute, pc, hooks):
+	def hooked(registers):
+		execute(registers)
+		target = registers[registers.PC]
+		if target != pc + 1:
+			for hook in hooks:
+				hook(pc, target, registers)
+	return hooked
+
+def _faulted(execute, pc, hooks):
+	def hooked(registers):
+		try:
+			execute(registers)
+		except Exception, e:
+			for hook in hooks:
+				hook(pc, e)
+			raise
+	return hooked
 		
 
 class Program(object):
 	"""Represents an ARM program."""
 	def __init__(self):
 		self.code = []
+		self.decoded = []
+		self.texts = []
+		self.instrumenters = []
+		self.history = None
+		self.watches = None
+		self.snapshot = None
+		self.hooks = {"instruction": [], "branch": [], "fault": [],
+			"mem_read": [], "mem_write": []}
+		self.symbols = symindex.SymbolIndex()
+		self.lines = linetable.LineTable()
 		self.registers = register.Registers()
 		self.memory = memory.Memory(4096)
+		self.memory.reads = self.hooks["mem_read"]
+		self.memory.writes = self.hooks["mem_write"]
 		self.registers.memory = self.memory
 	
 	def compile(self, tuples):
@@ -71,6 +117,8 @@ class Program(object):
 		data_boffset = 0xA1000000
 		
 		self.code = []
+		lines = []
+		data_lines = []
 		
 		self.breakpoints = []
 				
@@ -101,6 +149,7 @@ class Program(object):
 			if mode == code_s:
 				if isinstance(line, instruction.Instruction):
 					self.code.append(line)
+					lines.append(getattr(line, "line", 0))
 					if label:
 						self.registers.symbol_insert(label, code_woffset)
 						line.label = label
@@ -110,8 +159,204 @@ class Program(object):
 					if label:
 						self.registers.symbol_insert(label, data_boffset)
 					line.store(self.memory, data_boffset)
+					data_lines.append((data_boffset, data_boffset + line.size(), line.line))
 					data_boffset += line.size()
 		self.breakpoints.append(code_woffset - 1)
+		self.data_end = data_boffset
+		self.symbols = symindex.SymbolIndex.from_table(self.registers.symbol_table,
+			self.memory.startaddr)
+		self.lines = linetable.LineTable(lines, data_lines)
+		self.decoded = [self.decode_lazily] * len(self.code)
+		self.texts = [None] * len(self.code)
+	
+	def load(self, img):
+		"""
+		Loads an image.Image, so that its machine code can be run
+		directly. Instructions are decoded as they are reached.
+		"""
+		# instruction imports this module, so decoder can only be
+		# imported once the instruction classes exist
+		import decoder
+		self.memory = decoder.ImageMemory(img)
+		self.memory.reads = self.hooks["mem_read"]
+		self.memory.writes = self.hooks["mem_write"]
+		self.memory.rehook()
+		self.registers.memory = self.memory
+		labels = {}
+		for (name, (value, kind)) in img.symbols.iteritems():
+			self.registers.symbol_insert(name, value)
+			if kind == image.CODE_SYMBOL:
+				labels[value] = name
+		self.code = decoder.DecodedCode(self, self.memory, img.ntext, labels)
+		self.memory.code = self.code
+		self.breakpoints = [img.ntext - 1]
+		self.data_end = img.database + len(img.data)
+		self.symbols = symindex.SymbolIndex(img.symbols)
+		self.lines = linetable.LineTable.unknown(img.ntext)
+		self.decoded = [self.decode_lazily] * img.ntext
+		self.texts = [None] * img.ntext
+	
+	def compact(self):
+		"""
+		Keeps the instructions of a compiled program as columns of
+		arrays (see compact.py) rather than a list of objects.
+		Loaded images already keep theirs as machine code.
+		"""
+		import compact
+		if isinstance(self.code, list):
+			self.code = compact.CompactCode.from_code(self.code)
+	
+	def decode(self, pc):
+		"""
+		Decodes the instruction at pc, storing the function which
+		executes it in self.decoded, and returns that function.
+		The operands are simplified first (see fold.py).
+		"""
+		# fold imports instruction, which imports this module
+		import fold
+		instr = self.code[pc]
+		execute = fold.simplify(instr).execute
+		for instrumenter in self.instrumenters:
+			execute = instrumenter(pc, instr, execute)
+		self.decoded[pc] = execute
+		return execute
+	
+	def undecode(self, pc):
+		'Forgets the decoded instruction at pc'
+		self.decoded[pc] = self.decode_lazily
+	
+	def forget(self, pc):
+		'Forgets everything worked out from the instruction at pc, which has been patched'
+		self.decoded[pc] = self.decode_lazily
+		self.texts[pc] = None
+	
+	def disassemble(self, pc):
+		"""
+		Returns the text of the instruction at pc. It is made the
+		first time it is asked for, and kept until the instruction
+		is patched.
+		"""
+		text = self.texts[pc]
+		if text is None:
+			text = self.texts[pc] = str(self.code[pc])
+		return text
+	
+	def listing(self, start=0, end=None):
+		"""
+		Generates the lines of a listing of the instructions from
+		start up to end, each label on a line of its own, so a
+		long program can be printed without building it all. Text
+		already made by disassemble() is used, but none is kept.
+		"""
+		if end is None:
+			end = len(self.code)
+		texts = self.texts
+		for pc in xrange(start, end):
+			for name in self.symbols.at(pc):
+				yield name
+			yield "\t" + (texts[pc] or str(self.code[pc]))
+	
+	def instrument(self, instrumenter):
+		"""
+		Adds an instrumenter, which is called as
+			instrumenter(pc, instruction, execute)
+		whenever an instruction is decoded, and returns the function
+		to store in self.decoded in place of execute (usually one
+		which does some bookkeeping then calls execute). Everything
+		decoded so far is forgotten, so it all goes through the new
+		instrumenter.
+		"""
+		self.instrumenters.append(instrumenter)
+		self.decoded = [self.decode_lazily] * len(self.decoded)
+	
+	def uninstrument(self, instrumenter):
+		'Removes an instrumenter added by instrument()'
+		self.instrumenters.remove(instrumenter)
+		self.decoded = [self.decode_lazily] * len(self.decoded)
+	
+	def on_instruction(self, hook):
+		"""
+		Calls hook(pc, registers) before each instruction runs. The
+		PC register already points at the next one.
+		"""
+		return self.add_hook("instruction", hook)
+	
+	def on_branch(self, hook):
+		"""
+		Calls hook(pc, target, registers) after the instruction at pc
+		sends the PC anywhere but the next instruction.
+		"""
+		return self.add_hook("branch", hook)
+	
+	def on_mem_read(self, hook):
+		'Calls hook(addr, size, value) after each load'
+		return self.add_hook("mem_read", hook)
+	
+	def on_mem_write(self, hook):
+		'Calls hook(addr, size, value) after each store'
+		return self.add_hook("mem_write", hook)
+	
+	def on_fault(self, hook):
+		"""
+		Calls hook(pc, error) when the instruction at pc raises an
+		error, before it is passed on.
+		"""
+		return self.add_hook("fault", hook)
+	
+	def add_hook(self, event, hook):
+		'Adds a hook for one of the events in self.hooks, and returns it'
+		self.hooks[event].append(hook)
+		self.rehook()
+		return hook
+	
+	def remove_hook(self, hook):
+		'Removes a hook, from whichever events it was added for'
+		for hooks in self.hooks.itervalues():
+			while hook in hooks:
+				hooks.remove(hook)
+		self.rehook()
+	
+	def rehook(self):
+		"""
+		Puts the hooks in place. With none, instructions and memory
+		run exactly as they would if there was no such thing as a
+		hook. Step hooks are added by the hooked instrumenter, only
+		to the instructions that need them, and memory hooks by
+		swapping the memory's load and store methods.
+		"""
+		self.memory.rehook()
+		if self.hooked in self.instrumenters:
+			self.instrumenters.remove(self.hooked)
+		if any(self.hooks[event] for event in STEP_HOOKS):
+			self.instrumenters.append(self.hooked)
+		self.decoded = [self.decode_lazily] * len(self.decoded)
+	
+	def hooked(self, pc, instr, execute):
+		'The instrumenter which calls the step hooks'
+		# hotspot imports instruction, which imports this module
+		import hotspot
+		if self.hooks["fault"]:
+			execute = _faulted(execute, pc, tuple(self.hooks["fault"]))
+		if self.hooks["branch"] and hotspot.writes_pc(instr):
+			execute = _branched(execute, pc, tuple(self.hooks["branch"]))
+		if self.hooks["instruction"]:
+			execute = _before(execute, pc, tuple(self.hooks["instruction"]))
+		return execute
+	
+	def decode_lazily(self, registers):
+		"""
+		Stands in self.decoded for instructions that haven't been
+		decoded yet. The PC has already moved on when it's called.
+		"""
+		self.decode(registers[registers.PC] - 1)(registers)
+	
+	def image(self):
+		"""
+		Assembles the compiled program into ARM machine code,
+		returning an image.Image holding the code, literal pool,
+		data areas and symbol table.
+		"""
+		return image.assemble(self)
 					
 	
 	def start(self):
@@ -124,15 +369,8 @@ class Program(object):
 		"""
 		Returns the symbol closes to the current PC. Debug mode only.
 		"""
-		ans = "{program}"
-		for i in xrange(self.registers[self.registers.PC], -1, -1):
-			line = self.code[i]
-			#print "trying %s %s"%(line.label if line.label != "" else "", line)
-			if line.label != "":
-				ans = line.label
-				num = i
-				break
-		return ans
+		found = self.symbols.lookup(self.registers[self.registers.PC])
+		return found[0] if found else "{program}"
 
 	@promise.sensible()
 	def step(self):
@@ -140,15 +378,14 @@ class Program(object):
 		Steps through one instruction.
 		
 		"""
-		if self.registers[self.registers.PC] in self.breakpoints:
+		registers = self.registers
+		pc = registers[registers.PC]
+		if pc in self.breakpoints:
 			raise Breakpoint()
-	
-		# fetch/decode
-		instr = self.code[self.registers[self.registers.PC]]
 		
-		# execute
-		self.registers[self.registers.PC] += 1
-		instr.execute(self.registers)
+		# execute the decoded instruction
+		registers[registers.PC] = pc + 1
+		self.decoded[pc](registers)
 
 	@promise.sensible()
 	def step_debug(self):
@@ -156,12 +393,12 @@ class Program(object):
 		Steps through one instruction.
 		
 		"""
-		# fetch/decode
-		instr = self.code[self.registers[self.registers.PC]]
+		registers = self.registers
+		pc = registers[registers.PC]
 		
-		# execute
-		self.registers[self.registers.PC] += 1
-		instr.execute(self.registers)
+		# execute the decoded instruction
+		registers[registers.PC] = pc + 1
+		self.decoded[pc](registers)
 		if len(self.registers.changed) > 1:
 			self.registers.p()
 			self.registers.set_clean()
@@ -176,18 +413,69 @@ class Program(object):
 				self.step()
 		except:
 			print "Breakpoint detected!"
-			print str(self.code[self.registers[self.registers.PC]])
+			reason = str(sys.exc_info()[1])
+			if reason:
+				print reason
+			print self.disassemble(self.registers[self.registers.PC])
 			self.debug()
 			
+	def print_changes(self):
+		'Prints the memory which changed since this was last called'
+		snapshot = self.memory.snapshot()
+		if self.snapshot is None:
+			print "Saved memory, to compare with next time."
+		else:
+			for (addr, old, new) in memory.diff(self.snapshot, snapshot, self.memory.startaddr):
+				print "0x%X: %s -> %s"%(addr, binascii.hexlify(old).upper(),
+					binascii.hexlify(new).upper())
+		self.snapshot = snapshot
+	
+	def toggle_watch(self, args):
+		"""
+		Sets or clears a watchpoint on the word at a label or address,
+		for the kinds of access given as any of r, w or c.
+		"""
+		# watch imports this module
+		import watch
+		if not 1 <= len(args) <= 2:
+			print "Usage: w target [r|w|c]"
+			return
+		target = args[0]
+		if target in self.symbols:
+			addr = self.symbols.address(target)
+		else:
+			try:
+				addr = int(target, 0)
+			except ValueError:
+				print "No symbol " + target
+				return
+		kind = 0
+		for letter in args[1] if len(args) > 1 else "w":
+			if letter not in watch.KINDS:
+				print "Unknown kind of watchpoint " + letter
+				return
+			kind |= watch.KINDS[letter]
+		if self.watches is None:
+			self.watches = watch.Watchpoints(self)
+		watchpoint = self.watches.find(addr)
+		if watchpoint is not None:
+			self.watches.unwatch(watchpoint)
+			print "Stopped watching " + str(watchpoint)
+		else:
+			try:
+				print "Watching " + str(self.watches.watch(addr, 4, kind))
+			except memory.MemoryError, e:
+				print e
+	
 	def debug(self):
 		# simple repl
 		lastcmd = 's'
 		while True:
-			print ">> " + str(self.code[self.registers[self.registers.PC]])
-			sym = self.cursym()
-			num = self.registers.symbol_table[sym] if sym != "{program}" else 0
+			print ">> " + self.disassemble(self.registers[self.registers.PC])
 			try:
-				cmd = raw_input("0x%X <%s + 0x%X>: "%(self.registers[self.registers.PC], sym, self.registers[self.registers.PC] - num))
+				pc = self.registers[self.registers.PC]
+				cmd = raw_input(" ".join(filter(None, (self.symbols.describe(pc),
+					self.lines.describe(pc)))) + ": ")
 			except Exception, e:
 				print "\nQuitting."
 				exit(1)
@@ -196,7 +484,10 @@ class Program(object):
 			else:
 				lastcmd = cmd
 			if cmd == "s":
-				self.step_debug()
+				try:
+					self.step_debug()
+				except Breakpoint, e:
+					print e
 			elif cmd == "q":
 				break
 			elif cmd == "p":
@@ -205,9 +496,37 @@ class Program(object):
 				self.memory.debug()
 			elif cmd == "mb":
 				self.memory.debug_char()
+			elif cmd == "md":
+				self.print_changes()
 			elif cmd == "c":
 				self.run()
+			elif cmd in ("rs", "rc"):
+				if self.history is None:
+					print "Not recording, so can't go back."
+				elif cmd == "rs":
+					if not self.history.reverse_step():
+						print "At the start."
+				elif not self.history.reverse_continue():
+					print "No breakpoint before, back at the start."
+			elif cmd.startswith("b "):
+				target = cmd[2:].strip()
+				if target in self.symbols:
+					pc = self.symbols.address(target)
+				else:
+					try:
+						pc = int(target, 0)
+					except ValueError:
+						print "No symbol " + target
+						continue
+				if pc in self.breakpoints:
+					self.breakpoints.remove(pc)
+				else:
+					self.breakpoints.append(pc)
+			elif cmd.startswith("w "):
+				self.toggle_watch(cmd[2:].split())
 			elif cmd == "t":
-				for sym in self.registers.symbol_table:
-					print sym + ": " + hex(self.registers.symbol_table[sym])
+				for (value, sym) in self.symbols.sorted(symindex.CODE_SYMBOL):
+					print sym + ": " + hex(value)
+				for (value, sym) in self.symbols.sorted(symindex.DATA_SYMBOL):
+					print sym + ": " + hex(value)
 	
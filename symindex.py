@@ -0,0 +1,115 @@
+##########################################################################
+# This file is part of d00ks.
+# 
+# d00ks is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# d00ks is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with d00ks.  If not, see <http://www.gnu.org/licenses/>.
+##########################################################################
+
+
+"""
+This file contains the symbol index of a program: its symbols
+sorted by address, with code and data kept apart, so the symbol
+at or before an address is found with a binary search instead of
+by scanning the program.
+
+It is built once, when a program is compiled or loaded, and used
+by the debugger, the profilers and listings.
+"""
+
+import bisect
+from image import CODE_SYMBOL, DATA_SYMBOL
+
+class SymbolIndex(object):
+	"""
+	addresses[kind] is the sorted list of the addresses of the
+	symbols of that kind (image.CODE_SYMBOL or image.DATA_SYMBOL)
+	and names[kind] is the list of their names. Code addresses are
+	PCs, data addresses are byte addresses.
+	"""
+	def __init__(self, symbols={}):
+		self.symbols = dict(symbols)
+		self.addresses = {CODE_SYMBOL: [], DATA_SYMBOL: []}
+		self.names = {CODE_SYMBOL: [], DATA_SYMBOL: []}
+		entries = sorted((kind, value, name) for (name, (value, kind)) in self.symbols.iteritems())
+		for (kind, value, name) in entries:
+			self.addresses[kind].append(value)
+			self.names[kind].append(name)
+
+	@classmethod
+	def from_table(cls, table, database):
+		"""
+		Makes an index from a symbol table of name: value, taking
+		every symbol at or above database to be data.
+		"""
+		symbols = {}
+		for (name, value) in table.iteritems():
+			symbols[name] = (value, DATA_SYMBOL if value >= database else CODE_SYMBOL)
+		return cls(symbols)
+
+	def __len__(self):
+		return len(self.symbols)
+
+	def __contains__(self, name):
+		return name in self.symbols
+
+	def address(self, name):
+		'Returns the address of the symbol name'
+		return self.symbols[name][0]
+
+	def kind(self, name):
+		return self.symbols[name][1]
+
+	def lookup(self, addr, kind=CODE_SYMBOL):
+		"""
+		Returns (name, address) of the nearest symbol of the given
+		kind at or before addr, or None if there isn't one. Of
+		several symbols at the same address the last by name wins.
+		"""
+		i = bisect.bisect_right(self.addresses[kind], addr) - 1
+		if i < 0:
+			return None
+		return (self.names[kind][i], self.addresses[kind][i])
+
+	def at(self, addr, kind=CODE_SYMBOL):
+		'Returns the names of the symbols of the given kind at exactly addr'
+		addresses = self.addresses[kind]
+		lo = bisect.bisect_left(addresses, addr)
+		hi = bisect.bisect_right(addresses, addr, lo)
+		return self.names[kind][lo:hi]
+
+	def describe(self, addr, kind=CODE_SYMBOL):
+		'Describes addr as 0x<addr> <symbol + 0x<offset>>'
+		found = self.lookup(addr, kind)
+		if found is None:
+			return "0x%X <{program} + 0x%X>"%(addr, addr)
+		return "0x%X <%s + 0x%X>"%(addr, found[0], addr - found[1])
+
+	def ranges(self, kind=CODE_SYMBOL, end=None):
+		"""
+		Returns (name, start, end) for each symbol of the given kind,
+		in address order, where end is the address of the next symbol
+		(or the given end for the last one).
+		"""
+		addresses = self.addresses[kind]
+		names = self.names[kind]
+		ans = []
+		for i in xrange(len(addresses)):
+			stop = addresses[i + 1] if i + 1 < len(addresses) else end
+			ans.append((names[i], addresses[i], stop))
+		return ans
+
+	def sorted(self, kind=None):
+		'Returns (address, name) for the symbols of kind (or all), by address'
+		if kind is None:
+			return sorted((value, name) for (name, (value, k)) in self.symbols.iteritems())
+		return zip(self.addresses[kind], self.names[kind])
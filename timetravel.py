@@ -0,0 +1,283 @@
+##########################################################################
+# This file is part of d00ks.
+# 
+# d00ks is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# d00ks is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with d00ks.  If not, see <http://www.gnu.org/licenses/>.
+##########################################################################
+
+
+"""
+This file lets the debugger step backwards.
+
+A History takes a Checkpoint of the registers, and of the memory
+pages written since the last one, every so many instructions. To
+go back to an earlier step, the nearest checkpoint before it is
+restored and the program is run forward from there until it gets
+to that step again. Runs are deterministic, so the replay ends up
+in exactly the state the program was in. The replay runs the plain
+instructions, with the memory hooks and watchpoints taken out, so
+profilers, traces and the like only ever see each step once.
+
+Recent checkpoints are kept close together so reverse steps are
+quick, and older ones are thinned out as the run goes on, so the
+number kept only grows with the log of the number of steps. If
+the saved pages still go over the limit, the interval between new
+checkpoints is doubled.
+"""
+
+from bisect import bisect_right
+
+# checkpoints save memory 1 << PAGE_BITS bytes at a time
+PAGE_BITS = 8
+PAGE = 1 << PAGE_BITS
+
+# steps between checkpoints, to begin with
+INTERVAL = 4096
+# a checkpoint n steps old is kept at most n / DENSITY steps from
+# its neighbours
+DENSITY = 8
+# bytes of saved pages
+LIMIT = 16 << 20
+
+class Checkpoint(object):
+	"""
+	The state of a program before it ran the instruction at step:
+	its registers, with the PC of that instruction, and a dict of
+	the pages written since the checkpoint before, by page number.
+	"""
+	def __init__(self, step, regs, pages):
+		self.step = step
+		self.regs = regs
+		self.pages = pages
+	
+	def __repr__(self):
+		return "<Checkpoint %i: %i pages>"%(self.step, len(self.pages))
+
+class History(object):
+	"""
+	Records checkpoints of a program as it runs, until close() is
+	called. Every instruction is wrapped when it is decoded to count
+	steps, and a memory hook finds the pages that are written.
+	"""
+	def __init__(self, program, interval=INTERVAL, limit=LIMIT, density=DENSITY):
+		self.program = program
+		self.memory = program.memory
+		self.interval = interval
+		self.limit = limit
+		self.density = density
+		self.checkpoints = []
+		self.size = 0
+		self.now = 0
+		self.due = 0
+		# the first checkpoint has every page
+		npages = (len(self.memory.buffer) + PAGE - 1) >> PAGE_BITS
+		self.dirty = set(xrange(npages))
+		program.on_mem_write(self.store)
+		program.instrument(self.instrument)
+		program.history = self
+
+	def store(self, addr, size, value):
+		self.dirty.add(self.memory.realaddr(addr) >> PAGE_BITS)
+
+	def instrument(self, pc, instr, execute):
+		def recorded(registers):
+			if self.now == self.due:
+				self.arrive(pc)
+			self.now += 1
+			execute(registers)
+		return recorded
+
+	def arrive(self, pc):
+		"""
+		Called before the instruction at pc runs, when the step is
+		one a checkpoint is (or is due to be) taken at.
+		"""
+		checkpoints = self.checkpoints
+		if not checkpoints or checkpoints[-1].step < self.now:
+			regs = list(self.program.registers.regs)
+			regs[15] = pc
+			pages = {}
+			buffer = self.memory.buffer
+			for page in self.dirty:
+				pages[page] = buffer[page << PAGE_BITS:(page + 1) << PAGE_BITS]
+				self.size += len(pages[page])
+			checkpoints.append(Checkpoint(self.now, regs, pages))
+			self.thin()
+		self.dirty.clear()
+		self.due = self.schedule()
+
+	def schedule(self):
+		'Returns the step after this one at which a checkpoint is reached'
+		steps = [checkpoint.step for checkpoint in self.checkpoints]
+		i = bisect_right(steps, self.now)
+		if i < len(steps):
+			return steps[i]
+		return steps[-1] + self.interval
+
+	def drop(self, i):
+		'Forgets checkpoint i, merging its pages into the one after'
+		older = self.checkpoints.pop(i)
+		newer = self.checkpoints[i]
+		for (page, data) in older.pages.iteritems():
+			if page in newer.pages:
+				self.size -= len(data)
+			else:
+				newer.pages[page] = data
+
+	def thin(self):
+		"""
+		Drops the checkpoints that are closer together than their age
+		calls for, then the closest ones while the saved pages are over
+		the limit. The first and last are always kept.
+		"""
+		checkpoints = self.checkpoints
+		i = 1
+		while i < len(checkpoints) - 1:
+			gap = checkpoints[i + 1].step - checkpoints[i - 1].step
+			if gap <= max(self.interval, (self.now - checkpoints[i].step) // self.density):
+				self.drop(i)
+			else:
+				i += 1
+		if self.size > self.limit and len(checkpoints) > 2:
+			self.interval *= 2
+			while self.size > self.limit and len(checkpoints) > 2:
+				gaps = [(checkpoints[i + 1].step - checkpoints[i - 1].step, i)
+					for i in xrange(1, len(checkpoints) - 1)]
+				self.drop(min(gaps)[1])
+
+	def page(self, i, page):
+		'Returns the contents of page as of checkpoint i'
+		while page not in self.checkpoints[i].pages:
+			i -= 1
+		return self.checkpoints[i].pages[page]
+
+	def restore(self, i):
+		'Puts the program back in the state of checkpoint i'
+		checkpoints = self.checkpoints
+		# anything written since could differ
+		pages = set(self.dirty)
+		for checkpoint in checkpoints[i + 1:]:
+			pages.update(checkpoint.pages)
+		buffer = self.memory.buffer
+		code_size = getattr(self.memory, "code_size", 0)
+		for page in pages:
+			data = self.page(i, page)
+			lo = page << PAGE_BITS
+			hi = lo + len(data)
+			if buffer[lo:hi] != data:
+				buffer[lo:hi] = data
+				if lo < code_size:
+					self.memory.code.invalidate(lo >> 2)
+		self.dirty.clear()
+		registers = self.program.registers
+		registers.regs[:] = checkpoints[i].regs
+		registers.set_clean()
+		self.now = self.due = checkpoints[i].step
+
+	def execute(self):
+		"""
+		Runs one instruction, without looking for breakpoints. It
+		isn't run decoded, so the other instrumenters (profilers,
+		traces, idle detection, ...) don't see it a second time.
+		"""
+		registers = self.program.registers
+		pc = registers[registers.PC]
+		if self.now == self.due:
+			self.arrive(pc)
+		self.now += 1
+		registers[registers.PC] = pc + 1
+		self.program.code[pc].execute(registers)
+
+	def suspend(self):
+		"""
+		Takes the memory hooks and watchpoints out while replaying,
+		all but the one finding the pages written. Returns what
+		resume() needs to put them back.
+		"""
+		memory = self.memory
+		saved = (memory.reads, memory.writes, memory.watched, memory.watchpoints)
+		memory.reads = []
+		memory.writes = [self.store]
+		memory.watched = {}
+		memory.watchpoints = []
+		memory.rehook()
+		return saved
+
+	def resume(self, saved):
+		memory = self.memory
+		(memory.reads, memory.writes, memory.watched, memory.watchpoints) = saved
+		memory.rehook()
+
+	def nearest(self, step):
+		'Returns the index of the last checkpoint at or before step'
+		steps = [checkpoint.step for checkpoint in self.checkpoints]
+		return bisect_right(steps, step) - 1
+
+	def seek(self, step):
+		"""
+		Goes to the given step, restoring a checkpoint first if it is
+		in the past.
+		"""
+		saved = self.suspend()
+		try:
+			if step < self.now:
+				self.restore(self.nearest(step))
+			while self.now < step:
+				self.execute()
+		finally:
+			self.resume(saved)
+		self.program.registers.set_clean()
+
+	def reverse_step(self, n=1):
+		'Goes back n steps. Returns False if already at the start'
+		if self.now == 0:
+			return False
+		self.seek(max(0, self.now - n))
+		return True
+
+	def reverse_continue(self):
+		"""
+		Goes back to the last step at which the PC was at a breakpoint,
+		looking through one checkpoint interval at a time, latest
+		first. Returns False if there was none, having gone back to
+		the start.
+		"""
+		breakpoints = self.program.breakpoints
+		registers = self.program.registers
+		end = self.now
+		saved = self.suspend()
+		try:
+			while end > 0:
+				i = self.nearest(end - 1)
+				start = self.checkpoints[i].step
+				self.restore(i)
+				found = None
+				while self.now < end:
+					if registers[registers.PC] in breakpoints:
+						found = self.now
+					self.execute()
+				if found is not None:
+					self.seek(found)
+					return True
+				end = start
+			self.seek(0)
+			return False
+		finally:
+			self.resume(saved)
+
+	def close(self):
+		'Stops recording and forgets the checkpoints'
+		self.program.uninstrument(self.instrument)
+		self.program.remove_hook(self.store)
+		self.program.history = None
+		self.checkpoints = []
@@ -0,0 +1,297 @@
+#!/usr/bin/env python
+##########################################################################
+# This file is part of d00ks.
+# 
+# d00ks is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# d00ks is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with d00ks.  If not, see <http://www.gnu.org/licenses/>.
+##########################################################################
+
+
+"""
+This file records a trace of a running Program: every step, the
+registers it changed and the memory it read and wrote.
+
+The trace is a sequence of fixed-size records:
+	kind, size, step, address, value
+where kind is STEP (address is the PC), REGISTER (size is the
+register number, value its new value), READ or WRITE (size is
+1, 2 or 4 bytes). step counts from 0 and is stored in 32 bits;
+the reader puts back the bits lost when it wraps.
+
+Records are packed into a preallocated buffer, which a Writer
+writes out to a file whenever it fills up (through gzip if the
+file name ends in .gz), so a trace never has to fit in memory. A
+RingBuffer instead keeps only the most recent records.
+
+	writer = tracefile.Writer("run.trace.gz")
+	trace = tracefile.Trace(program, writer)
+	program.run()
+	trace.close()
+
+	for (kind, size, step, addr, value) in tracefile.read("run.trace.gz"):
+		...
+
+From the command line, a trace can be printed, keeping only the
+steps whose PC is in a range, or only the accesses to a range of
+addresses:
+	python tracefile.py [-p lo:hi] [-a lo:hi] file.trace
+"""
+
+import sys
+import gzip
+import struct
+
+MAGIC = "D00T"
+VERSION = 1
+HEADER = struct.Struct("<4sHH")
+
+# kind, size or register, (padding), step, address, value
+RECORD = struct.Struct("<BBHIII")
+
+STEP = 0
+REGISTER = 1
+READ = 2
+WRITE = 3
+
+# records to buffer before writing them out
+CHUNK = 4096
+
+class TraceError(Exception):
+	pass
+
+def _open(path, mode):
+	if path.endswith(".gz"):
+		# the fastest level still shrinks a trace several times over
+		return gzip.open(path, mode, 1)
+	return open(path, mode)
+
+class Writer(object):
+	'Writes records to a file, a buffer at a time'
+	def __init__(self, path, chunk=CHUNK):
+		self.file = _open(path, "wb")
+		self.file.write(HEADER.pack(MAGIC, VERSION, 0))
+		self.buffer = bytearray(RECORD.size*chunk)
+		self.offset = 0
+
+	def record(self, kind, size, step, addr, value):
+		RECORD.pack_into(self.buffer, self.offset, kind, size, 0,
+			step & 0xFFFFFFFF, addr & 0xFFFFFFFF, value & 0xFFFFFFFF)
+		self.offset += RECORD.size
+		if self.offset == len(self.buffer):
+			self.flush()
+
+	def flush(self):
+		self.file.write(buffer(self.buffer, 0, self.offset))
+		self.offset = 0
+
+	def close(self):
+		self.flush()
+		self.file.close()
+
+class RingBuffer(object):
+	'Keeps the last n records in memory'
+	def __init__(self, n=65536):
+		self.n = n
+		self.buffer = bytearray(RECORD.size*n)
+		self.next = 0
+		self.full = False
+
+	def record(self, kind, size, step, addr, value):
+		RECORD.pack_into(self.buffer, self.next*RECORD.size, kind, size, 0,
+			step & 0xFFFFFFFF, addr & 0xFFFFFFFF, value & 0xFFFFFFFF)
+		self.next += 1
+		if self.next == self.n:
+			self.next = 0
+			self.full = True
+
+	def raw(self):
+		'Returns the records as a string, oldest first'
+		end = self.next*RECORD.size
+		if self.full:
+			return str(self.buffer[end:] + self.buffer[:end])
+		return str(self.buffer[:end])
+
+	def __iter__(self):
+		return _unpack([self.raw()])
+
+	def save(self, path):
+		'Writes the records to a file that read() can load'
+		f = _open(path, "wb")
+		try:
+			f.write(HEADER.pack(MAGIC, VERSION, 0))
+			f.write(self.raw())
+		finally:
+			f.close()
+
+	def close(self):
+		pass
+
+class Trace(object):
+	"""
+	Records the execution of a program into a Writer or RingBuffer.
+	Every instruction is wrapped when it is decoded, and every load
+	and store goes through a memory hook, until close() is called.
+	"""
+	def __init__(self, program, sink):
+		self.program = program
+		self.sink = sink
+		self.steps = 0
+		program.on_mem_read(self.load)
+		program.on_mem_write(self.store)
+		program.instrument(self.instrument)
+
+	def load(self, addr, size, value):
+		self.sink.record(READ, size, self.steps, addr, value)
+
+	def store(self, addr, size, value):
+		self.sink.record(WRITE, size, self.steps, addr, value)
+
+	def instrument(self, pc, instr, execute):
+		record = self.sink.record
+		def traced(registers):
+			step = self.steps
+			record(STEP, 0, step, pc, 0)
+			changed = registers.changed
+			n = len(changed)
+			cpsr = registers.regs[16]
+			execute(registers)
+			# the PC is in the next STEP record
+			for key in changed[n:]:
+				if key != 15:
+					record(REGISTER, key, step, 0, registers[key])
+			# flag_set() changes the CPSR without going through changed
+			if registers.regs[16] != cpsr and 16 not in changed[n:]:
+				record(REGISTER, 16, step, 0, registers.regs[16])
+			# everything is in the trace, so don't let changed grow every step
+			del changed[n:]
+			self.steps = step + 1
+		return traced
+
+	def close(self):
+		'Stops tracing and closes the sink'
+		self.program.uninstrument(self.instrument)
+		self.program.remove_hook(self.load)
+		self.program.remove_hook(self.store)
+		self.sink.close()
+
+def _unpack(chunks):
+	'Yields the records in a sequence of strings'
+	size = RECORD.size
+	unpack = RECORD.unpack_from
+	high = 0
+	last = 0
+	rest = ""
+	for chunk in chunks:
+		if rest:
+			chunk = rest + chunk
+		end = len(chunk) - len(chunk) % size
+		for offset in xrange(0, end, size):
+			(kind, n, pad, step, addr, value) = unpack(chunk, offset)
+			if step < last:
+				high += 1 << 32
+			last = step
+			yield (kind, n, high | step, addr, value)
+		rest = chunk[end:]
+	if rest:
+		raise TraceError("Trace ends with a partial record")
+
+def read(path, chunk=CHUNK):
+	"""
+	Yields the records in a trace file as tuples of
+	(kind, size, step, address, value), reading it a chunk at a
+	time.
+	"""
+	f = _open(path, "rb")
+	try:
+		header = f.read(HEADER.size)
+		if len(header) < HEADER.size:
+			raise TraceError("Trace is truncated")
+		(magic, version, flags) = HEADER.unpack(header)
+		if magic != MAGIC:
+			raise TraceError("Not a d00ks trace")
+		if version != VERSION:
+			raise TraceError("Unsupported trace version %i"%version)
+		def chunks():
+			while True:
+				data = f.read(RECORD.size*chunk)
+				if not data:
+					break
+				yield data
+		for record in _unpack(chunks()):
+			yield record
+	finally:
+		f.close()
+
+def select(records, pcs=None, addrs=None):
+	"""
+	Filters records: with pcs = (lo, hi), only the steps whose PC
+	is in [lo, hi) are kept, with their register and memory records;
+	with addrs = (lo, hi), only the memory accesses which touch
+	[lo, hi) are kept, each after the STEP record it belongs to.
+	"""
+	keep = True
+	pending = None
+	for record in records:
+		kind = record[0]
+		if kind == STEP:
+			keep = pcs is None or pcs[0] <= record[3] < pcs[1]
+			pending = record
+			if keep and addrs is None:
+				yield record
+				pending = None
+			continue
+		if not keep:
+			continue
+		if addrs is not None:
+			if kind not in (READ, WRITE):
+				continue
+			(lo, hi) = addrs
+			if record[3] + record[1] <= lo or record[3] >= hi:
+				continue
+			if pending is not None:
+				yield pending
+				pending = None
+		yield record
+
+def describe(record):
+	(kind, size, step, addr, value) = record
+	if kind == STEP:
+		return "%10i 0x%X"%(step, addr)
+	if kind == REGISTER:
+		return "%10s R%i = 0x%08X"%("", size, value)
+	return "%10s %s%i [0x%08X] = 0x%X"%("", "read " if kind == READ else "write", 8*size, addr, value)
+
+def _range(arg):
+	(lo, hi) = arg.split(":")
+	return (int(lo, 0), int(hi, 0))
+
+def main(argv):
+	pcs = addrs = None
+	args = iter(argv)
+	path = None
+	for arg in args:
+		if arg == "-p":
+			pcs = _range(args.next())
+		elif arg == "-a":
+			addrs = _range(args.next())
+		else:
+			path = arg
+	if path is None:
+		print "usage: tracefile.py [-p lo:hi] [-a lo:hi] file.trace"
+		return 2
+	for record in select(read(path), pcs, addrs):
+		print describe(record)
+	return 0
+
+if __name__ == "__main__":
+	sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,117 @@
+##########################################################################
+# This file is part of d00ks.
+# 
+# d00ks is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# d00ks is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with d00ks.  If not, see <http://www.gnu.org/licenses/>.
+##########################################################################
+
+
+"""
+This file stops a program when memory it is watching is read,
+written or changed, for hunting down whatever is trampling the
+stack in a long run.
+
+The checking is done by the Memory, which keeps its watchpoints
+indexed by page: an access to a page with no watchpoint on it
+costs one dictionary lookup, and with no watchpoints at all the
+loads and stores aren't touched. The Watchpoints instrumenter
+wraps the instructions which access memory, only while there
+are watchpoints, and raises Watched once one of them has found
+something. The instruction is allowed to finish first, so the
+new value is in memory when the program stops.
+
+	watches = watch.Watchpoints(program)
+	watches.watch(program.symbols.address("stack"), 4, memory.WATCH_CHANGE)
+	program.run()
+"""
+
+import simulator
+import instruction
+import memory
+
+# instructions which read or write memory
+ACCESSES = (instruction.LDR, instruction.LDRB, instruction.LDRH,
+	instruction.LDSB, instruction.LDSH, instruction.LDM,
+	instruction.STR, instruction.STRB, instruction.STRH,
+	instruction.STM, instruction.SWP, instruction.SWPB)
+
+KINDS = {"r": memory.WATCH_READ, "w": memory.WATCH_WRITE, "c": memory.WATCH_CHANGE}
+
+_names = {memory.WATCH_READ: "read", memory.WATCH_WRITE: "write",
+	memory.WATCH_CHANGE: "change"}
+
+class Watched(simulator.Breakpoint):
+	"""
+	Raised with the PC of the instruction which set off a
+	watchpoint, the kind of access, the address and size of the
+	access, and the watched value before and after it. Any other
+	watchpoints set off by the same instruction are in hits, as
+	tuples in the form of Memory.hits.
+	"""
+	def __init__(self, pc, hits):
+		(watchpoint, kind, addr, size, old, new) = hits[0]
+		super(Watched, self).__init__(
+			"Watchpoint: %s of %i bytes at 0x%X by the instruction at 0x%X, 0x%X -> 0x%X"%(
+			_names[kind], size, addr, pc, old, new))
+		self.reason = "watchpoint"
+		self.pc = pc
+		self.watchpoint = watchpoint
+		self.kind = kind
+		self.addr = addr
+		self.size = size
+		self.old = old
+		self.new = new
+		self.hits = hits
+
+class Watchpoints(object):
+	'Raises Watched from a program when one of its watchpoints is hit'
+	def __init__(self, program):
+		self.program = program
+		self.memory = program.memory
+		self.attached = False
+
+	def watch(self, addr, size=4, kind=memory.WATCH_WRITE):
+		'Adds and returns a memory.Watchpoint'
+		watchpoint = self.memory.watch(addr, size, kind)
+		if not self.attached:
+			self.program.instrument(self.instrument)
+			self.attached = True
+		return watchpoint
+
+	def unwatch(self, watchpoint):
+		self.memory.unwatch(watchpoint)
+		if not self.memory.watchpoints and self.attached:
+			self.program.uninstrument(self.instrument)
+			self.attached = False
+
+	def find(self, addr):
+		'Returns the watchpoint starting at addr, or None'
+		for watchpoint in self.memory.watchpoints:
+			if watchpoint.addr == addr:
+				return watchpoint
+		return None
+
+	def instrument(self, pc, instr, execute):
+		if not isinstance(instr, ACCESSES):
+			return execute
+		hits = self.memory.hits
+		def watched(registers):
+			if hits:
+				# left over from something outside the program
+				del hits[:]
+			execute(registers)
+			if hits:
+				found = list(hits)
+				del hits[:]
+				raise Watched(pc, found)
+		return watched